@@ -0,0 +1,211 @@
+"""
+Measures the latency and scaling of pyvinga checks against the fake vCenter in fakevc.py.
+
+For each inventory size every main() path (vm, host, datastore and cluster with each of their counters) is
+run as a check would be run by Icinga, followed by get_properties over every Virtual Machine and
+write_perf_dictionary with and without an existing dictionary file.  For each of them the wall time (best of
+--repeat runs), the peak Python memory allocated (measured by tracemalloc in a separate run) and the number
+of vCenter calls are reported.  Every call is delayed by --latency milliseconds to simulate the round trip
+to vCenter, so the number of calls made by a check shows up in its wall time as it would on a real network.
+
+All cache files (performance dictionary, index, sessions, samples and results) are kept in a temporary
+directory that is removed afterwards, so the benchmark does not touch the files of a real installation.
+
+Usage: python3 benchmarks/bench_checks.py [--latency MS] [--repeat N] [--only PATTERN] [number of VMs ...]
+"""
+
+import argparse
+import contextlib
+import fnmatch
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyVmomi import vim
+import pyvinga
+from fakevc import FakeVCenter
+
+default_sizes = [100, 1000, 10000, 50000]
+
+
+class ExitHandlers(object):
+    """
+    Stands in for the atexit module in pyvinga, so the handlers registered by a check (such as Disconnect)
+    run when the check finishes instead of piling up until the benchmark exits
+    """
+    def __init__(self):
+        self.handlers = []
+
+    def register(self, func, *args, **kwargs):
+        self.handlers.append((func, args, kwargs))
+
+    def run(self):
+        while self.handlers:
+            func, args, kwargs = self.handlers.pop()
+            func(*args, **kwargs)
+
+
+def GetArgs():
+    """
+    Supports the command-line arguments listed below.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark pyvinga checks against a fake vCenter')
+    parser.add_argument('sizes', nargs='*', type=int, default=default_sizes, metavar='VMS',
+                        help='Number of Virtual Machines in each generated inventory (default: %s)' %
+                        ' '.join(str(size) for size in default_sizes))
+    parser.add_argument('--latency', type=float, default=1.0,
+                        help='Simulated round trip time of every vCenter call in milliseconds (default: 1)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of timed runs of each benchmark, the fastest is reported (default: 3)')
+    parser.add_argument('--only', default='*',
+                        help='Only run the benchmarks whose name matches this pattern, e.g. "vm *" (default: *)')
+    return parser.parse_args()
+
+
+def check_matrix(vc):
+    """
+    Lists the command lines of every check path, one entry per entity type and counter
+
+    :param vc: The FakeVCenter the checks run against
+    :return: A list of tuples of the benchmark name and the pyvinga arguments
+    """
+    entities = {
+        'vm': vc.objects[vc.vms[0]].props['name'],
+        'host': vc.objects[vc.hosts[0]].props['name'],
+        'datastore': vc.objects[vc.datastores[0]].props['name'],
+        'cluster': vc.objects[vc.clusters[0]].props['name'],
+    }
+    matrix = []
+    for entity_type in ('vm', 'host', 'datastore', 'cluster'):
+        for counter in pyvinga.cached_counters[entity_type]:
+            matrix.append(('{} {}'.format(entity_type, counter),
+                           ['-s', 'vcenter', '-u', 'pyvinga', '-p', 'secret', '-n', entity_type,
+                            '-e', entities[entity_type], '-r', counter, '-w', '80', '-c', '90']))
+    return matrix
+
+
+def run_main(argv, exit_handlers):
+    """
+    Runs pyvinga.main() with the given arguments as a single check
+
+    :return: The output printed by the check
+    """
+    sys.argv = ['pyvinga.py'] + argv
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            pyvinga.main()
+        except SystemExit:
+            pass
+        finally:
+            exit_handlers.run()
+    return output.getvalue()
+
+
+def measure(vc, func, repeat, setup=None):
+    """
+    Runs func repeat times for the wall time and once more under tracemalloc for the peak memory
+
+    :param vc: The FakeVCenter whose calls are counted
+    :param func: The function to benchmark
+    :param repeat: The number of timed runs
+    :param setup: Optional function called before every run, outside of the measurement
+    :return: A tuple of the fastest wall time, the peak memory in bytes, the calls of one run and the result
+    """
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        with vc.lock:
+            vc.calls.clear()
+        start = time.time()
+        result = func()
+        wall = time.time() - start
+        best = wall if best is None else min(best, wall)
+    calls = dict(vc.calls)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak, calls, result
+
+
+def report(name, best, peak, calls):
+    print('  {:<30} {:>10.1f} ms {:>10.1f} KB {:>6} calls  {}'.format(
+        name, best * 1000, peak / 1024, sum(calls.values()),
+        ', '.join('{} {}'.format(call, count) for call, count in sorted(calls.items()))))
+
+
+def bench(num_vms, args, work_dir):
+    start = time.time()
+    vc = FakeVCenter(num_vms=num_vms, latency=args.latency / 1000)
+    print('{} VMs, {} hosts, {} datastores, {} clusters (generated in {:.1f} s, {} ms latency)'.format(
+        len(vc.vms), len(vc.hosts), len(vc.datastores), len(vc.clusters), time.time() - start, args.latency))
+    pyvinga.SmartConnect = vc.SmartConnect
+    pyvinga.Disconnect = vc.Disconnect
+    pyvinga.SoapStubAdapter = vc.SoapStubAdapter
+    exit_handlers = ExitHandlers()
+    pyvinga.atexit = exit_handlers
+
+    # Every inventory size starts without any cache files, the first check builds the performance dictionary
+    for name in os.listdir(work_dir):
+        os.remove(os.path.join(work_dir, name))
+    matrix = check_matrix(vc)
+    run_main(matrix[0][1], exit_handlers)
+
+    for name, argv in matrix:
+        if fnmatch.fnmatch(name, args.only):
+            best, peak, calls, output = measure(vc, lambda: run_main(argv, exit_handlers), args.repeat)
+            if not output.strip():
+                print('  WARNING: {} printed nothing'.format(name))
+            report(name, best, peak, calls)
+
+    si = vc.login()
+    content = si.RetrieveContent()
+    if fnmatch.fnmatch('get_properties', args.only):
+        props = ['name', 'runtime.powerState'] + pyvinga.counter_props[('vm', 'core')]
+        best, peak, calls, vm_props = measure(vc, lambda: pyvinga.get_properties(
+            content, [vim.VirtualMachine], props, vim.VirtualMachine), args.repeat)
+        report('get_properties', best, peak, calls)
+
+    file_perf_dic = os.path.join(work_dir, 'bench_perfdic.json')
+
+    def remove_perf_dictionary():
+        if os.path.exists(file_perf_dic):
+            os.remove(file_perf_dic)
+
+    if fnmatch.fnmatch('write_perf_dictionary', args.only):
+        best, peak, calls, perf_dict = measure(vc, lambda: pyvinga.write_perf_dictionary(content, file_perf_dic),
+                                               args.repeat, setup=remove_perf_dictionary)
+        report('write_perf_dictionary', best, peak, calls)
+        best, peak, calls, perf_dict = measure(vc, lambda: pyvinga.write_perf_dictionary(content, file_perf_dic),
+                                               args.repeat)
+        report('write_perf_dictionary (read)', best, peak, calls)
+
+
+def main():
+    args = GetArgs()
+    pyvinga.import_vsphere()
+    work_dir = tempfile.mkdtemp()
+    pyvinga.perf_dict_dir = pyvinga.index_dir = pyvinga.session_cache_dir = work_dir
+    pyvinga.sample_ring_dir = pyvinga.result_cache_dir = pyvinga.clock_dir = work_dir
+    try:
+        for num_vms in args.sizes:
+            bench(num_vms, args, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
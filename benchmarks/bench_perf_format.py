@@ -0,0 +1,66 @@
+"""
+Compares the normal and csv QueryPerf formats (pyvinga --perf-format) for large multi-entity queries.
+
+For each inventory size a single QueryPerf for every powered on Virtual Machine is sent through the fake
+vCenter in wire mode, so the response is really serialized to SOAP and parsed by pyVmomi.  The size of the
+response, the time pyVmomi spends parsing it and the client side time of build_query are reported.
+
+Usage: python3 benchmarks/bench_perf_format.py [number of VMs ...]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyVmomi import vim
+import pyvinga
+from fakevc import FakeVCenter
+
+counters = ['cpu.ready', 'mem.balloon', 'datastore.io', 'datastore.latency']
+
+
+def bench(num_vms, perf_dir):
+    vc = FakeVCenter(num_vms=num_vms, wire=True)
+    si = vc.login()
+    content = si.RetrieveContent()
+    vchtime = si.CurrentTime()
+    perf_dict = pyvinga.PerfDictionary(pyvinga.fetch_perf_counters(content, pyvinga.max_perf_level),
+                                       os.path.join(perf_dir, 'perfdic.json'), pyvinga.max_perf_level)
+    stub = content.perfManager._GetStub()
+    vm_counters = [metric for counter in counters for metric in pyvinga.vm_perf_counters[counter]]
+    queries = [(vim.VirtualMachine(moid, stub), vm_counters) for moid in vc.vms
+               if vc.objects[moid].props['runtime'].powerState == 'poweredOn']
+
+    results = {}
+    for perf_format in ('normal', 'csv'):
+        vc.response_bytes.clear()
+        vc.parse_time.clear()
+        vc.server_time.clear()
+        start = time.time()
+        results[perf_format] = pyvinga.build_query(content, vchtime, perf_dict, queries, chunk_size=0,
+                                                   workers=1, perf_format=perf_format)
+        wall = time.time() - start
+        print('{:>7} VMs {:>6}: {:>10.1f} KB response, {:>8.1f} ms SOAP parse, {:>8.1f} ms client total'.format(
+            num_vms, perf_format, vc.response_bytes.get('QueryPerf', 0) / 1024,
+            vc.parse_time.get('QueryPerf', 0) * 1000, (wall - vc.server_time.get('QueryPerf', 0)) * 1000))
+    if results['normal'] != results['csv']:
+        print('WARNING: normal and csv results differ (a sample may have rolled over between the queries)')
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 5000]
+    pyvinga.import_vsphere()
+    perf_dir = tempfile.mkdtemp()
+    try:
+        for num_vms in sizes:
+            bench(num_vms, perf_dir)
+    finally:
+        shutil.rmtree(perf_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Measures the cold start time of pyvinga, as paid by every check Icinga forks.
+
+Each scenario runs pyvinga.py in a new interpreter --repeat times and the median wall time is reported,
+together with the slowest imports of one run under python -X importtime and whether pyVmomi was imported.
+The scenarios cover the paths that should never import pyVmomi (invalid arguments, an unsupported entity
+type and a check answered from the result cache) and the import of everything a check connecting to vCenter
+needs.  The result cache entry is written by a check against the fake vCenter in fakevc.py beforehand and
+removed afterwards.
+
+With --budget the benchmark fails when a path that should not connect to vCenter takes longer than the
+given number of milliseconds, so the start up time can be tracked as a budget.
+
+Usage: python3 benchmarks/bench_startup.py [--repeat N] [--budget MS]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+
+import pyvinga
+from fakevc import FakeVCenter
+
+script = os.path.join(root, 'pyvinga.py')
+check_args = ['-s', 'bench-vcenter', '-u', 'pyvinga', '-p', 'secret', '-n', 'vm', '-e', 'VM00001',
+              '-r', 'cpu.ready', '-w', '5', '-c', '10', '--result-cache', '600']
+
+# Name, command line and whether the path has to stay clear of pyVmomi
+scenarios = [
+    ('interpreter', [sys.executable, '-c', 'pass'], True),
+    ('invalid arguments', [sys.executable, script], True),
+    ('unsupported entity type', [sys.executable, script, '-s', 'x', '-u', 'u', '-p', 'p', '-n', 'folder',
+                                 '-e', 'x', '-r', 'core'], True),
+    ('result cache hit', [sys.executable, script] + check_args, True),
+    ('result cache hit (-m)', [sys.executable, '-m', 'pyvinga'] + check_args, True),
+    ('import for a connection', [sys.executable, '-c', 'import pyvinga; pyvinga.import_vsphere()'], False),
+]
+
+
+def GetArgs():
+    """
+    Supports the command-line arguments listed below.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the start up time of pyvinga')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Number of runs of each scenario, the median is reported (default: 20)')
+    parser.add_argument('--budget', type=float,
+                        help='Fail if a scenario that does not connect to vCenter takes longer than this (ms)')
+    return parser.parse_args()
+
+
+def fill_result_cache(work_dir):
+    """
+    Runs the cached check once against the fake vCenter, so the following runs are answered from the cache
+
+    :return: The result cache files written
+    """
+    # Only the result cache has to be where pyvinga.py looks for it, the other files go to work_dir
+    pyvinga.perf_dict_dir = pyvinga.index_dir = pyvinga.session_cache_dir = work_dir
+    pyvinga.sample_ring_dir = pyvinga.clock_dir = work_dir
+    vc = FakeVCenter(num_vms=100)
+    pyvinga.import_vsphere()
+    pyvinga.SmartConnect = vc.SmartConnect
+    pyvinga.Disconnect = vc.Disconnect
+    sys.argv = ['pyvinga.py'] + check_args
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            pyvinga.main()
+        except SystemExit:
+            pass
+    args = pyvinga.GetArgs()
+    cache_file = pyvinga.get_result_cache_file(args, 'VM00001')
+    return [cache_file, cache_file + '.lock']
+
+
+def slowest_imports(command, count=4):
+    """
+    Runs the command once under -X importtime
+
+    :return: A tuple of the slowest top level imports as (cumulative microseconds, module) and whether pyVmomi
+    was imported
+    """
+    env = dict(os.environ, PYTHONPROFILEIMPORTTIME='1')
+    stderr = subprocess.run(command, cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True).stderr
+    imports = []
+    modules = set()
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and 'cumulative' not in line:
+            self_time, cumulative, module = line[len('import time:'):].split('|')
+            modules.add(module.strip())
+            # Only the modules imported at the top level, nested imports are part of their cumulative time
+            if not module.startswith('  '):
+                imports.append((int(cumulative), module.strip()))
+    pyvmomi = 'pyVmomi' in modules
+    return sorted(imports, reverse=True)[:count], pyvmomi
+
+
+def run_scenario(command, repeat):
+    """
+    Runs the command repeat times
+
+    :return: The median wall time in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.run(command, cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    return statistics.median(times)
+
+
+def main():
+    args = GetArgs()
+    work_dir = tempfile.mkdtemp()
+    cache_files = fill_result_cache(work_dir)
+    over_budget = []
+    try:
+        for name, command, light in scenarios:
+            wall = run_scenario(command, args.repeat)
+            imports, pyvmomi = slowest_imports(command)
+            print('{:<26} {:>8.1f} ms  pyVmomi {:<8} {}'.format(
+                name, wall * 1000, 'imported' if pyvmomi else 'no',
+                ', '.join('{} {:.1f} ms'.format(module, cumulative / 1000) for cumulative, module in imports)))
+            if light and pyvmomi:
+                over_budget.append('{} imported pyVmomi'.format(name))
+            if light and args.budget is not None and wall * 1000 > args.budget:
+                over_budget.append('{} took {:.1f} ms'.format(name, wall * 1000))
+    finally:
+        for cache_file in cache_files:
+            if os.path.exists(cache_file):
+                os.remove(cache_file)
+        shutil.rmtree(work_dir)
+    for problem in over_budget:
+        print('OVER BUDGET: ' + problem)
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
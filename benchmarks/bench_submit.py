@@ -0,0 +1,140 @@
+"""
+Measures the submission of passive check results to the Icinga 2 API (pyvinga --api-url) against the
+stand-in API in fakeicinga.py.
+
+First a scan of the fake vCenter in fakevc.py is submitted to the stand-in API and to a spool directory at
+the same time.  Every result received by the API is compared with the output of the same result in the
+spool file, as printed by an active check and split the way Icinga 2 splits the output of an active check.
+Then --results synthetic results are submitted with 1, 4 and 8 connections, with every request delayed by
+--latency milliseconds, and once more with every 7th request failing with 503 to exercise the retries.
+The results per second, the requests and the connections seen by the API are reported.
+
+Usage: python3 benchmarks/bench_submit.py [--latency MS] [--results N]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pyvinga
+from fakevc import FakeVCenter
+from fakeicinga import FakeIcinga
+
+scan_args = ['-s', 'vcenter', '-u', 'pyvinga', '-p', 'secret', '-n', 'vm', '-e', 'VM0000*',
+             '-r', 'core,cpu.ready,datastore.latency', '-w', '5', '-c', '10']
+
+
+def GetArgs():
+    """
+    Supports the command-line arguments listed below.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the Icinga 2 API submission of pyvinga')
+    parser.add_argument('--latency', type=float, default=1.0,
+                        help='Time the stand-in API takes to answer each request in milliseconds (default: 1)')
+    parser.add_argument('--results', type=int, default=2000,
+                        help='Number of synthetic results submitted for each run (default: 2000)')
+    return parser.parse_args()
+
+
+def run_main(argv):
+    """
+    Runs pyvinga.main() with the given arguments
+
+    :return: The output printed
+    """
+    sys.argv = ['pyvinga.py'] + argv
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            pyvinga.main()
+        except SystemExit:
+            pass
+    return output.getvalue()
+
+
+def compare_scan(work_dir):
+    """
+    Submits a scan to the stand-in API and to a spool directory at the same time, and compares each result
+    received by the API with the output in the external command of the same result
+
+    :return: The number of results that differ
+    """
+    vc = FakeVCenter(num_vms=100)
+    pyvinga.SmartConnect = vc.SmartConnect
+    pyvinga.Disconnect = vc.Disconnect
+    icinga = FakeIcinga()
+    spool_dir = os.path.join(work_dir, 'spool')
+    os.mkdir(spool_dir)
+    try:
+        print(run_main(scan_args + ['--api-url', icinga.url, '--api-user', 'pyvinga', '--api-password', 'secret',
+                                    '--spool-dir', spool_dir]).strip())
+        expected = {}
+        for name in os.listdir(spool_dir):
+            with open(os.path.join(spool_dir, name)) as spool_file:
+                for command in spool_file:
+                    host, service, state, output = command.rstrip('\n').split(';', 4)[1:]
+                    # The output of an active check would have real newlines where the command has escaped ones
+                    expected['{}!{}'.format(host, service)] = (int(state), pyvinga.split_check_output(
+                        output.replace('\\n', '\n')))
+        differ = 0
+        for result in icinga.results:
+            received = (result['exit_status'], (result['plugin_output'], result['performance_data']))
+            if received != expected.pop(result['service'], None):
+                differ += 1
+                print('DIFFERS: {}\n  received: {!r}'.format(result['service'], received))
+        differ += len(expected)
+        print('{} results received, {} differ from or are missing compared to the check output'.format(
+            len(icinga.results), differ))
+        return differ
+    finally:
+        icinga.close()
+
+
+def bench_throughput(args, connections, fail_every=0):
+    icinga = FakeIcinga(latency=args.latency / 1000, fail_every=fail_every)
+    try:
+        submitter = pyvinga.ApiSubmitter(icinga.url, 'pyvinga', 'secret', connections, retry_delay=0.01)
+        start = time.time()
+        for number in range(args.results):
+            submitter.submit({'type': 'Service', 'service': 'host{}!cpu.ready'.format(number), 'exit_status': 0,
+                              'plugin_output': 'OK - CPU Ready is 0.3%  ',
+                              'performance_data': ["'CPU Ready'=0.3%;5.0;10.0;0;100"]})
+        try:
+            submitted = submitter.close()
+        except IOError as e:
+            submitted = submitter.submitted
+            print('  ' + str(e))
+        wall = time.time() - start
+        print('  {:>2} connections{:<14} {:>8.0f} results/s  {:>6} accepted {:>6} requests {:>3} connections'.format(
+            connections, ', 1 in {} fail'.format(fail_every) if fail_every else '', submitted / wall, submitted,
+            icinga.requests, len(icinga.connections)))
+    finally:
+        icinga.close()
+
+
+def main():
+    args = GetArgs()
+    pyvinga.import_vsphere()
+    work_dir = tempfile.mkdtemp()
+    pyvinga.perf_dict_dir = pyvinga.index_dir = pyvinga.session_cache_dir = work_dir
+    pyvinga.sample_ring_dir = pyvinga.result_cache_dir = pyvinga.clock_dir = work_dir
+    try:
+        differ = compare_scan(work_dir)
+        print('{} results, {} ms latency'.format(args.results, args.latency))
+        for connections in (1, 4, 8):
+            bench_throughput(args, connections)
+        bench_throughput(args, 4, fail_every=7)
+    finally:
+        shutil.rmtree(work_dir)
+    return 1 if differ else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+A local stand-in for the Icinga 2 API used to exercise the passive result submission of pyvinga.
+
+Only POST /v1/actions/process-check-result is implemented.  Connections are kept alive as with the real
+API, every accepted result is recorded together with the connection it came in on, and the server can
+be made slow (latency), flaky (every Nth request answered with 503) or strict about the services it
+knows (anything else is answered with 404, as Icinga 2 does for an unknown object).
+"""
+
+import base64
+import json
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class FakeIcingaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are written separately, which stalls on delayed ACKs with Nagle's algorithm
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, results):
+        body = json.dumps({'results': results}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        icinga = self.server.icinga
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status, results = icinga.handle(self.path, self.headers.get('Authorization'), body,
+                                        self.client_address)
+        self.reply(status, results)
+
+
+class FakeIcingaServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeIcinga(object):
+    """
+    Runs the stand-in API on a free port of 127.0.0.1 in a background thread
+
+    :param user: The API user accepted by the server
+    :param password: The password of the API user
+    :param services: The 'host!service' names known to the server, or None to accept every service
+    :param latency: Seconds each request takes to answer
+    :param fail_every: Answer every Nth request with 503 Service Unavailable, 0 never fails
+    """
+    def __init__(self, user='pyvinga', password='secret', services=None, latency=0, fail_every=0):
+        self.auth = 'Basic ' + base64.b64encode('{}:{}'.format(user, password).encode('utf-8')).decode('ascii')
+        self.services = services
+        self.latency = latency
+        self.fail_every = fail_every
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.results = []
+        self.connections = set()
+        self.server = FakeIcingaServer(('127.0.0.1', 0), FakeIcingaHandler)
+        self.server.icinga = self
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle(self, path, auth, body, client_address):
+        """
+        Answers a single request
+
+        :return: A tuple of the HTTP status and the results list of the reply
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            self.connections.add(client_address)
+            if self.fail_every and self.requests % self.fail_every == 0:
+                return 503, [{'code': 503, 'status': 'Too busy.'}]
+        if auth != self.auth:
+            return 401, [{'code': 401, 'status': 'Unauthorized.'}]
+        if path != '/v1/actions/process-check-result':
+            return 404, [{'code': 404, 'status': 'No such action.'}]
+        result = json.loads(body.decode('utf-8'))
+        if self.services is not None and result.get('service') not in self.services:
+            return 404, [{'code': 404, 'status': "No objects found for service '{}'.".format(result.get('service'))}]
+        with self.lock:
+            self.results.append(result)
+        return 200, [{'code': 200, 'status': "Successfully processed check result for object '{}'.".format(
+            result['service'])}]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,613 @@
+"""
+A local stand-in for a vCenter Server used to exercise pyvinga without a live environment.
+
+The real pyVmomi type system is used for every managed and data object, only the stub adapter
+that would normally talk SOAP to vCenter is replaced.  Every method call and property access is
+counted and can be delayed by a simulated round trip latency.  With wire=True every response is
+also serialized to a SOAP envelope and deserialized again, recording the response size and the
+time pyVmomi spends parsing it.
+"""
+
+from datetime import datetime, timedelta, timezone
+import threading
+import time
+import uuid
+import zlib
+
+from pyVmomi import vim, vmodl, SoapAdapter, VmomiSupport
+
+
+# Size of a page returned by RetrievePropertiesEx when the client does not supply maxObjects
+default_page_size = 100
+
+
+def realtime_samples(start, end):
+    """
+    Returns the 20 second realtime sample timestamps between start (exclusive) and end (inclusive)
+    """
+    epoch = datetime(1970, 1, 1, tzinfo=end.tzinfo)
+    first = int((start - epoch).total_seconds()) // 20 * 20 + 20
+    last = int((end - epoch).total_seconds()) // 20 * 20
+    return [epoch + timedelta(seconds=ts) for ts in range(first, last + 1, 20)]
+
+
+class FakeObject(object):
+    """
+    Server side state for a single managed object
+    """
+    def __init__(self, moid, mo_type, props):
+        self.moid = moid
+        self.type = mo_type
+        self.props = props
+        self.children = []
+
+
+class FakeStub(object):
+    """
+    Replacement for pyVmomi's SoapStubAdapter.  Dispatches calls to a FakeVCenter.
+    """
+    def __init__(self, vc, cookie=None):
+        self.vc = vc
+        self.cookie = cookie
+        self.version = "vim.version.v7_0_3_0"
+
+    def InvokeMethod(self, mo, info, args):
+        return self.vc.invoke(self, mo, info, args)
+
+    def InvokeAccessor(self, mo, info):
+        return self.vc.access(self, mo, info)
+
+    def DropConnections(self):
+        pass
+
+
+class FakeVCenter(object):
+    """
+    A generated vCenter inventory with a PropertyCollector, ViewManager, SearchIndex and PerformanceManager
+    """
+    def __init__(self, num_vms=100, num_hosts=None, num_datastores=None, num_clusters=None, num_datacenters=1,
+                 latency=0.0, page_size=default_page_size, clock_skew=0, rollup_delay=10, wire=False):
+        self.latency = latency
+        self.wire = wire
+        self.response_bytes = {}
+        self.parse_time = {}
+        self.server_time = {}
+        self.rollup_delay = timedelta(seconds=rollup_delay)
+        self.page_size = page_size
+        self.clock_skew = timedelta(seconds=clock_skew)
+        self.lock = threading.RLock()
+        self.calls = {}
+        self.sessions = set()
+        self.objects = {}
+        self.views = {}
+        self.tokens = {}
+        self.filters = {}
+        self.collectors = {}
+        self.version = 0
+        self.changes = []
+        self.instance_uuid = str(uuid.uuid4())
+        self.perf_counters = self.build_perf_counters()
+        num_hosts = num_hosts or max(1, num_vms // 25)
+        num_datastores = num_datastores or max(1, num_vms // 50)
+        num_clusters = num_clusters or max(1, num_hosts // 8)
+        self.build_inventory(num_vms, num_hosts, num_datastores, num_clusters, num_datacenters)
+
+    # Inventory generation
+
+    def add(self, moid, mo_type, parent=None, **props):
+        obj = FakeObject(moid, mo_type, props)
+        self.objects[moid] = obj
+        if parent:
+            self.objects[parent].children.append(moid)
+            obj.props['parent'] = parent
+        return obj
+
+    def build_inventory(self, num_vms, num_hosts, num_datastores, num_clusters, num_datacenters):
+        self.add('ServiceInstance', vim.ServiceInstance)
+        self.add('group-d1', vim.Folder, name='Datacenters')
+        self.add('PropertyCollector', vim.PropertyCollector)
+        self.add('ViewManager', vim.view.ViewManager)
+        self.add('SearchIndex', vim.SearchIndex)
+        self.add('PerfMgr', vim.PerformanceManager, perfCounter=self.perf_counters)
+        self.add('SessionManager', vim.SessionManager)
+        self.hosts = []
+        self.vms = []
+        self.datastores = []
+        self.clusters = []
+        for dc_index in range(num_datacenters):
+            dc = 'datacenter-%d' % (dc_index + 1)
+            self.add(dc, vim.Datacenter, 'group-d1', name='DC%d' % (dc_index + 1), datastore=[])
+            self.add(dc + '-host', vim.Folder, dc, name='host')
+            self.add(dc + '-vm', vim.Folder, dc, name='vm')
+            self.add(dc + '-datastore', vim.Folder, dc, name='datastore')
+            self.objects[dc].props.update(hostFolder=dc + '-host', vmFolder=dc + '-vm',
+                                          datastoreFolder=dc + '-datastore')
+        dcs = ['datacenter-%d' % (i + 1) for i in range(num_datacenters)]
+        for index in range(num_datastores):
+            dc = dcs[index % len(dcs)]
+            moid = 'datastore-%d' % (index + 1)
+            capacity = 2 * 1024 ** 4
+            self.add(moid, vim.Datastore, dc + '-datastore', name='DS%03d' % (index + 1),
+                     overallStatus='green', vm=[],
+                     summary=vim.Datastore.Summary(name='DS%03d' % (index + 1), capacity=capacity,
+                                                   freeSpace=int(capacity * (0.2 + (index % 7) / 10.0)),
+                                                   type='VMFS', accessible=True))
+            self.objects[dc].props['datastore'].append(moid)
+            self.datastores.append(moid)
+        for index in range(num_clusters):
+            dc = dcs[index % len(dcs)]
+            moid = 'domain-c%d' % (index + 1)
+            self.add(moid, vim.ClusterComputeResource, dc + '-host', name='CL%02d' % (index + 1),
+                     overallStatus='yellow' if index % 5 == 4 else 'green', host=[])
+            self.clusters.append(moid)
+        for index in range(num_hosts):
+            moid = 'host-%d' % (index + 1)
+            name = 'esx%03d.lab.local' % (index + 1)
+            if self.clusters and index % 10 != 9:
+                parent = self.clusters[index % len(self.clusters)]
+                self.objects[parent].props['host'].append(moid)
+            else:
+                dc = dcs[index % len(dcs)]
+                parent = 'domain-s%d' % (index + 1)
+                self.add(parent, vim.ComputeResource, dc + '-host', name=name, host=[moid])
+            self.add(moid, vim.HostSystem, parent, name=name, overallStatus='green', vm=[],
+                     summary=vim.host.Summary(
+                         hardware=vim.host.Summary.HardwareSummary(model='PowerEdge R640', cpuModel='Xeon Gold 6130',
+                                                                   cpuMhz=2100, numCpuPkgs=2, numCpuCores=32,
+                                                                   numCpuThreads=64, memorySize=512 * 1024 ** 3),
+                         quickStats=vim.host.Summary.QuickStats(overallCpuUsage=10000 + index * 37 % 40000,
+                                                                overallMemoryUsage=100000 + index * 91 % 300000)),
+                     config=vim.host.ConfigInfo(product=vim.AboutInfo(fullName='VMware ESXi 7.0.3 build-20328353')))
+            self.hosts.append(moid)
+        for index in range(num_vms):
+            moid = 'vm-%d' % (index + 1)
+            name = 'VM%05d' % (index + 1)
+            host = self.hosts[index % len(self.hosts)]
+            dc = self.dc_of(host)
+            power = 'poweredOff' if index % 20 == 19 else 'poweredOn'
+            datastores = [self.datastores[index % len(self.datastores)]]
+            if index % 3 == 0 and len(self.datastores) > 1:
+                datastores.append(self.datastores[(index + 1) % len(self.datastores)])
+            runtime = vim.vm.RuntimeInfo(powerState=power, host=vim.HostSystem(host))
+            self.add(moid, vim.VirtualMachine, dc + '-vm', name=name, overallStatus='green',
+                     datastore=datastores,
+                     runtime=runtime,
+                     guest=vim.vm.GuestInfo(hostName=name.lower() + '.lab.local'),
+                     summary=vim.vm.Summary(
+                         runtime=runtime,
+                         config=vim.vm.Summary.ConfigSummary(name=name, memorySizeMB=4096, numCpu=2,
+                                                             annotation='Test Virtual Machine',
+                                                             guestFullName='Ubuntu Linux (64-bit)'),
+                         quickStats=vim.vm.Summary.QuickStats(overallCpuUsage=100 + index % 900,
+                                                              guestMemoryUsage=512 + index % 2048,
+                                                              balloonedMemory=0)))
+            self.objects[host].props['vm'].append(moid)
+            for ds in datastores:
+                self.objects[ds].props['vm'].append(moid)
+            self.vms.append(moid)
+
+    def dc_of(self, moid):
+        obj = self.objects[moid]
+        while obj.type is not vim.Datacenter:
+            obj = self.objects[obj.props['parent']]
+        return obj.moid
+
+    def build_perf_counters(self):
+        counters = []
+        names = [('cpu', 'ready', 'summation', 1), ('cpu', 'usage', 'average', 1), ('mem', 'active', 'average', 1),
+                 ('mem', 'shared', 'average', 1), ('mem', 'vmmemctl', 'average', 1),
+                 ('datastore', 'numberReadAveraged', 'average', 1), ('datastore', 'numberWriteAveraged', 'average', 1),
+                 ('datastore', 'totalReadLatency', 'average', 1), ('datastore', 'totalWriteLatency', 'average', 1),
+                 ('net', 'received', 'average', 2), ('net', 'transmitted', 'average', 2)]
+        # Pad the list out to the size of a real vCenter perfCounter list
+        for index in range(len(names), 600):
+            names.append(('group%d' % (index % 30), 'counter%d' % index, 'average', index % 4 + 1))
+        for key, (group, name, rollup, level) in enumerate(names, 1):
+            counters.append(vim.PerformanceManager.CounterInfo(
+                key=key, level=level, rollupType=rollup, statsType='rate',
+                nameInfo=vim.ElementDescription(key=name, label=name.capitalize(),
+                                                summary='Long localized description of the ' + name + ' counter'),
+                groupInfo=vim.ElementDescription(key=group, label=group.capitalize(),
+                                                 summary='Long localized description of the ' + group + ' group'),
+                unitInfo=vim.ElementDescription(key='number', label='Num', summary='Number')))
+        return counters
+
+    # Stub dispatch
+
+    def mo(self, stub, moid):
+        return self.objects[moid].type(moid, stub)
+
+    def wrap(self, stub, value):
+        """
+        Turns server side moids held in a property into managed objects bound to the calling stub
+        """
+        if isinstance(value, list):
+            items = [self.wrap(stub, item) for item in value]
+            # Property values have to be typed arrays, as they are when deserialized from a real response
+            if items and isinstance(items[0], VmomiSupport.ManagedObject):
+                return type(items[0]).Array(items)
+            return items
+        if isinstance(value, str) and value in self.objects:
+            return self.mo(stub, value)
+        return value
+
+    def count(self, name, stub, check_session=True):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if check_session and stub.cookie not in self.sessions:
+            raise vim.fault.NotAuthenticated()
+
+    def access(self, stub, mo, info):
+        self.count(info.name, stub, check_session=info.name != 'currentSession')
+        moid = mo._moId
+        if info.name == 'currentSession':
+            if stub.cookie in self.sessions:
+                return vim.UserSession(key=stub.cookie, userName='pyvinga')
+            return None
+        return self.wrap(stub, self.get_path(moid, info.name))
+
+    def get_path(self, moid, prop_path):
+        parts = prop_path.split('.')
+        value = self.objects[moid].props.get(parts[0])
+        for part in parts[1:]:
+            if value is None:
+                return None
+            value = getattr(value, part)
+        return value
+
+    def invoke(self, stub, mo, info, args):
+        self.count(info.wsdlName, stub, check_session=info.wsdlName not in ('RetrieveServiceContent', 'CurrentTime'))
+        params = dict((param.name, arg) for param, arg in zip(info.params, args))
+        handler = getattr(self, 'do_' + info.wsdlName)
+        start = time.time()
+        result = handler(stub, mo, **params)
+        if self.wire and result is not None:
+            result = self.transfer(stub, info, result)
+        with self.lock:
+            self.server_time[info.wsdlName] = self.server_time.get(info.wsdlName, 0) + time.time() - start
+        return result
+
+    def transfer(self, stub, info, result):
+        """
+        Sends a response through the pyVmomi SOAP serializer and deserializer, as a real connection would
+        """
+        ns_map = {'xsi': SoapAdapter.XMLNS_XSI, 'xsd': SoapAdapter.XMLNS_XSD}
+        body = SoapAdapter.Serialize(result, VmomiSupport.Object(name='returnval', type=info.result,
+                                                                 version=info.version, flags=0),
+                                     info.version, nsMap=ns_map)
+        # Everything up to here is the server side, the deserialization below is what the client pays for
+        envelope = (b'<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+                    b'xmlns:xsd="http://www.w3.org/2001/XMLSchema" '
+                    b'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"><soapenv:Body>'
+                    b'<' + info.wsdlName.encode('ascii') + b'Response xmlns="urn:vim25">' + body +
+                    b'</' + info.wsdlName.encode('ascii') + b'Response></soapenv:Body></soapenv:Envelope>')
+        start = time.time()
+        result = SoapAdapter.SoapResponseDeserializer(stub).Deserialize(envelope, info.result)
+        with self.lock:
+            self.server_time[info.wsdlName] = self.server_time.get(info.wsdlName, 0) - (time.time() - start)
+            self.response_bytes[info.wsdlName] = self.response_bytes.get(info.wsdlName, 0) + len(envelope)
+            self.parse_time[info.wsdlName] = self.parse_time.get(info.wsdlName, 0) + time.time() - start
+        return result
+
+    # Session handling
+
+    def login(self):
+        cookie = 'vmware_soap_session="%s"' % uuid.uuid4()
+        self.sessions.add(cookie)
+        return vim.ServiceInstance('ServiceInstance', FakeStub(self, cookie))
+
+    def SmartConnect(self, **kwargs):
+        self.count('Login', FakeStub(self), check_session=False)
+        return self.login()
+
+    def SoapStubAdapter(self, *args, **kwargs):
+        return FakeStub(self)
+
+    def Disconnect(self, si):
+        try:
+            si.RetrieveContent().sessionManager.Logout()
+        except vim.fault.NotAuthenticated:
+            pass
+
+    def do_Logout(self, stub, mo):
+        self.sessions.discard(stub.cookie)
+
+    # ServiceInstance
+
+    def do_RetrieveServiceContent(self, stub, mo):
+        return vim.ServiceInstanceContent(
+            rootFolder=self.mo(stub, 'group-d1'), propertyCollector=self.mo(stub, 'PropertyCollector'),
+            viewManager=self.mo(stub, 'ViewManager'), searchIndex=self.mo(stub, 'SearchIndex'),
+            perfManager=self.mo(stub, 'PerfMgr'), sessionManager=self.mo(stub, 'SessionManager'),
+            about=vim.AboutInfo(name='VMware vCenter Server', fullName='VMware vCenter Server 7.0.3',
+                                apiVersion='7.0.3.0', instanceUuid=self.instance_uuid))
+
+    def do_CurrentTime(self, stub, mo):
+        return datetime.now(timezone.utc) + self.clock_skew
+
+    # ViewManager and ContainerView
+
+    def members(self, moid, types, recursive):
+        found = []
+        for child in self.objects[moid].children:
+            obj = self.objects[child]
+            if any(issubclass(obj.type, view_type) for view_type in types):
+                found.append(child)
+            if recursive:
+                found.extend(self.members(child, types, recursive))
+        return found
+
+    def do_CreateContainerView(self, stub, mo, container, type, recursive):
+        types = [getattr(vim, t.split('.')[-1]) if isinstance(t, str) else t for t in type]
+        with self.lock:
+            moid = 'session[%s]view-%d' % (id(self), len(self.views) + 1)
+            self.views[moid] = self.members(container._moId, types, recursive)
+            self.objects[moid] = FakeObject(moid, vim.view.ContainerView, {'view': self.views[moid]})
+        return vim.view.ContainerView(moid, stub)
+
+    def do_DestroyView(self, stub, mo):
+        with self.lock:
+            self.views.pop(mo._moId, None)
+            self.objects.pop(mo._moId, None)
+
+    def do_DestroyPropertyFilter(self, stub, mo):
+        with self.lock:
+            self.filters.pop(mo._moId, None)
+            self.objects.pop(mo._moId, None)
+
+    # PropertyCollector
+
+    def select(self, moid, select_set, specs_by_name, found):
+        obj = self.objects[moid]
+        for spec in select_set or []:
+            if not isinstance(spec, vmodl.query.PropertyCollector.TraversalSpec):
+                spec = specs_by_name[spec.name]
+            if not issubclass(obj.type, spec.type):
+                continue
+            targets = obj.props.get(spec.path)
+            if targets is None:
+                continue
+            if not isinstance(targets, list):
+                targets = [targets]
+            for target in targets:
+                if not spec.skip and target not in found:
+                    found.append(target)
+                self.select(target, spec.selectSet, specs_by_name, found)
+
+    def collect(self, spec):
+        specs_by_name = {}
+        for obj_spec in spec.objectSet:
+            for select in obj_spec.selectSet or []:
+                if select.name:
+                    specs_by_name[select.name] = select
+                    for nested in getattr(select, 'selectSet', None) or []:
+                        if isinstance(nested, vmodl.query.PropertyCollector.TraversalSpec) and nested.name:
+                            specs_by_name[nested.name] = nested
+        found = []
+        for obj_spec in spec.objectSet:
+            moid = obj_spec.obj._moId
+            if moid not in self.objects:
+                raise vmodl.fault.ManagedObjectNotFound(obj=obj_spec.obj)
+            if not obj_spec.skip:
+                found.append(moid)
+            self.select(moid, obj_spec.selectSet, specs_by_name, found)
+        return found
+
+    def object_content(self, stub, moid, prop_specs):
+        obj = self.objects[moid]
+        prop_set = []
+        matched = False
+        for prop_spec in prop_specs:
+            if issubclass(obj.type, prop_spec.type):
+                matched = True
+                for name in prop_spec.pathSet or []:
+                    value = self.get_path(moid, name)
+                    if value is not None:
+                        prop_set.append(vmodl.DynamicProperty(name=name, val=self.wrap(stub, value)))
+        if not matched:
+            return None
+        return vmodl.query.PropertyCollector.ObjectContent(obj=self.mo(stub, moid), propSet=prop_set)
+
+    def do_RetrievePropertiesEx(self, stub, mo, specSet, options):
+        contents = []
+        for spec in specSet:
+            for moid in self.collect(spec):
+                content = self.object_content(stub, moid, spec.propSet)
+                if content is not None:
+                    contents.append(content)
+        page_size = (options and options.maxObjects) or self.page_size
+        return self.page(stub, contents, page_size)
+
+    def page(self, stub, contents, page_size):
+        result = vmodl.query.PropertyCollector.RetrieveResult(objects=contents[:page_size])
+        if len(contents) > page_size:
+            with self.lock:
+                token = str(uuid.uuid4())
+                self.tokens[token] = (contents[page_size:], page_size)
+            result.token = token
+        return result
+
+    def do_ContinueRetrievePropertiesEx(self, stub, mo, token):
+        with self.lock:
+            contents, page_size = self.tokens.pop(token)
+        return self.page(stub, contents, page_size)
+
+    def do_CancelRetrievePropertiesEx(self, stub, mo, token):
+        with self.lock:
+            self.tokens.pop(token, None)
+
+    def do_CreatePropertyCollector(self, stub, mo):
+        with self.lock:
+            moid = 'session[%s]collector-%d' % (id(self), len(self.collectors) + 1)
+            self.collectors[moid] = {'cancelled': False}
+            self.objects[moid] = FakeObject(moid, vim.PropertyCollector, {})
+        return vmodl.query.PropertyCollector(moid, stub)
+
+    def do_DestroyPropertyCollector(self, stub, mo):
+        with self.lock:
+            self.collectors.pop(mo._moId, None)
+            self.objects.pop(mo._moId, None)
+            for moid in [moid for moid, state in self.filters.items() if state['collector'] == mo._moId]:
+                self.filters.pop(moid)
+
+    def do_CreateFilter(self, stub, mo, spec, partialUpdates):
+        with self.lock:
+            moid = 'session[%s]filter-%d' % (id(self), len(self.filters) + 1)
+            self.filters[moid] = {'spec': spec, 'collector': mo._moId}
+            self.objects[moid] = FakeObject(moid, vmodl.query.PropertyCollector.Filter, {})
+        return vmodl.query.PropertyCollector.Filter(moid, stub)
+
+    def do_WaitForUpdatesEx(self, stub, mo, version, options):
+        deadline = time.time() + ((options and options.maxWaitSeconds) or 0)
+        while True:
+            with self.lock:
+                collector = self.collectors.get(mo._moId)
+                if collector and collector['cancelled']:
+                    collector['cancelled'] = False
+                    raise vmodl.fault.RequestCanceled()
+                update_set = self.pending_updates(stub, mo._moId, version)
+            if update_set is not None or time.time() >= deadline:
+                return update_set
+            time.sleep(0.05)
+
+    def pending_updates(self, stub, collector, version):
+        filter_updates = []
+        for moid, filter_state in self.filters.items():
+            if filter_state['collector'] != collector:
+                continue
+            spec = filter_state['spec']
+            if not version:
+                object_updates = []
+                for member in self.collect(spec):
+                    content = self.object_content(stub, member, spec.propSet)
+                    if content is None:
+                        continue
+                    changes = [vmodl.query.PropertyCollector.Change(name=prop.name, op='assign', val=prop.val)
+                               for prop in content.propSet]
+                    object_updates.append(vmodl.query.PropertyCollector.ObjectUpdate(
+                        kind='enter', obj=content.obj, changeSet=changes))
+            else:
+                members = set(self.collect(spec))
+                object_updates = []
+                for change_version, member, name, value in self.changes:
+                    if change_version <= int(version) or member not in members:
+                        continue
+                    content = self.object_content(stub, member, spec.propSet)
+                    if content is None:
+                        continue
+                    # A change below a tracked property is reported as a change of the tracked property
+                    changes = [vmodl.query.PropertyCollector.Change(name=prop.name, op='assign', val=prop.val)
+                               for prop in content.propSet
+                               if name == prop.name or name.startswith(prop.name + '.')]
+                    if changes:
+                        object_updates.append(vmodl.query.PropertyCollector.ObjectUpdate(
+                            kind='modify', obj=self.mo(stub, member), changeSet=changes))
+            if object_updates:
+                filter_updates.append(vmodl.query.PropertyCollector.FilterUpdate(
+                    filter=vmodl.query.PropertyCollector.Filter(moid, stub), objectSet=object_updates))
+        if not filter_updates:
+            return None
+        return vmodl.query.PropertyCollector.UpdateSet(version=str(self.version), filterSet=filter_updates)
+
+    def do_CancelWaitForUpdates(self, stub, mo):
+        with self.lock:
+            if mo._moId in self.collectors:
+                self.collectors[mo._moId]['cancelled'] = True
+
+    def set_property(self, moid, name, value):
+        """
+        Changes a property on the server side and records it for WaitForUpdatesEx
+        """
+        with self.lock:
+            props = self.objects[moid].props
+            parts = name.split('.')
+            if len(parts) == 1:
+                props[name] = value
+            else:
+                target = props[parts[0]]
+                for part in parts[1:-1]:
+                    target = getattr(target, part)
+                setattr(target, parts[-1], value)
+            self.version += 1
+            self.changes.append((self.version, moid, name, value))
+
+    # SearchIndex
+
+    def do_FindByDnsName(self, stub, mo, datacenter, dnsName, vmSearch):
+        for moid in (self.vms if vmSearch else self.hosts):
+            obj = self.objects[moid]
+            name = obj.props['guest'].hostName if vmSearch else obj.props['name']
+            if name == dnsName:
+                return self.mo(stub, moid)
+        return None
+
+    def do_FindByInventoryPath(self, stub, mo, inventoryPath):
+        moid = 'group-d1'
+        for part in inventoryPath.strip('/').split('/'):
+            for child in self.objects[moid].children:
+                if self.objects[child].props.get('name') == part:
+                    moid = child
+                    break
+            else:
+                return None
+        return self.mo(stub, moid)
+
+    # PerformanceManager
+
+    def do_QueryPerfCounterByLevel(self, stub, mo, level):
+        return [counter for counter in self.perf_counters if counter.level <= level]
+
+    def do_QueryPerfCounter(self, stub, mo, counterId):
+        return [counter for counter in self.perf_counters if counter.key in counterId]
+
+    def instances(self, moid, counter):
+        group = counter.groupInfo.key
+        if group == 'datastore':
+            return [self.objects[ds].props['summary'].name + '-uuid' for ds in self.objects[moid].props['datastore']]
+        if group == 'net':
+            # Every other Virtual Machine has a second vNIC
+            return ['', '4000', '4001'] if int(moid.split('-')[1]) % 2 else ['', '4000']
+        return ['']
+
+    def sample_value(self, moid, counter_id, instance, timestamp):
+        seed = '{}/{}/{}/{}'.format(moid, counter_id, instance, int(time.mktime(timestamp.timetuple())) // 20)
+        return zlib.crc32(seed.encode('utf-8')) % 1000
+
+    def do_QueryPerf(self, stub, mo, querySpec):
+        counters = dict((counter.key, counter) for counter in self.perf_counters)
+        results = []
+        for spec in querySpec:
+            moid = spec.entity._moId
+            end = spec.endTime or self.do_CurrentTime(stub, mo)
+            start = spec.startTime or end - timedelta(seconds=20 * (spec.maxSample or 1))
+            # Samples only become available once they have been rolled up
+            now = self.do_CurrentTime(stub, mo)
+            timestamps = [ts for ts in realtime_samples(start, end) if ts <= now - self.rollup_delay]
+            if spec.maxSample:
+                timestamps = timestamps[-spec.maxSample:]
+            if not timestamps:
+                continue
+            series = []
+            for metric in spec.metricId:
+                counter = counters[metric.counterId]
+                for instance in self.instances(moid, counter):
+                    if metric.instance != '*' and metric.instance != instance:
+                        continue
+                    values = [self.sample_value(moid, metric.counterId, instance, ts) for ts in timestamps]
+                    metric_id = vim.PerformanceManager.MetricId(counterId=metric.counterId, instance=instance)
+                    if spec.format == 'csv':
+                        series.append(vim.PerformanceManager.MetricSeriesCSV(
+                            id=metric_id, value=','.join(str(value) for value in values)))
+                    else:
+                        series.append(vim.PerformanceManager.IntSeries(id=metric_id, value=values))
+            if spec.format == 'csv':
+                sample_info = ','.join('20,' + ts.strftime('%Y-%m-%dT%H:%M:%SZ') for ts in timestamps)
+                results.append(vim.PerformanceManager.EntityMetricCSV(
+                    entity=spec.entity, sampleInfoCSV=sample_info, value=series))
+            else:
+                results.append(vim.PerformanceManager.EntityMetric(
+                    entity=spec.entity, value=series,
+                    sampleInfo=[vim.PerformanceManager.SampleInfo(timestamp=ts, interval=20) for ts in timestamps]))
+        return results
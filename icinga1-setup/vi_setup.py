@@ -9,6 +9,7 @@ from __future__ import print_function
 import argparse
 import atexit
 import getpass
+import os
 
 from pyVim.connect import SmartConnect, Disconnect
 from pyVmomi import vmodl, vim
@@ -18,6 +19,8 @@ from pyVmomi import vmodl, vim
 vi_var_file = '/etc/icinga/objects/vi_commands.cfg'
 # Domain name of your ESXi hosts - only used when querying individual ESXi hosts
 domain_name = '.homelab.local'
+# Size of the write buffer of each configuration file
+config_buffer_size = 1024 * 1024
 
 
 def GetArgs():
@@ -45,13 +48,27 @@ def get_properties(content, viewType, props, specType):
     :param specType: Type of Managed Object Reference that should be used for the Property Specification
     :return:
     """
+    return get_view_properties(content, viewType, [(specType, props)])
+
+
+def get_view_properties(content, viewType, typeProps):
+    """
+    Obtains the properties of several Managed Object types from a single View with one PropertyCollector
+    traversal.
+
+    :param content: ServiceInstance Managed Object
+    :param viewType: Types of Managed Object Reference that should populate the View
+    :param typeProps: A list of (Managed Object type, list of properties) tuples, one Property Specification each
+    :return: A list of dictionaries of the properties of each object, with its Managed Object Reference as 'moref'
+    """
     # Get the View based on the viewType
     objView = content.viewManager.CreateContainerView(content.rootFolder, viewType, True)
     # Build the Filter Specification
     tSpec = vim.PropertyCollector.TraversalSpec(name='tSpecName', path='view', skip=False, type=vim.view.ContainerView)
-    pSpec = vim.PropertyCollector.PropertySpec(all=False, pathSet=props, type=specType)
+    pSpecs = [vim.PropertyCollector.PropertySpec(all=False, pathSet=props, type=specType)
+              for specType, props in typeProps]
     oSpec = vim.PropertyCollector.ObjectSpec(obj=objView, selectSet=[tSpec], skip=False)
-    pfSpec = vim.PropertyCollector.FilterSpec(objectSet=[oSpec], propSet=[pSpec], reportMissingObjectsInResults=False)
+    pfSpec = vim.PropertyCollector.FilterSpec(objectSet=[oSpec], propSet=pSpecs, reportMissingObjectsInResults=False)
     retOptions = vim.PropertyCollector.RetrieveOptions()
     # Retrieve the properties and look for a token coming back with each RetrievePropertiesEx call
     # If the token is present it indicates there are more items to be returned.
@@ -73,6 +90,55 @@ def get_properties(content, viewType, props, specType):
     return gpOutput
 
 
+class ConfigWriter(object):
+    """
+    Keeps one buffered handle open for each configuration file written during the run.
+
+    Each file is written to a temporary file next to it (not picked up by Icinga, which only reads *.cfg files)
+    and only replaces the file in commit(), so Icinga never reads a half-written configuration.
+    """
+    def __init__(self, buffer_size=config_buffer_size):
+        self.buffer_size = buffer_size
+        self.files = {}
+
+    def write(self, file_name, lines):
+        """
+        Adds an object definition to a configuration file
+
+        :param file_name: The configuration file to write to
+        :param lines: The lines of the object definition, including the line endings
+        """
+        f = self.files.get(file_name)
+        if f is None:
+            f = open(file_name + '.tmp', 'w', self.buffer_size)
+            self.files[file_name] = f
+        f.writelines(lines)
+
+    def commit(self):
+        """
+        Replaces every configuration file written with its temporary file
+        """
+        for file_name, f in self.files.items():
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.rename(file_name + '.tmp', file_name)
+        self.files = {}
+
+    def discard(self):
+        """
+        Removes the temporary files, leaving the configuration files as they were
+        """
+        for file_name, f in self.files.items():
+            f.close()
+            os.remove(file_name + '.tmp')
+        self.files = {}
+
+
+# The writer used for every configuration file of the run
+config_writer = ConfigWriter()
+
+
 def create_commands():
     """
     Create the file that will store the command definition to for check_pyvi.
@@ -80,14 +146,12 @@ def create_commands():
     Ensure $USER3$ and $USER4$ are configured.  If multiple sets of credentials are stored then
     multiple commands would need to be entered into this file.
     """
-    f = open(vi_var_file, 'w')
-    f.write('#\'check_pyvi\' command definition\n')
-    f.write('define command {\n')
-    f.write('\tcommand_name\tcheck_pyvi\n')
-    f.write(
-        '\tcommand_line\t/opt/pyvinga/pyvinga.py -s $ARG1$ -u $USER3$ -p $USER4$ -n $ARG2$ -e \'$HOSTNAME$\' -r $ARG3$ -w $ARG4$ -c $ARG5$\n')
-    f.write('\t}\n\n')
-    f.close()
+    config_writer.write(vi_var_file, [
+        '#\'check_pyvi\' command definition\n',
+        'define command {\n',
+        '\tcommand_name\tcheck_pyvi\n',
+        '\tcommand_line\t/opt/pyvinga/pyvinga.py -s $ARG1$ -u $USER3$ -p $USER4$ -n $ARG2$ -e \'$HOSTNAME$\' -r $ARG3$ -w $ARG4$ -c $ARG5$\n',
+        '\t}\n\n'])
 
 
 def create_esxi_config(entity, vmProps, dsProps):
@@ -143,14 +207,13 @@ def create_esxi_hostgroup(hostgroup_type, entity, norm_entity, h_description):
     vi_entity_file = '/etc/icinga/objects/vi_' + norm_entity + '_config.cfg'
     hostgroup_name = norm_entity + '-' + hostgroup_type
 
-    f = open(vi_entity_file, 'a')
-    f.write('#' + h_description + ' in hostgroup for this entity\n')
-    f.write('#@' + entity + hostgroup_type + '\n')
-    f.write('define hostgroup {\n')
-    f.write('\thostgroup_name\t\t' + hostgroup_name + '\n')
-    f.write('\talias\t\t\t' + norm_entity + ' ' + h_description + '\n')
-    f.write('\t}\n\n')
-    f.close()
+    config_writer.write(vi_entity_file, [
+        '#' + h_description + ' in hostgroup for this entity\n',
+        '#@' + entity + hostgroup_type + '\n',
+        'define hostgroup {\n',
+        '\thostgroup_name\t\t' + hostgroup_name + '\n',
+        '\talias\t\t\t' + norm_entity + ' ' + h_description + '\n',
+        '\t}\n\n'])
 
     return hostgroup_name
 
@@ -173,18 +236,17 @@ def create_esxi_service(hostgroup_type, entity, norm_entity, service_template, s
     vi_entity_file = '/etc/icinga/objects/vi_' + norm_entity + '_config.cfg'
     hostgroup_name = norm_entity + '-' + hostgroup_type
 
-    f = open(vi_entity_file, 'a')
-    f.write('#Service ' + s_description + ' for Virtual Machines\n')
-    f.write('define service {\n')
-    f.write('\tuse\t\t\t + service_template + \n')
+    lines = ['#Service ' + s_description + ' for Virtual Machines\n',
+             'define service {\n',
+             '\tuse\t\t\t + service_template + \n']
     if group:
-        f.write('\thostgroup_name\t\t' + hostgroup_name + '\n')
+        lines.append('\thostgroup_name\t\t' + hostgroup_name + '\n')
     else:
-        f.write('\thost_name\t\t' + norm_entity + '\n')
-    f.write('\tservice_description\t' + s_description + '\n')
-    f.write('\tcheck_command\t\tcheck_pyvi!' + entity + '!' + counter_type + '!' + counter + '!' + str(warning) + '!' + str(critical) + '\n')
-    f.write('\t}\n\n')
-    f.close()
+        lines.append('\thost_name\t\t' + norm_entity + '\n')
+    lines.append('\tservice_description\t' + s_description + '\n')
+    lines.append('\tcheck_command\t\tcheck_pyvi!' + entity + '!' + counter_type + '!' + counter + '!' + str(warning) + '!' + str(critical) + '\n')
+    lines.append('\t}\n\n')
+    config_writer.write(vi_entity_file, lines)
 
 
 def create_esxi_host(entity):
@@ -196,15 +258,14 @@ def create_esxi_host(entity):
     norm_entity = entity.split('.')[0]
     vi_entity_file = '/etc/icinga/objects/vi_' + norm_entity + '_hosts.cfg'
 
-    f = open(vi_entity_file, 'a')
-    f.write('#Host ' + norm_entity + '\n')
-    f.write('define host {\n')
-    f.write('\tuse\t\t\tgeneric-host\n')
-    f.write('\thost_name\t\t' + entity + '\n')
-    f.write('\talias\t\t\t' + norm_entity + '\n')
-    f.write('\taddress\t\t\t' + entity + '\n')
-    f.write('\t}\n\n')
-    f.close()
+    config_writer.write(vi_entity_file, [
+        '#Host ' + norm_entity + '\n',
+        'define host {\n',
+        '\tuse\t\t\tgeneric-host\n',
+        '\thost_name\t\t' + entity + '\n',
+        '\talias\t\t\t' + norm_entity + '\n',
+        '\taddress\t\t\t' + entity + '\n',
+        '\t}\n\n'])
 
 
 def create_esxi_vm(hostgroup_type, hostgroup_name, entity, host_name, warning, critical):
@@ -221,18 +282,17 @@ def create_esxi_vm(hostgroup_type, hostgroup_name, entity, host_name, warning, c
     norm_entity = entity.split('.')[0]
     vi_entity_file = '/etc/icinga/objects/vi_' + norm_entity + '_hosts.cfg'
 
-    f = open(vi_entity_file, 'a')
-    f.write('#Stand Alone Host ' + norm_entity + '\n')
-    f.write('define host {\n')
-    f.write('\tuse\t\t\tgeneric-host\n')
-    f.write('\thost_name\t\t' + host_name + '\n')
-    f.write('\talias\t\t\t' + host_name + '\n')
-    f.write('\taddress\t\t\t' + host_name + domain_name + '\n')
-    f.write('\tparents\t\t\t' + norm_entity + '\n')
-    f.write('\thostgroups\t\t' + hostgroup_name + '\n')
-    f.write('\tcheck_command\t\tcheck_pyvi!' + entity + '!vm!status!' + str(warning) + '!' + str(critical) + '!' + '\n')
-    f.write('\t}\n\n')
-    f.close()
+    config_writer.write(vi_entity_file, [
+        '#Stand Alone Host ' + norm_entity + '\n',
+        'define host {\n',
+        '\tuse\t\t\tgeneric-host\n',
+        '\thost_name\t\t' + host_name + '\n',
+        '\talias\t\t\t' + host_name + '\n',
+        '\taddress\t\t\t' + host_name + domain_name + '\n',
+        '\tparents\t\t\t' + norm_entity + '\n',
+        '\thostgroups\t\t' + hostgroup_name + '\n',
+        '\tcheck_command\t\tcheck_pyvi!' + entity + '!vm!status!' + str(warning) + '!' + str(critical) + '!' + '\n',
+        '\t}\n\n'])
 
 
 def create_esxi_ds(hostgroup_type, hostgroup_name, entity, host_name, warning, critical):
@@ -249,17 +309,16 @@ def create_esxi_ds(hostgroup_type, hostgroup_name, entity, host_name, warning, c
     norm_entity = entity.split('.')[0]
     vi_entity_file = '/etc/icinga/objects/vi_' + norm_entity + '_hosts.cfg'
 
-    f = open(vi_entity_file, 'a')
-    f.write('#Host ' + norm_entity + '\n')
-    f.write('define host {\n')
-    f.write('\tuse\t\t\tgeneric-host\n')
-    f.write('\thost_name\t\t' + host_name + '\n')
-    f.write('\talias\t\t\t' + host_name + ' Datastore\n')
-    f.write('\tparents\t\t\t' + norm_entity + '\n')
-    f.write('\thostgroups\t\t' + hostgroup_name + '\n')
-    f.write('\tcheck_command\t\tcheck_pyvi!' + entity + '!datastore!status!' + str(warning) + '!' + str(critical) + '!' + '\n')
-    f.write('\t}\n\n')
-    f.close()
+    config_writer.write(vi_entity_file, [
+        '#Host ' + norm_entity + '\n',
+        'define host {\n',
+        '\tuse\t\t\tgeneric-host\n',
+        '\thost_name\t\t' + host_name + '\n',
+        '\talias\t\t\t' + host_name + ' Datastore\n',
+        '\tparents\t\t\t' + norm_entity + '\n',
+        '\thostgroups\t\t' + hostgroup_name + '\n',
+        '\tcheck_command\t\tcheck_pyvi!' + entity + '!datastore!status!' + str(warning) + '!' + str(critical) + '!' + '\n',
+        '\t}\n\n'])
 
 
 def create_vcenter_config(entity, vm_props, dc_list, dc_sahost_list, dc_cl_list, cl_host_list, ds_table):
@@ -364,7 +423,7 @@ def create_vcenter_config(entity, vm_props, dc_list, dc_sahost_list, dc_cl_list,
 
 def create_vc_hostgroup(dc, entity, hostgroup_name, hostgroup_type, cl_name=''):
     """
-    Add a hostgroup object to the file named after the vCenter Datacenter
+    Add a hostgroup object to the file named after the vCenter instance and Datacenter
 
     :param dc: The vCenter Datacenter name
     :param entity: The vCenter instance passed on the command line
@@ -372,20 +431,19 @@ def create_vc_hostgroup(dc, entity, hostgroup_name, hostgroup_type, cl_name=''):
     :param hostgroup_type: A descriptive name for the hostgroup
     :param cl_name: Optional, but allows a Cluster name to be supplied to the function
     """
-    vi_entity_file = '/etc/icinga/objects/vc_' + dc + '_config.cfg'
+    vi_entity_file = '/etc/icinga/objects/vc_' + entity.split('.')[0] + '_' + dc + '_config.cfg'
 
-    f = open(vi_entity_file, 'a')
-    f.write('#' + hostgroup_type + ' in hostgroup for ' + entity + '\n')
-    f.write('define hostgroup {\n')
-    f.write('\thostgroup_name\t\t' + hostgroup_name + '\n')
-    f.write('\talias\t\t\t' + dc + ' ' + cl_name + ' ' + hostgroup_type + '\n')
-    f.write('\t}\n\n')
-    f.close()
+    config_writer.write(vi_entity_file, [
+        '#' + hostgroup_type + ' in hostgroup for ' + entity + '\n',
+        'define hostgroup {\n',
+        '\thostgroup_name\t\t' + hostgroup_name + '\n',
+        '\talias\t\t\t' + dc + ' ' + cl_name + ' ' + hostgroup_type + '\n',
+        '\t}\n\n'])
 
 
 def create_vc_host(dc, entity, host_name, hostgroup_name, host_type, warning, critical, cl_name=''):
     """
-    Add a host object to the file named after the vCenter Datacenter
+    Add a host object to the file named after the vCenter instance and Datacenter
 
     :param dc: The vCenter Datacenter name
     :param entity: The vCenter instance passed on the command line
@@ -397,37 +455,36 @@ def create_vc_host(dc, entity, host_name, hostgroup_name, host_type, warning, cr
     :param warning: The warning value for the counter supplied by the command definition
     :param critical: The critical value for the counter supplied by the command definition
     """
-    vi_entity_file = '/etc/icinga/objects/vc_' + dc + '_hosts.cfg'
+    vi_entity_file = '/etc/icinga/objects/vc_' + entity.split('.')[0] + '_' + dc + '_hosts.cfg'
     norm_host = host_name.split('.')[0]
 
-    f = open(vi_entity_file, 'a')
-    f.write('define host {\n')
-    f.write('\tuse\t\t\tgeneric-host\n')
+    lines = ['define host {\n',
+             '\tuse\t\t\tgeneric-host\n']
     if host_type == 'cluster':
-        f.write('\thost_name\t\t' + cl_name + '\n')
+        lines.append('\thost_name\t\t' + cl_name + '\n')
     elif host_type == 'clhost' or host_type == 'sahost':
-        f.write('\thost_name\t\t' + host_name + '\n')
+        lines.append('\thost_name\t\t' + host_name + '\n')
     else:
-        f.write('\thost_name\t\t' + norm_host + '\n')
-    f.write('\talias\t\t\t' + norm_host + ' ' + host_type + '\n')
+        lines.append('\thost_name\t\t' + norm_host + '\n')
+    lines.append('\talias\t\t\t' + norm_host + ' ' + host_type + '\n')
     if host_type != 'cluster' and host_type != 'datastore':
-        f.write('\taddress\t\t\t' + host_name + '\n')
+        lines.append('\taddress\t\t\t' + host_name + '\n')
     if host_type == 'clhost' or host_type == 'vm':
-        f.write('\tparents\t\t\t' + cl_name + '\n')
-    f.write('\thostgroups\t\t\t' + hostgroup_name + '\n')
+        lines.append('\tparents\t\t\t' + cl_name + '\n')
+    lines.append('\thostgroups\t\t\t' + hostgroup_name + '\n')
     if host_type == 'datastore':
-        f.write('\tcheck_command\t\tcheck_pyvi!' + entity + '!datastore!status!' + str(warning) + '!' + str(critical) + '\n')
+        lines.append('\tcheck_command\t\tcheck_pyvi!' + entity + '!datastore!status!' + str(warning) + '!' + str(critical) + '\n')
     elif host_type == 'cluster':
-        f.write('\tcheck_command\t\tcheck_pyvi!' + entity + '!cluster!status!' + str(warning) + '!' + str(critical) + '\n')
+        lines.append('\tcheck_command\t\tcheck_pyvi!' + entity + '!cluster!status!' + str(warning) + '!' + str(critical) + '\n')
     elif host_type == 'vm':
-            f.write('\tcheck_command\t\tcheck_pyvi!' + entity + '!vm!status!' + str(warning) + '!' + str(critical) + '\n')
-    f.write('\t}\n\n')
-    f.close()
+        lines.append('\tcheck_command\t\tcheck_pyvi!' + entity + '!vm!status!' + str(warning) + '!' + str(critical) + '\n')
+    lines.append('\t}\n\n')
+    config_writer.write(vi_entity_file, lines)
 
 
 def create_vc_service(entity, hostgroup_name, service_template, s_description, counter_type, counter, warning, critical):
     """
-    Add a service object to the file named after the vCenter Datacenter
+    Add a service object to the file named after the vCenter instance
 
     :param entity: The vCenter instance passed on the command line
     :param hostgroup_name: One or more hostgroups supplied as a comma separated string
@@ -438,94 +495,128 @@ def create_vc_service(entity, hostgroup_name, service_template, s_description, c
     :param warning: The warning value for the counter supplied by the command definition
     :param critical: The critical value for the counter supplied by the command definition
     """
-    vi_services_file = '/etc/icinga/objects/vc_services_config.cfg'
+    # Each run replaces the files it writes, so every vCenter instance has its own
+    vi_services_file = '/etc/icinga/objects/vc_' + entity.split('.')[0] + '_services_config.cfg'
 
-    f = open(vi_services_file, 'a')
-    f.write('#Service ' + s_description + ' for ' + counter_type + '\n')
-    f.write('define service {\n')
-    f.write('\tuse\t\t\t' + service_template + '\n')
-    f.write('\thostgroup_name\t\t' + hostgroup_name + '\n')
-    f.write('\tservice_description\t' + s_description + '\n')
-    f.write('\tcheck_command\t\tcheck_pyvi!' + entity + '!' + counter_type + '!' + counter + '!' + str(warning) + '!' + str(critical) + '\n')
-    f.write('\t}\n\n')
-    f.close()
+    config_writer.write(vi_services_file, [
+        '#Service ' + s_description + ' for ' + counter_type + '\n',
+        'define service {\n',
+        '\tuse\t\t\t' + service_template + '\n',
+        '\thostgroup_name\t\t' + hostgroup_name + '\n',
+        '\tservice_description\t' + s_description + '\n',
+        '\tcheck_command\t\tcheck_pyvi!' + entity + '!' + counter_type + '!' + counter + '!' + str(warning) + '!' + str(critical) + '\n',
+        '\t}\n\n'])
 
 
-def get_hierarchy(content):
+def get_inventory(content):
     """
-    Build the hierarchy of Clusters, Stand ALone Hosts, CLuster Hosts, DataCenters and Virtual Machines
+    Retrieves the Virtual Machines, ESXi hosts, Datastores and every Cluster, Compute Resource, Folder and
+    Datacenter above them with a single PropertyCollector traversal, so the hierarchies are built without any
+    further calls to the host.
 
     :param content: ServiceInstance Managed Object
+    :return: A dictionary of the properties of each object, indexed by its Managed Object Reference
+    """
+    inventory = get_view_properties(content, [vim.VirtualMachine, vim.HostSystem, vim.ComputeResource, vim.Folder,
+                                              vim.Datacenter, vim.Datastore],
+                                    [(vim.VirtualMachine, ['name', 'runtime.host']),
+                                     (vim.HostSystem, ['name', 'parent']),
+                                     (vim.ComputeResource, ['name', 'parent']),
+                                     (vim.Folder, ['name', 'parent']),
+                                     (vim.Datacenter, ['name', 'parent', 'datastore']),
+                                     (vim.Datastore, ['name'])])
+    return dict((entity['moref']._moId, entity) for entity in inventory)
+
+
+def get_hierarchy(by_moref):
     """
-    vm_props = get_properties(content, [vim.VirtualMachine], ['name', 'runtime.host'], vim.VirtualMachine)
-    host_props = get_properties(content, [vim.HostSystem], ['name', 'parent'], vim.HostSystem)
+    Build the hierarchy of Clusters, Stand ALone Hosts, CLuster Hosts, DataCenters and Virtual Machines
+
+    :param by_moref: The inventory returned by get_inventory
+    """
+    vm_props = []
+    host_props = []
+    for entity in by_moref.values():
+        if isinstance(entity['moref'], vim.VirtualMachine):
+            vm_props.append(entity)
+        elif isinstance(entity['moref'], vim.HostSystem):
+            host_props.append(entity)
+
+    def get_dcname(entity):
+        # Walk up the parents until the Datacenter, whatever the depth of the folders in between
+        while entity is not None and not isinstance(entity['moref'], vim.Datacenter):
+            parent = entity.get('parent')
+            entity = by_moref.get(parent._moId) if parent is not None else None
+        return entity['name'] if entity is not None else None
+
     # Get the Datacenter to Stand Alone Host list
     dc_sahost_list = []
     # Get the Datacenter to Cluster list
     dc_cl_list = []
     # Get the Cluster to Host list
     cl_host_list = []
+    # The entries already added to each list
+    seen = set()
     for host in host_props:
-        if str(host['parent']).startswith('\'vim.Compute'):
+        parent = by_moref.get(host['parent']._moId) if host.get('parent') is not None else None
+        if parent is None:
+            continue
+        if isinstance(parent['moref'], vim.ClusterComputeResource):
+            host['clustername'] = parent['name']
+            host['dcname'] = get_dcname(parent)
+            if ('cl', parent['name'], host['dcname']) not in seen:
+                seen.add(('cl', parent['name'], host['dcname']))
+                dc_cl_list.append({'clustername': parent['name'], 'dcname': host['dcname']})
+            if ('clh', parent['name'], host['name']) not in seen:
+                seen.add(('clh', parent['name'], host['name']))
+                cl_host_list.append({'clustername': parent['name'], 'hostname': host['name']})
+        else:
             host['clustername'] = False
-            host['dcname'] = host['parent'].parent.parent.name
-            sahost_list = {}
-            sahost_list['hostname'] = host['name']
-            sahost_list['dcname'] = host['dcname']
-            if sahost_list in dc_sahost_list:
-                pass
-            else:
-                dc_sahost_list.append(sahost_list)
-        elif str(host['parent']).startswith('\'vim.Cluster'):
-            host['clustername'] = host['parent'].name
-            host['dcname'] = host['parent'].parent.parent.name
-            cl_list = {}
-            cl_list['clustername'] = host['parent'].name
-            cl_list['dcname'] = host['dcname']
-            if cl_list not in dc_cl_list:
-                dc_cl_list.append(cl_list)
-            clh_list = {}
-            clh_list['clustername'] = host['parent'].name
-            clh_list['hostname'] = host['name']
-            if clh_list not in cl_host_list:
-                cl_host_list.append(clh_list)
+            host['dcname'] = get_dcname(parent)
+            if ('sahost', host['name'], host['dcname']) not in seen:
+                seen.add(('sahost', host['name'], host['dcname']))
+                dc_sahost_list.append({'hostname': host['name'], 'dcname': host['dcname']})
 
+    hosts = dict((host['moref']._moId, host) for host in host_props if 'dcname' in host)
+    placed_vms = []
     for vm in vm_props:
-        for host in host_props:
-            if vm['runtime.host'] == host['moref']:
-                vm['hostname'] = host['name']
-                vm['clustername'] = host['clustername']
-                vm['dcname'] = host['dcname']
-                if host['clustername'] == False:
-                    vm['hostgroup_name'] = str(host['dcname']).lower() + '-' + str(host['name']).split('.')[0].lower() + '-vms'
-                else:
-                    vm['hostgroup_name'] = str(host['dcname']).lower() + '-' + str(host['clustername']).lower() + '-vms'
-        del vm['runtime.host']
+        host = hosts.get(vm['runtime.host']._moId) if vm.get('runtime.host') is not None else None
+        # Virtual Machines without a host (e.g. being registered) have no place in the hierarchy
+        if host is None:
+            continue
+        placed_vms.append({
+            'name': vm['name'],
+            'moref': vm['moref'],
+            'hostname': host['name'],
+            'clustername': host['clustername'],
+            'dcname': host['dcname'],
+        })
+        if host['clustername'] == False:
+            placed_vms[-1]['hostgroup_name'] = str(host['dcname']).lower() + '-' + str(host['name']).split('.')[0].lower() + '-vms'
+        else:
+            placed_vms[-1]['hostgroup_name'] = str(host['dcname']).lower() + '-' + str(host['clustername']).lower() + '-vms'
 
     #Get unique DC list
-    dc_list = []
-    for vm in vm_props:
-        dc_list.append(vm['dcname'])
-    dc_list = set(dc_list)
+    dc_list = set(vm['dcname'] for vm in placed_vms)
 
+    return (placed_vms, dc_list, dc_sahost_list, dc_cl_list, cl_host_list)
 
 
-    return (vm_props, dc_list, dc_sahost_list, dc_cl_list, cl_host_list)
-
-
-def get_datastore_hierarchy(content):
+def get_datastore_hierarchy(by_moref):
     """
     Get the Datastore hierarchy for each Datacenter
 
-    :param content: ServiceInstance Managed Object
+    :param by_moref: The inventory returned by get_inventory
     """
-    dc_props = get_properties(content, [vim.Datacenter], ['name', 'datastore'], vim.Datacenter)
     ds_table = []
-    for datacenter in dc_props:
-        for datastore in datacenter['datastore']:
+    for datacenter in by_moref.values():
+        if not isinstance(datacenter['moref'], vim.Datacenter):
+            continue
+        for datastore in datacenter.get('datastore', []):
             dc_dict = {}
             dc_dict['dcname'] = datacenter['name']
-            dc_dict['dsname'] = datastore.name
+            # The name was retrieved with the inventory, reading datastore.name would be a call per Datastore
+            dc_dict['dsname'] = by_moref[datastore._moId]['name']
             ds_table.append(dc_dict)
     return ds_table
 
@@ -552,18 +643,24 @@ def main():
         atexit.register(Disconnect, si)
         content = si.RetrieveContent()
 
-        vm_props, dc_list, dc_sahost_list, dc_cl_list, cl_host_list = get_hierarchy(content)
-        ds_table = get_datastore_hierarchy(content)
+        inventory = get_inventory(content)
+        vm_props, dc_list, dc_sahost_list, dc_cl_list, cl_host_list = get_hierarchy(inventory)
+        ds_table = get_datastore_hierarchy(inventory)
 
-        if content.about.name == 'VMware vCenter Server':
-            print("vCenter Instance detected")
-            create_commands()
-            create_vcenter_config(args.entity, vm_props, dc_list, dc_sahost_list, dc_cl_list, cl_host_list, ds_table)
-            pass
-        elif content.about.name == 'VMware ESXi':
-            print("ESXi Host detected")
-            create_commands()
-            create_esxi_config(args.entity, vm_props, ds_table)
+        try:
+            if content.about.name == 'VMware vCenter Server':
+                print("vCenter Instance detected")
+                create_commands()
+                create_vcenter_config(args.entity, vm_props, dc_list, dc_sahost_list, dc_cl_list, cl_host_list, ds_table)
+                pass
+            elif content.about.name == 'VMware ESXi':
+                print("ESXi Host detected")
+                create_commands()
+                create_esxi_config(args.entity, vm_props, ds_table)
+            config_writer.commit()
+        finally:
+            # Leave the previous configuration in place rather than a partial one, nothing is left after commit()
+            config_writer.discard()
 
     except vmodl.MethodFault as e:
         print("Caught vmodl fault : " + e.msg)
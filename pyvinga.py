@@ -1,21 +1,40 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """
 Python program that will query requested counters in vCenter and return
 status information for Nagios/Icinga
 """
 
-from __future__ import print_function
-from __future__ import division
-from pyVim.connect import SmartConnect, Disconnect
-from pyVmomi import vmodl, vim
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, timezone
 from os import path
-from ssl import SSLError
-import ssl
+from array import array
 import argparse
 import atexit
+import base64
+import calendar
+import contextlib
+import fcntl
+import fnmatch
 import getpass
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import os
+import queue
+import re
+import signal
+import socket
+import socketserver
+import stat
+import struct
 import sys
+import threading
+import time
+
+# pyVmomi, pyVim and ssl take most of the start up time of a check, they are imported by import_vsphere
+# once a check connects to vCenter.  Checks answered by the daemon or the result cache never import them.
+SmartConnect = Disconnect = SoapStubAdapter = vim = vmodl = ssl = SSLError = None
 
 
 # Define specific values for the Icinga return status and also create a list
@@ -24,6 +43,178 @@ STATE_WARNING = 1
 STATE_CRITICAL = 2
 STATE_UNKNOWN = 3
 state_tuple = 'OK', 'WARNING', 'CRITICAL', 'UNKNOWN'
+# Order used to pick the most severe state when a check reports on several entities or counters
+state_severity = STATE_OK, STATE_UNKNOWN, STATE_WARNING, STATE_CRITICAL
+# A single perfdata field, labels are quoted (with single quotes doubled) where they contain spaces
+perfdata_field = re.compile(r"(?:'(?:[^']|'')*'|[^\s'])+")
+
+# The performance counters (and instance) queried for each Virtual Machine counter
+vm_perf_counters = {
+    'cpu.ready': [('cpu.ready.summation', '')],
+    'cpu.usage': [('cpu.usage.average', '')],
+    'mem.active': [('mem.active.average', '')],
+    'mem.shared': [('mem.shared.average', '')],
+    'mem.balloon': [('mem.vmmemctl.average', '')],
+    'datastore.io': [('datastore.numberReadAveraged.average', '*'), ('datastore.numberWriteAveraged.average', '*')],
+    'datastore.latency': [('datastore.totalReadLatency.average', '*'), ('datastore.totalWriteLatency.average', '*')],
+    'network.usage': [('net.received.average', '*'), ('net.transmitted.average', '*')],
+    'cpu.ready.trend': [('cpu.ready.summation', '')],
+}
+# How the instances of a counter (e.g. the datastores or vNICs of a Virtual Machine) are combined unless
+# --aggregate is set.  Rates and throughputs add up across instances, latencies do not, the worst instance is used.
+counter_aggregate = {
+    'datastore.totalReadLatency.average': 'max',
+    'datastore.totalWriteLatency.average': 'max',
+}
+default_aggregate = 'sum'
+
+# The properties read by each entity type and counter, fetched together with the entity lookup
+vm_memory_props = ['summary.config.memorySizeMB']
+counter_props = {
+    ('vm', 'core'): ['summary.config.annotation', 'summary.config.guestFullName', 'summary.config.numCpu',
+                     'summary.config.memorySizeMB'],
+    ('vm', 'status'): ['overallStatus', 'runtime.powerState'],
+    ('vm', 'mem.active'): vm_memory_props,
+    ('vm', 'mem.shared'): vm_memory_props,
+    ('vm', 'mem.balloon'): vm_memory_props,
+    ('host', 'core'): ['config.product.fullName', 'summary.hardware.model', 'summary.hardware.numCpuPkgs',
+                       'summary.hardware.cpuModel', 'summary.hardware.numCpuCores', 'summary.hardware.numCpuThreads',
+                       'summary.hardware.memorySize'],
+    ('host', 'cpu.usage'): ['summary.quickStats.overallCpuUsage', 'summary.hardware.cpuMhz',
+                            'summary.hardware.numCpuCores'],
+    ('host', 'mem.usage'): ['summary.quickStats.overallMemoryUsage', 'summary.hardware.memorySize'],
+    ('datastore', 'space'): ['summary.capacity', 'summary.freeSpace'],
+    ('datastore', 'space.growth'): ['summary.capacity', 'summary.freeSpace'],
+    ('datastore', 'status'): ['overallStatus', 'summary.type'],
+    ('cluster', 'status'): ['overallStatus'],
+    ('host', 'vms.cpu.ready'): ['vm'],
+    ('host', 'vms.mem.balloon'): ['vm'],
+    ('cluster', 'vms.cpu.ready'): ['host'],
+    ('cluster', 'vms.mem.balloon'): ['host'],
+}
+
+# The Host and Cluster counters rolled up over their Virtual Machines, and the Virtual Machine counter each is
+# calculated from
+rollup_counters = {
+    'vms.cpu.ready': 'cpu.ready',
+    'vms.mem.balloon': 'mem.balloon',
+}
+# The properties obtained for each Virtual Machine of a Host or Cluster for the rollup counters
+rollup_vm_props = ['name', 'runtime.powerState', 'summary.config.memorySizeMB']
+
+# The properties kept in memory by the inventory mirror of the pyvinga daemon
+mirror_props = {
+    'VirtualMachine': ['name', 'runtime.powerState', 'runtime.host', 'overallStatus', 'summary.quickStats',
+                       'summary.config'],
+    'HostSystem': ['name', 'overallStatus', 'config.product', 'summary.quickStats', 'summary.hardware'],
+    'Datastore': ['name', 'overallStatus', 'summary'],
+    'ClusterComputeResource': ['name', 'overallStatus', 'summary'],
+}
+# Longest time (seconds) the inventory mirror waits for changes in a single WaitForUpdatesEx call
+mirror_wait = 60
+
+# Interval (seconds) between realtime performance samples, and the time (seconds) after the end of its interval
+# by which vCenter has certainly rolled up a sample
+sample_interval = 20
+sample_delay = 40
+
+# Directory of the caches kept between checks, private to the user running pyvinga (see private_dir)
+cache_dir = '/tmp/pyvinga-{}'.format(os.getuid())
+# Cache directories already found to be private
+private_dirs = set()
+
+# Directory of the sample ring (see --sample-ring), its smallest number of series (it grows to keep every series
+# of the inventory queried at most half full), samples kept per series, and the period (seconds) trend counters
+# are calculated over
+sample_ring_dir = cache_dir
+sample_ring_series = 16384
+sample_ring_size = 180
+trend_period = 3600
+
+# Default number of entities per QueryPerf call and number of QueryPerf calls running at once
+query_chunk_size = 250
+query_workers = 4
+
+# The entity types supported by -n and their vim Managed Object types
+entity_types = {
+    'vm': 'VirtualMachine',
+    'host': 'HostSystem',
+    'datastore': 'Datastore',
+    'cluster': 'ClusterComputeResource',
+}
+# The counters fetched for an entity when --result-cache is set, so checks for the other counters of the
+# same entity find them in the cache
+cached_counters = {
+    'vm': ['core', 'status', 'cpu.ready', 'cpu.usage', 'mem.active', 'mem.shared', 'mem.balloon', 'datastore.io',
+           'datastore.latency', 'network.usage'],
+    'host': ['core', 'cpu.usage', 'mem.usage'],
+    'datastore': ['status', 'space'],
+    'cluster': ['status'],
+}
+# The Virtual Machine counters Virtual Machines can be ranked by with --top
+top_counters = ['cpu.ready', 'cpu.usage', 'mem.active', 'mem.shared', 'mem.balloon', 'datastore.io',
+                'datastore.latency', 'network.usage']
+# Directory of the result cache (see --result-cache)
+result_cache_dir = cache_dir
+
+# Default location of the Unix socket used between the pyvinga daemon and check clients
+default_socket = '/tmp/pyvinga.sock'
+# Directory used to store vCenter session cookies between checks (see --session-cache)
+session_cache_dir = cache_dir
+# Directory and default lifetime (seconds) of the entity name to Managed Object Reference index
+index_dir = cache_dir
+index_ttl = 3600
+# Directory of the offset between the local and the vCenter clock, and seconds before it is measured again
+clock_dir = cache_dir
+clock_ttl = 900
+# Directory and lifetime of the performance counter dictionary
+perf_dict_dir = cache_dir
+perf_dict_age = timedelta(days=7)
+# Statistics level fetched when the performance dictionary is built, and the highest level there is
+perf_dict_level = 1
+max_perf_level = 4
+# Default Icinga host and service names used for passive check results in scan mode
+passive_host_name = '{entity}'
+passive_service_name = '{counter}'
+# Icinga 2 API submission in scan mode (see --api-url): default port, number of keep-alive connections,
+# results queued before the scan waits for the API, results sent by a connection in one go, attempts for each
+# result and seconds before the first retry (doubled for each further retry), and the timeout of a request
+api_port = 5665
+api_connections = 4
+api_queue_size = 1000
+api_batch_size = 50
+api_retries = 3
+api_retry_delay = 0.5
+api_timeout = 30
+
+
+class CheckError(Exception):
+    """
+    Raised when a check cannot produce a value.  Carries the Icinga state that should be returned.
+    """
+    def __init__(self, state, message):
+        Exception.__init__(self, message)
+        self.state = state
+
+
+def import_vsphere():
+    """
+    Imports the modules needed to talk to vCenter the first time they are used.
+    """
+    global SmartConnect, Disconnect, SoapStubAdapter, vim, vmodl, ssl, SSLError
+    if vim is not None:
+        return
+    import ssl
+    from ssl import SSLError
+    from pyVim.connect import SmartConnect, Disconnect
+    from pyVmomi import SoapStubAdapter, vmodl, vim
+
+
+def get_entity_type(entity_type):
+    """
+    Returns the vim Managed Object type for an entity type supported by -n (e.g. vim.VirtualMachine for vm)
+    """
+    return getattr(vim, entity_types[entity_type])
 
 
 def GetArgs():
@@ -38,284 +229,947 @@ def GetArgs():
     parser.add_argument('-p', '--password', required=False, action='store',
                         help='Password to use when connecting to host')
     parser.add_argument('-n', '--type', required=True, action='store', help='values should be vm,host or datastore')
-    parser.add_argument('-e', '--entity', required=True, action='store', help='One or more entities to report on')
-    parser.add_argument('-r', '--counter', required=True, action='store', help='Performance Counter Name')
+    parser.add_argument('-e', '--entity', required=True, action='store',
+                        help='One or more entities to report on (comma separated names or wildcard patterns)')
+    parser.add_argument('-r', '--counter', required=True, action='store',
+                        help='Performance Counter Name (comma separated for several counters)')
     parser.add_argument('-w', '--warning', required=False, action='store', default=80,
                         help='Warning level for the counter (default: 80)')
     parser.add_argument('-c', '--critical', required=False, action='store', default=90,
                         help='Critical level for the counter (default: 90)')
+    parser.add_argument('--socket', required=False, action='store',
+                        help='Forward the check to a pyvinga daemon listening on this Unix socket')
+    parser.add_argument('--session-cache', required=False, action='store_true', default=False,
+                        help='Reuse the vCenter session from a previous check and keep it logged in afterwards')
+    parser.add_argument('--container', required=False, action='store',
+                        help='Inventory path of a Datacenter, Cluster or Folder to look for the entities in '
+                             '(e.g. DC1/host/Cluster1)')
+    parser.add_argument('--index-ttl', required=False, action='store', type=int, default=index_ttl,
+                        help='Seconds before wildcard patterns rebuild the local entity index, 0 disables the index '
+                             '(default: ' + str(index_ttl) + ')')
+    parser.add_argument('--chunk-size', required=False, action='store', type=int, default=query_chunk_size,
+                        help='Largest number of entities in a single performance query, 0 for no limit '
+                             '(default: ' + str(query_chunk_size) + ')')
+    parser.add_argument('--workers', required=False, action='store', type=int, default=query_workers,
+                        help='Largest number of performance queries sent to vCenter at once '
+                             '(default: ' + str(query_workers) + ')')
+    parser.add_argument('--perf-format', required=False, action='store', choices=['normal', 'csv'],
+                        default='normal',
+                        help='Format of the performance samples returned by vCenter, csv is smaller and faster to '
+                             'parse for large queries (default: normal)')
+    parser.add_argument('--window', required=False, action='store', type=int, default=sample_interval,
+                        help='Seconds of realtime samples to evaluate, e.g. the check interval '
+                             '(default: ' + str(sample_interval) + ', the latest sample only)')
+    parser.add_argument('--stat', required=False, action='store', choices=['avg', 'max', 'p95'], default='avg',
+                        help='Statistic taken over the samples in --window (default: avg)')
+    parser.add_argument('--aggregate', required=False, action='store', choices=['sum', 'max', 'avg'],
+                        help='How the instances of a counter (e.g. the datastores or vNICs of a Virtual Machine) '
+                             'are combined, each instance is also added to the perfdata (default: max for '
+                             'latencies, sum for the other counters)')
+    parser.add_argument('--sample-ring', required=False, action='store_true', default=False,
+                        help='Keep fetched samples in a shared local ring buffer, reuse them within the same '
+                             'realtime interval and enable the trend counters')
+    parser.add_argument('--sample-ring-series', required=False, action='store', type=int,
+                        default=sample_ring_series,
+                        help='Smallest number of series the sample ring holds, at least twice the number of '
+                             'entities times counters checked with --sample-ring.  Scans grow it to fit the '
+                             'inventory (default: ' + str(sample_ring_series) + ')')
+    parser.add_argument('--result-cache', required=False, action='store', type=int, default=0,
+                        help='Seconds to share the values fetched for an entity with the checks of its other '
+                             'counters, the first check fetches every counter (default: 0, disabled)')
+    parser.add_argument('--top', required=False, action='store', type=int, default=0,
+                        help='Rank the Virtual Machines matching --entity by a single counter and report only the '
+                             'N worst of them as one result (e.g. -e "*" -r cpu.ready --top 10)')
+    parser.add_argument('--timings', required=False, action='store_true', default=False,
+                        help='Add the time taken by each phase of the check and the number of SOAP calls made '
+                             'to the perfdata (checks run by the daemon, see --socket, report its phases without '
+                             'the SOAP calls)')
+    parser.add_argument('--command-file', required=False, action='store',
+                        help='Scan mode: submit a passive check result for every entity and counter to this Icinga '
+                             'external command file (e.g. /var/run/icinga2/cmd/icinga2.cmd) instead of printing them')
+    parser.add_argument('--spool-dir', required=False, action='store',
+                        help='Scan mode: write the passive check results as external commands to a new file '
+                             'in this directory')
+    parser.add_argument('--api-url', required=False, action='store',
+                        help='Scan mode: submit the passive check results to this Icinga 2 API '
+                             '(e.g. https://icinga.example.com:5665)')
+    parser.add_argument('--api-user', required=False, action='store', help='Icinga 2 API user for --api-url')
+    parser.add_argument('--api-password', required=False, action='store',
+                        help='Icinga 2 API password for --api-url')
+    parser.add_argument('--api-ca', required=False, action='store',
+                        help='CA certificate to verify the Icinga 2 API with (e.g. /var/lib/icinga2/certs/ca.crt), '
+                             '-i / --insecure skips verifying it')
+    parser.add_argument('--api-connections', required=False, action='store', type=int, default=api_connections,
+                        help='Number of keep-alive connections to the Icinga 2 API (default: ' +
+                             str(api_connections) + ')')
+    parser.add_argument('--host-name', required=False, action='store', default=passive_host_name,
+                        help='Icinga host name for passive check results, {entity}, {type} and {counter} are '
+                             'replaced (default: ' + passive_host_name + ')')
+    parser.add_argument('--service-name', required=False, action='store', default=passive_service_name,
+                        help='Icinga service name for passive check results, {entity}, {type} and {counter} are '
+                             'replaced (default: ' + passive_service_name + ')')
     args = parser.parse_args()
     return args
 
 
-def build_query(content, vchtime, counterId, instance, vm_moref):
+def GetServeArgs(argv):
+    """
+    Supports the command-line arguments listed below for the pyvinga daemon (pyvinga.py serve).
+    """
+    parser = argparse.ArgumentParser(prog='pyvinga.py serve',
+                                     description='Run pyvinga as a daemon holding vCenter sessions for check clients')
+    parser.add_argument('--socket', required=False, action='store', default=default_socket,
+                        help='Unix socket to listen on (default: ' + default_socket + ')')
+    parser.add_argument('--no-mirror', required=False, action='store_true',
+                        help='Do not keep an in-memory copy of the inventory, query vCenter for every check')
+    args = parser.parse_args(argv)
+    return args
+
+
+def build_query(content, vchtime, perf_dict, queries, chunk_size=query_chunk_size, workers=query_workers,
+                perf_format='normal', window=sample_interval, stat='avg', ring=None, aggregate=None):
     """
-    Creates the query for performance stats in the correct format
+    Creates the query for performance stats in the correct format.  Entities are fetched chunk_size at a time,
+    with up to workers QueryPerf calls running at once on the same session.
 
     :param content: ServiceInstance Managed Object
-    :param counterId: The returned integer counter Id assigned to the named performance counter
-    :param instance: instance of the performance counter to return (typically empty but it may need to contain a value
-    for example - with VM virtual disk queries)
-    :param vm_moref: Managed Object Reference for the Virtual Machine
+    :param vchtime: The vCenter date and time used as the baseline when querying for counters
+    :param perf_dict: The array containing the performance dictionary (with counters and IDs)
+    :param queries: A list of (moref, counters) tuples where counters is a list of (counter name, instance) tuples.
+    The instance is typically empty but it may need to contain a value, for example with VM virtual disk queries.
+    :param chunk_size: The largest number of entities in a single QueryPerf call, 0 for no limit
+    :param workers: The largest number of QueryPerf calls running at the same time
+    :param perf_format: 'normal' or 'csv', the format vCenter returns the samples in.  CSV returns each series
+    as one comma separated string, a much smaller response for large queries.
+    :param window: The number of seconds of samples to fetch, ending on the last sample boundary at least
+    sample_delay seconds before vchtime
+    :param stat: The statistic ('avg', 'max' or 'p95') taken over the samples in the window
+    :param ring: A SampleRing holding samples fetched earlier.  Entities with every sample of the window in the ring
+    are not queried again, the samples of the others are added to it.
+    :param aggregate: 'sum', 'max' or 'avg', how the series of the instances of a counter are combined, or None for
+    the default of each counter in counter_aggregate
+    :return: A dictionary keyed on the moref ID, holding a dictionary of counter name to value for each entity.
+    Counters with several instances also have the value of each instance under 'instances', and aggregate, where
+    one is given, is kept under 'aggregate'.
     """
     perfManager = content.perfManager
-    metricId = vim.PerformanceManager.MetricId(counterId=counterId, instance=instance)
-    startTime = vchtime - timedelta(seconds=60)
-    endTime = vchtime - timedelta(seconds=40)
-    query = vim.PerformanceManager.QuerySpec(intervalId=20, entity=vm_moref, metricId=[metricId], startTime=startTime,
-                                             endTime=endTime)
-    perfResults = perfManager.QueryPerf(querySpec=[query])
-    if perfResults:
-        statdata = float(sum(perfResults[0].value[0].value))
-        return statdata
+    endTime = align_sample_time(vchtime - timedelta(seconds=sample_delay))
+    startTime = endTime - timedelta(seconds=window)
+    counter_names = {}
+    querySpecs = []
+    perf_results = {}
+    # The combined series of counters queried for every instance ('*') are not kept in the ring, ring_statdata
+    # queries the instances again
+    instance_counters = set(counter_name for moref, counters in queries for counter_name, instance in counters
+                            if instance == '*')
+    if ring is not None:
+        ring.reserve(len(set((moref._moId, counter_name) for moref, counters in queries
+                             for counter_name, instance in counters if counter_name not in instance_counters)))
+        remaining = []
+        for moref, counters in queries:
+            statdata = ring_statdata(ring, moref, counters, epoch_seconds(startTime), epoch_seconds(endTime),
+                                     window, stat)
+            if statdata is None:
+                remaining.append((moref, counters))
+            else:
+                perf_results[moref._moId] = statdata
+        queries = remaining
+    resolve_perf_counters(content, perf_dict, [counter_name for moref, counters in queries
+                                               for counter_name, instance in counters])
+    for moref, counters in queries:
+        metricIds = []
+        for counter_name, instance in counters:
+            counterId = stat_lookup(perf_dict, counter_name)
+            counter_names[counterId] = counter_name
+            metricIds.append(vim.PerformanceManager.MetricId(counterId=counterId, instance=instance))
+        querySpecs.append(vim.PerformanceManager.QuerySpec(intervalId=20, entity=moref, metricId=metricIds,
+                                                           startTime=startTime, endTime=endTime,
+                                                           format=perf_format))
+    if not querySpecs:
+        return perf_results
+    if chunk_size <= 0:
+        chunk_size = len(querySpecs)
+    chunks = [querySpecs[i:i + chunk_size] for i in range(0, len(querySpecs), chunk_size)]
+    if len(chunks) == 1 or workers <= 1:
+        chunk_results = [perfManager.QueryPerf(querySpec=chunk) for chunk in chunks]
     else:
-        print('ERROR: Performance results empty.  Check time drift on source and vCenter server')
-        exit(STATE_WARNING)
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            # map returns the results in chunk order, so entities stay in the order they were queried
+            chunk_results = list(executor.map(lambda chunk: perfManager.QueryPerf(querySpec=chunk), chunks))
+    for perfResult in [perfResult for chunk_result in chunk_results for perfResult in chunk_result]:
+        statdata = perf_results.setdefault(perfResult.entity._moId, {})
+        if window > sample_interval:
+            # Tells the check functions to show the statistic next to the counter name
+            statdata['stat'] = stat
+        if aggregate:
+            # Tells the check functions combining several counters per instance how to combine the instances
+            statdata['aggregate'] = aggregate
+        counter_instances = {}
+        for series in perfResult.value:
+            counter_instances.setdefault(counter_names[series.id.counterId], {})[series.id.instance] = \
+                series_values(series)
+        for counter_name, instances in counter_instances.items():
+            values = aggregate_series(instances, aggregate or counter_aggregate.get(counter_name, default_aggregate))
+            statdata[counter_name] = series_stat(values, stat)
+            if any(instances):
+                statdata.setdefault('instances', {})[counter_name] = dict(
+                    (instance, series_stat(instance_values, stat))
+                    for instance, instance_values in instances.items() if instance)
+            if ring is not None and counter_name not in instance_counters:
+                ring.add(SampleRing.key(perfResult.entity._moId, counter_name),
+                         list(zip(sample_timestamps(perfResult), values)))
+    return perf_results
+
+
+def aggregate_series(instances, aggregate):
+    """
+    Combines the series of the instances of a counter into a single series, sample by sample
+
+    :param instances: A dictionary of instance name to the sample values returned by series_values.  The ''
+    instance (the total calculated by vCenter) is only used where there are no other instances.
+    :param aggregate: 'sum', 'max' or 'avg'
+    """
+    series = [values for instance, values in instances.items() if instance] or list(instances.values())
+    if len(series) == 1:
+        return series[0]
+    typecode = 'd' if aggregate == 'avg' else 'l'
+    length = max(len(values) for values in series)
+    if any(len(values) != length for values in series):
+        # An instance added during the window has fewer samples, the ones it has are the latest.  The series are
+        # aligned on their last sample and each sample combines the instances that have it.
+        return array(typecode, [aggregate_values([values[i - length + len(values)] for values in series
+                                                  if i - length + len(values) >= 0], aggregate)
+                                for i in range(length)])
+    if aggregate == 'max':
+        return array(typecode, map(max, zip(*series)))
+    if aggregate == 'avg':
+        return array(typecode, [float(sum(samples)) / len(series) for samples in zip(*series)])
+    return array(typecode, map(sum, zip(*series)))
+
+
+def aggregate_values(values, aggregate):
+    """
+    Combines the values of the instances of a counter into a single value
+
+    :param values: A list of at least one value
+    :param aggregate: 'sum', 'max' or 'avg'
+    """
+    if aggregate == 'max':
+        return max(values)
+    if aggregate == 'avg':
+        return float(sum(values)) / len(values)
+    return sum(values)
+
+
+def series_values(series):
+    """
+    Returns the sample values of a series returned by QueryPerf as an array of integers
+
+    :param series: A MetricSeries (normal format) or MetricSeriesCSV (csv format)
+    """
+    if isinstance(series, vim.PerformanceManager.MetricSeriesCSV):
+        return array('l', map(int, series.value.split(','))) if series.value else array('l')
+    return array('l', series.value)
+
+
+def series_stat(values, stat):
+    """
+    Returns a statistic over the sample values of a series
+
+    :param values: The array of sample values returned by series_values
+    :param stat: 'avg', 'max' or 'p95' (nearest rank 95th percentile)
+    """
+    if not values:
+        return 0.0
+    if stat == 'max':
+        return float(max(values))
+    if stat == 'p95':
+        return float(sorted(values)[int(math.ceil(0.95 * len(values))) - 1])
+    return float(sum(values)) / len(values)
+
+
+def stat_name(statName, statdata):
+    """
+    Adds the statistic taken over a multi-sample window to the friendly name of a counter, e.g. CPU Ready (p95)
+
+    :param statName: The friendly name for the performance statistic
+    :param statdata: The performance values returned by build_query for the entity
+    """
+    if statdata.get('stat'):
+        return '{} ({})'.format(statName, statdata['stat'])
+    return statName
+
+
+def get_sample_ring_file(content, args):
+    """
+    Returns the name of the sample ring file for the vCenter (or ESXi host) connected to
+
+    :param content: ServiceInstance Managed Object
+    :param args: The parsed command-line arguments
+    """
+    return path.join(private_dir(sample_ring_dir), 'pyvinga_samples_{}.ring'.format(get_instance_key(content, args)))
+
+
+class SampleRing(object):
+    """
+    A fixed size, memory mapped store of the most recent samples for each entity and counter, shared by every
+    pyvinga process checking the same vCenter.
+
+    The file holds a header followed by at least sample_ring_series slots.  Each slot holds the key of one series
+    and a ring of its last sample_ring_size (timestamp, value) pairs.  Slots are found by hashing the key with
+    linear probing, a full table reuses the probed slot with the oldest samples.  Readers take a shared
+    flock on the file and writers an exclusive one.
+
+    The number of slots is kept in the header.  A process asking for more slots than the file has (see reserve)
+    rehashes the stored series into a larger file, and the other processes map it again on their next access.
+    """
+    header = struct.Struct('<8sIII')
+    slot_header = struct.Struct('<QII')
+    sample = struct.Struct('<qd')
+    magic = b'PYVRING1'
+    max_probe = 16
+
+    def __init__(self, file_name, series=None, size=None):
+        self.size = size or sample_ring_size
+        self.slot_size = self.slot_header.size + self.size * self.sample.size
+        self.lock = threading.Lock()
+        self.map = None
+        self.fd = os.open(file_name, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                self.open_layout(series or sample_ring_series)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        except Exception:
+            if self.map is not None:
+                self.map.close()
+            os.close(self.fd)
+            raise
+
+    def open_layout(self, series):
+        """
+        Maps the file with at least series slots, keeping the layout of a file that has more of them already and
+        the stored series of one that has fewer.  Called with the exclusive flock held.
+        """
+        magic, file_series, size, reserved = self.header.unpack(
+            os.pread(self.fd, self.header.size, 0).ljust(self.header.size, b'\0'))
+        slots = []
+        if (magic, size) == (self.magic, self.size) and file_series:
+            self.map_file(file_series)
+            if file_series >= series:
+                return
+            for offset in range(self.header.size, len(self.map), self.slot_size):
+                if self.slot_header.unpack_from(self.map, offset)[0]:
+                    slots.append(self.map[offset:offset + self.slot_size])
+            self.map.close()
+        # A new file, one written with another layout or one with too few slots.  Truncating it first zeroes it
+        # without writing (or allocating) every page.
+        os.ftruncate(self.fd, 0)
+        self.map_file(series)
+        self.header.pack_into(self.map, 0, self.magic, series, self.size, 0)
+        for slot in slots:
+            offset = self.find_slot(self.slot_header.unpack_from(slot, 0)[0], True)
+            self.map[offset:offset + self.slot_size] = slot
+
+    def map_file(self, series):
+        """
+        Maps the file with series slots, extending it if it is shorter
+        """
+        length = self.header.size + series * self.slot_size
+        if os.fstat(self.fd).st_size < length:
+            os.ftruncate(self.fd, length)
+        self.map = mmap.mmap(self.fd, length)
+        self.series = series
+
+    def check_layout(self):
+        """
+        Maps the file again if another process has grown it since it was mapped.  Called with the flock held.
+
+        :return: False if the file has been written with another layout since
+        """
+        magic, series, size, reserved = self.header.unpack_from(self.map, 0)
+        if (magic, size) != (self.magic, self.size):
+            return False
+        if series != self.series:
+            self.map.close()
+            self.map_file(series)
+        return True
+
+    def reserve(self, count):
+        """
+        Grows the ring, doubling its slots until count series fill at most half of them
+
+        :param count: The number of series about to be stored
+        """
+        series = self.series
+        while series < 2 * count:
+            series *= 2
+        if series == self.series:
+            return
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                self.map.close()
+                self.map = None
+                self.open_layout(series)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def key(moid, counter_name):
+        """
+        Returns the non-zero 64 bit key of the series for an entity and counter
+        """
+        digest = hashlib.sha1('{}/{}'.format(moid, counter_name).encode('utf-8')).digest()
+        return struct.unpack('<Q', digest[:8])[0] or 1
+
+    def find_slot(self, key, create):
+        """
+        Returns the offset of the slot holding key, or of the slot to store it in if create is set
+        """
+        victim = None
+        victim_newest = None
+        for probe in range(self.max_probe):
+            offset = self.header.size + ((key + probe) % self.series) * self.slot_size
+            slot_key, head, count = self.slot_header.unpack_from(self.map, offset)
+            if slot_key == key:
+                return offset
+            if not create:
+                if slot_key == 0:
+                    return None
+                continue
+            if slot_key == 0:
+                self.slot_header.pack_into(self.map, offset, key, 0, 0)
+                return offset
+            newest = self.newest(offset) or 0
+            if victim is None or newest < victim_newest:
+                victim, victim_newest = offset, newest
+        if victim is not None:
+            self.slot_header.pack_into(self.map, victim, key, 0, 0)
+        return victim
+
+    def newest(self, offset):
+        """
+        Returns the timestamp of the newest sample in a slot, or None if it is empty
+        """
+        slot_key, head, count = self.slot_header.unpack_from(self.map, offset)
+        if not count:
+            return None
+        base = offset + self.slot_header.size
+        return self.sample.unpack_from(self.map, base + ((head - 1) % self.size) * self.sample.size)[0]
+
+    def read_slot(self, offset):
+        """
+        Returns the samples in a slot, oldest first
+        """
+        slot_key, head, count = self.slot_header.unpack_from(self.map, offset)
+        base = offset + self.slot_header.size
+        first = (head - count) % self.size
+        return [self.sample.unpack_from(self.map, base + ((first + i) % self.size) * self.sample.size)
+                for i in range(count)]
+
+    def samples(self, key, start=None, end=None):
+        """
+        Returns the stored samples of a series with start < timestamp <= end, oldest first
+
+        :param key: The series key returned by SampleRing.key
+        :param start: The timestamp (seconds since the epoch) after which samples are returned, None for no limit
+        :param end: The last timestamp (seconds since the epoch) returned, None for no limit
+        """
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_SH)
+            try:
+                offset = self.find_slot(key, False) if self.check_layout() else None
+                stored = self.read_slot(offset) if offset is not None else []
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return [(timestamp, value) for timestamp, value in stored
+                if (start is None or timestamp > start) and (end is None or timestamp <= end)]
+
+    def add(self, key, samples):
+        """
+        Stores the samples of a series that are newer than the newest sample already stored
+
+        :param key: The series key returned by SampleRing.key
+        :param samples: A list of (timestamp, value) tuples, oldest first
+        """
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                if not self.check_layout():
+                    return
+                offset = self.find_slot(key, True)
+                slot_key, head, count = self.slot_header.unpack_from(self.map, offset)
+                newest = self.newest(offset)
+                base = offset + self.slot_header.size
+                for timestamp, value in samples:
+                    if newest is not None and timestamp <= newest:
+                        continue
+                    self.sample.pack_into(self.map, base + head * self.sample.size, timestamp, value)
+                    head = (head + 1) % self.size
+                    count = min(count + 1, self.size)
+                    newest = timestamp
+                self.slot_header.pack_into(self.map, offset, key, head, count)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+def epoch_seconds(timestamp):
+    """
+    Returns a datetime returned by vCenter as seconds since the epoch
+    """
+    return calendar.timegm(timestamp.utctimetuple())
+
+
+def align_sample_time(timestamp):
+    """
+    Returns the last realtime sample boundary at or before a datetime.  Realtime samples are stamped with the
+    end of their interval, so a window between two boundaries holds exactly window / sample_interval samples.
+    """
+    return timestamp - timedelta(seconds=epoch_seconds(timestamp) % sample_interval,
+                                 microseconds=timestamp.microsecond)
+
+
+def sample_timestamps(perfResult):
+    """
+    Returns the timestamps (seconds since the epoch) of the samples in a QueryPerf result
+
+    :param perfResult: An EntityMetric (normal format) or EntityMetricCSV (csv format)
+    """
+    if isinstance(perfResult, vim.PerformanceManager.EntityMetricCSV):
+        # sampleInfoCSV alternates the interval and the timestamp of each sample
+        fields = perfResult.sampleInfoCSV.split(',') if perfResult.sampleInfoCSV else []
+        return [calendar.timegm(time.strptime(field[:19], '%Y-%m-%dT%H:%M:%S')) for field in fields[1::2]]
+    return [epoch_seconds(sampleInfo.timestamp) for sampleInfo in perfResult.sampleInfo or []]
+
+
+def ring_statdata(ring, moref, counters, start, end, window, stat):
+    """
+    Returns the performance values for an entity from the samples stored in the ring, if the ring holds
+    every sample in the window for all of its counters
+
+    :return: A dictionary of counter name to value as in the results of build_query, or None
+    """
+    statdata = {}
+    expected = max(1, window // sample_interval)
+    for counter_name, instance in counters:
+        if counter_name in statdata:
+            continue
+        if instance == '*':
+            # Neither the instances nor their combined series are kept in the ring, they have to be queried
+            return None
+        samples = ring.samples(SampleRing.key(moref._moId, counter_name), start, end)
+        if len(samples) < expected:
+            return None
+        statdata[counter_name] = series_stat(array('d', [value for timestamp, value in samples]), stat)
+    if window > sample_interval:
+        statdata['stat'] = stat
+    return statdata
+
+
+def trend_per_hour(samples):
+    """
+    Returns the least squares slope of the samples per hour
+
+    :param samples: A list of (timestamp, value) tuples
+    :return: The change of the value per hour, or None if the samples do not span any time
+    """
+    if len(samples) < 2:
+        return None
+    mean_t = float(sum(timestamp for timestamp, value in samples)) / len(samples)
+    mean_v = float(sum(value for timestamp, value in samples)) / len(samples)
+    variance = sum((timestamp - mean_t) ** 2 for timestamp, value in samples)
+    if not variance:
+        return None
+    covariance = sum((timestamp - mean_t) * (value - mean_v) for timestamp, value in samples)
+    return covariance / variance * 3600
+
+
+def get_trend_samples(ring, moid, counter_name):
+    """
+    Returns the samples of a series in the ring from the last trend_period seconds
+
+    :raises CheckError: If there is no sample ring
+    """
+    if ring is None:
+        raise CheckError(STATE_UNKNOWN, 'ERROR: Trend counters need the sample ring, use --sample-ring')
+    samples = ring.samples(SampleRing.key(moid, counter_name))
+    if not samples:
+        return samples
+    return [(timestamp, value) for timestamp, value in samples if timestamp > samples[-1][0] - trend_period]
+
+
+def get_statdata(perf_results, moref):
+    """
+    Returns the performance values fetched by build_query for a single entity
+
+    :param perf_results: The dictionary returned by build_query
+    :param moref: Managed Object Reference for the entity
+    """
+    statdata = perf_results.get(moref._moId)
+    if not statdata:
+        raise CheckError(STATE_WARNING, 'ERROR: Performance results empty.  Check time drift on source and vCenter server')
+    return statdata
 
 
-def vm_status(vm_moref):
+def vm_status(vm):
     """
     Obtains the overall status from the Virtual Machine
 
-    :param vm_moref: Managed Object Reference for the Virtual Machine
+    :param vm: The Virtual Machine properties, including those listed in counter_props
     """
-    finalOutput = str(vm_moref.overallStatus)
-    extraOutput = '(State: ' + vm_moref.summary.runtime.powerState + ')'
-    print_output_string(finalOutput, 'Virtual Machine Status', 'yellow', 'red', 'gray', extraOutput)
+    finalOutput = str(vm['overallStatus'])
+    extraOutput = '(State: ' + vm['runtime.powerState'] + ')'
+    return format_output_string(finalOutput, 'Virtual Machine Status', 'yellow', 'red', 'gray', extraOutput)
 
 
-def vm_core(vm_moref):
+def vm_core(vm):
     """
     Obtains the core information for Virtual Machine (Notes, Guest, vCPU, Memory)
 
-    :param vm_moref: Managed Object Reference for the Virtual Machine
+    :param vm: The Virtual Machine properties, including those listed in counter_props
     """
-    vmconfig = vm_moref.summary.config
-    if (float(vmconfig.memorySizeMB) / 1024).is_integer():
-        vm_memory = str(vmconfig.memorySizeMB / 1024) + ' GB'
+    memory = vm['summary.config.memorySizeMB']
+    if (float(memory) / 1024).is_integer():
+        vm_memory = str(memory / 1024) + ' GB'
     else:
-        vm_memory = str(vmconfig.memorySizeMB) + ' MB'
-    print("{}, {}, {} vCPU(s), {} Memory".format(vmconfig.annotation, vmconfig.guestFullName,
-                                                 vm_moref.summary.config.numCpu, vm_memory))
-    exit(STATE_OK)
+        vm_memory = str(memory) + ' MB'
+    return STATE_OK, "{}, {}, {} vCPU(s), {} Memory".format(vm['summary.config.annotation'],
+                                                            vm['summary.config.guestFullName'],
+                                                            vm['summary.config.numCpu'], vm_memory)
 
 
-def host_core(host_moref):
+def host_core(host):
     """
     Obtains the core information for ESXi Host (Hardware pCPU info, Memory)
 
-    :param host_moref: Managed Object Reference for the ESXi Host
+    :param host: The ESXi Host properties, including those listed in counter_props
     """
-    hosthardware = host_moref.summary.hardware
-    hostversion = host_moref.config.product
-    print("{}, {}, {} x {} ({} Cores, {} Logical), {:.0f} GB Memory".format(hostversion.fullName, hosthardware.model,
-                                                                            hosthardware.numCpuPkgs,
-                                                                            hosthardware.cpuModel,
-                                                                            hosthardware.numCpuCores,
-                                                                            hosthardware.numCpuThreads,
-                                                                            (hosthardware.memorySize / 1024 / 1024 / 1024)))
-    exit(STATE_OK)
+    return STATE_OK, "{}, {}, {} x {} ({} Cores, {} Logical), {:.0f} GB Memory".format(
+        host['config.product.fullName'], host['summary.hardware.model'], host['summary.hardware.numCpuPkgs'],
+        host['summary.hardware.cpuModel'], host['summary.hardware.numCpuCores'],
+        host['summary.hardware.numCpuThreads'], (host['summary.hardware.memorySize'] / 1024 / 1024 / 1024))
 
 
-def host_cpu_usage(host_moref, warning, critical):
+def host_cpu_usage(host, warning, critical):
     """
     Obtains the current CPU usage of the Host
 
-    :param host_moref: Managed Object Reference for the ESXi Host
+    :param host: The ESXi Host properties, including those listed in counter_props
     """
-    host_cpu = host_moref.summary.quickStats.overallCpuUsage
-    host_total_cpu = host_moref.summary.hardware.cpuMhz * host_moref.summary.hardware.numCpuCores
+    host_cpu = host['summary.quickStats.overallCpuUsage']
+    host_total_cpu = host['summary.hardware.cpuMhz'] * host['summary.hardware.numCpuCores']
     final_output = (host_cpu / host_total_cpu) * 100
-    print_output_float(final_output, 'CPU Usage', warning, critical, '%')
+    return format_output_float(final_output, 'CPU Usage', warning, critical, '%')
 
 
-def host_mem_usage(host_moref, warning, critical):
+def host_mem_usage(host, warning, critical):
     """
     Obtains the current Memory usage of the Host
 
-    :param host_moref: Managed Object Reference for the ESXi Host
+    :param host: The ESXi Host properties, including those listed in counter_props
     """
 
-    host_memory = host_moref.summary.quickStats.overallMemoryUsage
-    host_total_memory = host_moref.summary.hardware.memorySize / 1024 /1024
+    host_memory = host['summary.quickStats.overallMemoryUsage']
+    host_total_memory = host['summary.hardware.memorySize'] / 1024 /1024
     final_output = (host_memory / host_total_memory) * 100
-    print_output_float(final_output, 'Memory Usage', warning, critical, '%')
+    return format_output_float(final_output, 'Memory Usage', warning, critical, '%')
+
+
+def rollup_statdata(entity, perf_results):
+    """
+    Returns the performance values fetched by build_query for each powered on Virtual Machine of a Host or Cluster
+
+    :param entity: The Host or Cluster properties, with its Virtual Machines under 'vms' (see fetch_child_vms)
+    :param perf_results: The dictionary returned by build_query
+    :return: A list of (Virtual Machine properties, performance values) tuples
+    """
+    vms = [(vm, perf_results.get(vm['moref']._moId)) for vm in entity['vms']
+           if vm['runtime.powerState'] == 'poweredOn']
+    if not vms:
+        raise CheckError(STATE_UNKNOWN, 'ERROR: No powered on Virtual Machines found')
+    vms = [(vm, statdata) for vm, statdata in vms if statdata]
+    if not vms:
+        raise CheckError(STATE_WARNING, 'ERROR: Performance results empty.  Check time drift on source and vCenter server')
+    return vms
+
+
+def rollup_cpu_ready(entity, perf_results, warning, critical):
+    """
+    Obtains the worst CPU Ready value of the Virtual Machines of a Host or Cluster, and how many of them
+    are over the warning value
+
+    :param entity: The Host or Cluster properties, with its Virtual Machines under 'vms'
+    :param perf_results: The performance values returned by build_query for the Virtual Machines
+    :param warning: The value to use for the print_output function to calculate whether CPU Ready is warning
+    :param critical: The value to use for the print_output function to calculate whether CPU Ready is critical
+    """
+    vms = rollup_statdata(entity, perf_results)
+    ready = array('d', [statdata['cpu.ready.summation'] / 20000 * 100 for vm, statdata in vms])
+    worst = max(range(len(ready)), key=ready.__getitem__)
+    over = len([value for value in ready if value >= warning])
+    state, output = format_output_float(ready[worst], stat_name('Worst VM CPU Ready', vms[worst][1]), warning, critical,
+                                        '%', '({}, {} of {} VMs over warning)'.format(vms[worst][0]['name'], over,
+                                                                                       len(ready)))
+    return state, output + " 'VMs over warning'={};;;0;{}".format(over, len(ready))
+
 
+def rollup_mem_balloon(entity, perf_results, warning, critical):
+    """
+    Obtains the total Ballooned Memory of the Virtual Machines of a Host or Cluster.  The warning and critical
+    values are percentages of the memory configured for those Virtual Machines.
 
-def cl_status(cl_moref):
+    :param entity: The Host or Cluster properties, with its Virtual Machines under 'vms'
+    :param perf_results: The performance values returned by build_query for the Virtual Machines
+    :param warning: The value to use for the print_output function to calculate whether Ballooned Memory is warning
+    :param critical: The value to use for the print_output function to calculate whether Ballooned Memory is critical
+    """
+    vms = rollup_statdata(entity, perf_results)
+    balloon = array('d', [statdata['mem.vmmemctl.average'] for vm, statdata in vms])
+    # Inaccessible Virtual Machines and those being created have no memory size
+    memory = sum(vm.get('summary.config.memorySizeMB') or 0 for vm, statdata in vms)
+    ballooning = len([value for value in balloon if value > 0])
+    state, output = format_output_float(sum(balloon) / 1024, stat_name('Total VM Memory Balloon', vms[0][1]),
+                                        (warning * memory / 100), (critical * memory / 100), 'MB',
+                                        '({} of {} VMs ballooning)'.format(ballooning, len(balloon)), 0, memory)
+    return state, output + " 'VMs ballooning'={};;;0;{}".format(ballooning, len(balloon))
+
+
+def cl_status(cluster):
     """
     Obtains the overall status for the vSphere Cluster
 
-    :param cl_moref: Managed Object Reference for the vSphere Cluster
+    :param cluster: The Cluster properties, including those listed in counter_props
     """
-    final_output = str(cl_moref.overallStatus)
-    print_output_string(final_output, 'Cluster Status', 'yellow', 'red', 'gray')
+    final_output = str(cluster['overallStatus'])
+    return format_output_string(final_output, 'Cluster Status', 'yellow', 'red', 'gray')
 
 
-def vm_cpu_ready(vm_moref, content, vchtime, perf_dict, warning, critical):
+def vm_cpu_ready(vm, statdata, warning, critical):
     """
     Obtains the CPU Ready value for the Virtual Machine
 
-    :param vm_moref: Managed Object Reference for the Virtual Machine
-    :param content: ServiceInstance Managed Object
-    :param perf_dict: The array containing the performance dictionary (with counters and IDs)
+    :param vm: The Virtual Machine properties, including those listed in counter_props
+    :param statdata: The performance values returned by build_query for the Virtual Machine
     :param warning: The value to use for the print_output function to calculate whether CPU Ready is warning
     :param critical: The value to use for the print_output function to calculate whether CPU Ready is critical
     """
-    counter_key = stat_lookup(perf_dict, 'cpu.ready.summation')
-    statdata = build_query(content, vchtime, counter_key, "", vm_moref)
-    final_output = (statdata / 20000 * 100)
-    print_output_float(final_output, 'CPU Ready', warning, critical, '%')
+    final_output = (statdata['cpu.ready.summation'] / 20000 * 100)
+    return format_output_float(final_output, stat_name('CPU Ready', statdata), warning, critical, '%')
 
 
-def vm_cpu_usage(vm_moref, content, vchtime, perf_dict, warning, critical):
+def vm_cpu_usage(vm, statdata, warning, critical):
     """
     Obtains the CPU Usage value for the Virtual Machine
 
-    :param vm_moref: Managed Object Reference for the Virtual Machine
-    :param content: ServiceInstance Managed Object
-    :param perf_dict: The array containing the performance dictionary (with counters and IDs)
+    :param vm: The Virtual Machine properties, including those listed in counter_props
+    :param statdata: The performance values returned by build_query for the Virtual Machine
     :param warning: The value to use for the print_output function to calculate whether CPU Usage is warning
     :param critical: The value to use for the print_output function to calculate whether CPU Usage is critical
     """
-    counter_key = stat_lookup(perf_dict, 'cpu.usage.average')
-    statdata = build_query(content, vchtime, counter_key, "", vm_moref)
-    final_output = (statdata / 100)
-    print_output_float(final_output, 'CPU Usage', warning, critical, '%')
+    final_output = (statdata['cpu.usage.average'] / 100)
+    return format_output_float(final_output, stat_name('CPU Usage', statdata), warning, critical, '%')
+
+
+def vm_cpu_ready_trend(vm, ring, warning, critical):
+    """
+    Obtains the rise of the CPU Ready value per hour for the Virtual Machine over the last trend_period seconds
+
+    :param vm: The Virtual Machine properties, including those listed in counter_props
+    :param ring: The SampleRing holding the CPU Ready samples
+    :param warning: The value to use for the print_output function to calculate whether the rise is warning
+    :param critical: The value to use for the print_output function to calculate whether the rise is critical
+    """
+    samples = get_trend_samples(ring, vm['moref']._moId, 'cpu.ready.summation')
+    final_output = trend_per_hour([(timestamp, value / 20000 * 100) for timestamp, value in samples])
+    if final_output is None:
+        raise CheckError(STATE_UNKNOWN, 'ERROR: Not enough samples for a trend yet')
+    return format_output_float(final_output, 'CPU Ready Trend', warning, critical, '%/h', '', '', '')
 
 
-def vm_mem_active(vm_moref, content, vchtime, perf_dict, warning, critical):
+def vm_mem_active(vm, statdata, warning, critical):
     """
     Obtains the Active Memory value for the Virtual Machine
 
-    :param vm_moref: Managed Object Reference for the Virtual Machine
-    :param content: ServiceInstance Managed Object
-    :param perf_dict: The array containing the performance dictionary (with counters and IDs)
+    :param vm: The Virtual Machine properties, including those listed in counter_props
+    :param statdata: The performance values returned by build_query for the Virtual Machine
     :param warning: The value to use for the print_output function to calculate whether Active Memory is warning
     :param critical: The value to use for the print_output function to calculate whether Active Memory is critical
     """
-    counter_key = stat_lookup(perf_dict, 'mem.active.average')
-    statdata = build_query(content, vchtime, counter_key, "", vm_moref)
-    final_output = (statdata / 1024)
-    print_output_float(final_output, 'Memory Active', (warning * vm_moref.summary.config.memorySizeMB / 100),
-                      (critical * vm_moref.summary.config.memorySizeMB / 100), 'MB', '', 0, vm_moref.summary.config.memorySizeMB)
+    final_output = (statdata['mem.active.average'] / 1024)
+    memory = vm['summary.config.memorySizeMB']
+    return format_output_float(final_output, stat_name('Memory Active', statdata), (warning * memory / 100),
+                               (critical * memory / 100), 'MB', '', 0, memory)
 
 
-def vm_mem_shared(vm_moref, content, vchtime, perf_dict, warning, critical):
+def vm_mem_shared(vm, statdata, warning, critical):
     """
     Obtains the Shared Memory value for the Virtual Machine
 
-    :param vm_moref: Managed Object Reference for the Virtual Machine
-    :param content: ServiceInstance Managed Object
-    :param perf_dict: The array containing the performance dictionary (with counters and IDs)
+    :param vm: The Virtual Machine properties, including those listed in counter_props
+    :param statdata: The performance values returned by build_query for the Virtual Machine
     :param warning: The value to use for the print_output function to calculate whether Shared Memory is warning
     :param critical: The value to use for the print_output function to calculate whether Shared Memory is critical
     """
-    counter_key = stat_lookup(perf_dict, 'mem.shared.average')
-    statdata = build_query(content, vchtime, counter_key, "", vm_moref)
-    final_output = (statdata / 1024)
-    print_output_float(final_output, 'Memory Shared', (warning * vm_moref.summary.config.memorySizeMB / 100),
-                      (critical * vm_moref.summary.config.memorySizeMB / 100), 'MB', '', 0, vm_moref.summary.config.memorySizeMB)
+    final_output = (statdata['mem.shared.average'] / 1024)
+    memory = vm['summary.config.memorySizeMB']
+    return format_output_float(final_output, stat_name('Memory Shared', statdata), (warning * memory / 100),
+                               (critical * memory / 100), 'MB', '', 0, memory)
 
 
-def vm_mem_balloon(vm_moref, content, vchtime, perf_dict, warning, critical):
+def vm_mem_balloon(vm, statdata, warning, critical):
     """
     Obtains the Ballooned Memory value for the Virtual Machine
 
-    :param vm_moref: Managed Object Reference for the Virtual Machine
-    :param content: ServiceInstance Managed Object
-    :param perf_dict: The array containing the performance dictionary (with counters and IDs)
+    :param vm: The Virtual Machine properties, including those listed in counter_props
+    :param statdata: The performance values returned by build_query for the Virtual Machine
     :param warning: The value to use for the print_output function to calculate whether Ballooned Memory is warning
     :param critical: The value to use for the print_output function to calculate whether Ballooned Memory is critical
     """
-    counter_key = stat_lookup(perf_dict, 'mem.vmmemctl.average')
-    statdata = build_query(content, vchtime, counter_key, "", vm_moref)
-    final_output = (statdata / 1024)
-    print_output_float(final_output, 'Memory Balloon', (warning * vm_moref.summary.config.memorySizeMB / 100),
-                      (critical * vm_moref.summary.config.memorySizeMB / 100), 'MB', '', 0, vm_moref.summary.config.memorySizeMB)
+    final_output = (statdata['mem.vmmemctl.average'] / 1024)
+    memory = vm['summary.config.memorySizeMB']
+    return format_output_float(final_output, stat_name('Memory Balloon', statdata), (warning * memory / 100),
+                               (critical * memory / 100), 'MB', '', 0, memory)
 
 
-def vm_ds_io(vm_moref, content, vchtime, perf_dict, warning, critical):
+def vm_ds_io(vm, statdata, warning, critical):
     """
     Obtains the Read, Write and Total Virtual Machine Datastore IOPS values.
     Uses the Total IOPS value to calculate status.
 
-    :param vm_moref: Managed Object Reference for the Virtual Machine
-    :param content: ServiceInstance Managed Object
-    :param perf_dict: The array containing the performance dictionary (with counters and IDs)
+    :param vm: The Virtual Machine properties, including those listed in counter_props
+    :param statdata: The performance values returned by build_query for the Virtual Machine
     :param warning: The value to use for the print_output function to calculate whether IOPS are warning
     :param critical: The value to use for the print_output function to calculate whether IOPS are critical
     """
-    counter_key_read = stat_lookup(perf_dict, 'datastore.numberReadAveraged.average')
-    counter_key_write = stat_lookup(perf_dict, 'datastore.numberWriteAveraged.average')
-    statdata_read = build_query(content, vchtime, counter_key_read, "*", vm_moref)
-    statdata_write = build_query(content, vchtime, counter_key_write, "*", vm_moref)
+    statdata_read = statdata['datastore.numberReadAveraged.average']
+    statdata_write = statdata['datastore.numberWriteAveraged.average']
     statdata_total = statdata_read + statdata_write
-    print_output_float(statdata_total, 'Datastore IOPS', warning, critical, 'IOPS', '', 0, 5000)
+    statName = stat_name('Datastore IOPS', statdata)
+    return add_instance_perfdata(format_output_float(statdata_total, statName, warning, critical, 'IOPS', '', 0, 5000),
+                                 statdata, statName, 'IOPS', ['datastore.numberReadAveraged.average',
+                                                              'datastore.numberWriteAveraged.average'])
 
 
-def vm_ds_latency(vm_moref, content, vchtime, perf_dict, warning, critical):
+def vm_ds_latency(vm, statdata, warning, critical):
     """
     Obtains the Read, Write and Total Virtual Machine Datastore Latency values.
     Uses the Total IOPS value to calculate status.
 
-    :param vm_moref: Managed Object Reference for the Virtual Machine
-    :param content: ServiceInstance Managed Object
-    :param perf_dict: The array containing the performance dictionary (with counters and IDs)
+    :param vm: The Virtual Machine properties, including those listed in counter_props
+    :param statdata: The performance values returned by build_query for the Virtual Machine
     :param warning: The value to use for the print_output function to calculate whether Latency is warning
     :param critical: The value to use for the print_output function to calculate whether Latency is critical
     """
-    counter_key_read = stat_lookup(perf_dict, 'datastore.totalReadLatency.average')
-    counter_key_write = stat_lookup(perf_dict, 'datastore.totalWriteLatency.average')
-    statdata_read = build_query(content, vchtime, counter_key_read, "*", vm_moref)
-    statdata_write = build_query(content, vchtime, counter_key_write, "*", vm_moref)
-    statdata_total = statdata_read + statdata_write
-    print_output_float(statdata_total, 'Datastore Latency', warning, critical, 'ms', '', 0, 100)
+    counter_names = ['datastore.totalReadLatency.average', 'datastore.totalWriteLatency.average']
+    instances = statdata.get('instances', {})
+    names = set(instance for counter_name in counter_names for instance in instances.get(counter_name, {}))
+    if names:
+        # The latency of each datastore is its read plus its write latency, the worst datastore by default.  The
+        # read latency of one datastore and the write latency of another do not add up to that of any datastore.
+        statdata_total = aggregate_values([sum(instances.get(counter_name, {}).get(instance, 0)
+                                               for counter_name in counter_names) for instance in sorted(names)],
+                                          statdata.get('aggregate') or counter_aggregate[counter_names[0]])
+    else:
+        statdata_total = statdata[counter_names[0]] + statdata[counter_names[1]]
+    statName = stat_name('Datastore Latency', statdata)
+    return add_instance_perfdata(format_output_float(statdata_total, statName, warning, critical, 'ms', '', 0, 100),
+                                 statdata, statName, 'ms', counter_names)
 
 
-def vm_net_usage(vm_moref, content, vchtime, perf_dict, warning, critical):
+def vm_net_usage(vm, statdata, warning, critical):
     """
     Obtains the Tx and Rx Virtual Machine Network Usage values.
     Uses the Total Network Usage value to calculate status.
 
-    :param vm_moref: Managed Object Reference for the Virtual Machine
-    :param content: ServiceInstance Managed Object
-    :param perf_dict: The array containing the performance dictionary (with counters and IDs)
+    :param vm: The Virtual Machine properties, including those listed in counter_props
+    :param statdata: The performance values returned by build_query for the Virtual Machine
     :param warning: The value to use for the print_output function to calculate whether Network Usage is warning
     :param critical: The value to use for the print_output function to calculate whether Network Usage is critical
     """
-    counter_key_read = stat_lookup(perf_dict, 'net.received.average')
-    counter_key_write = stat_lookup(perf_dict, 'net.transmitted.average')
-    statdata_rx = build_query(content, vchtime, counter_key_read, "", vm_moref)
-    statdata_tx = build_query(content, vchtime, counter_key_write, "", vm_moref)
+    statdata_rx = statdata['net.received.average']
+    statdata_tx = statdata['net.transmitted.average']
     statdata_total = (statdata_rx + statdata_tx) * 8 / 1024
-    print_output_float(statdata_total, 'Network Usage', warning, critical, 'Mbps', '', 0, 1000)
+    statName = stat_name('Network Usage', statdata)
+    return add_instance_perfdata(format_output_float(statdata_total, statName, warning, critical, 'Mbps', '', 0, 1000),
+                                 statdata, statName, 'Mbps', ['net.received.average', 'net.transmitted.average'],
+                                 8 / 1024)
 
 
-def ds_space(ds_moref, warning, critical):
+def add_instance_perfdata(result, statdata, statName, suffix, counter_names, scale=1):
+    """
+    Adds a perfdata field for every instance of the counters (e.g. each datastore or vNIC) to the output of a check.
+    The value of an instance is the sum of its values for each counter, like the total in the output.
+
+    :param result: The tuple of the Icinga state and output line returned by format_output_float
+    :param statdata: The performance values returned by build_query for the entity
+    :param statName: The friendly name for the performance statistic, the instance name is appended to it
+    :param suffix: The performance value suffix (e.g. ms, IOPS)
+    :param counter_names: The performance counters added up for each instance
+    :param scale: The factor to convert the counter values to the suffix
+    """
+    instances = statdata.get('instances', {})
+    names = sorted(set(instance for counter_name in counter_names for instance in instances.get(counter_name, {})))
+    if not names:
+        return result
+    state, output = result
+    fields = ["'{} {}'={:.1f}{}".format(statName, instance,
+                                        sum(instances.get(counter_name, {}).get(instance, 0)
+                                            for counter_name in counter_names) * scale, suffix)
+              for instance in names]
+    return state, output + ' ' + ' '.join(fields)
+
+
+def ds_space(datastore, warning, critical):
     """
     Obtains the Datastore space information
-    :param ds_moref: Managed Object Reference for the Datastore
+    :param datastore: The Datastore properties, including those listed in counter_props
     :param warning: The value to use for the print_output function to calculate whether Datastore space is warning
     :param critical: The value to use for the print_output function to calculate whether Datastore space is critical
     """
-    datastore_capacity = float(ds_moref.summary.capacity / 1024 / 1024 / 1024)
-    datastore_free = float(ds_moref.summary.freeSpace / 1024 / 1024 / 1024)
+    datastore_capacity = float(datastore['summary.capacity'] / 1024 / 1024 / 1024)
+    datastore_free = float(datastore['summary.freeSpace'] / 1024 / 1024 / 1024)
     datastore_used_pct = ((1 - (datastore_free / datastore_capacity)) * 100)
     extraOutput = "(Used {:.1f} GB of {:.1f} GB)".format((datastore_used_pct * datastore_capacity / 100),
                                                          datastore_capacity)
-    print_output_float(datastore_used_pct, 'Datastore Used Space', warning, critical, '%', extraOutput)
+    return format_output_float(datastore_used_pct, 'Datastore Used Space', warning, critical, '%', extraOutput)
+
+
+def ds_space_growth(datastore, ring, warning, critical):
+    """
+    Obtains the growth of the used Datastore space per hour over the last trend_period seconds.
+    The used space is added to the sample ring on every check, so the trend builds up as the check runs.
+
+    :param datastore: The Datastore properties, including those listed in counter_props
+    :param ring: The SampleRing holding the earlier used space values
+    :param warning: The value to use for the print_output function to calculate whether the growth is warning
+    :param critical: The value to use for the print_output function to calculate whether the growth is critical
+    """
+    if ring is None:
+        raise CheckError(STATE_UNKNOWN, 'ERROR: Trend counters need the sample ring, use --sample-ring')
+    datastore_used = float((datastore['summary.capacity'] - datastore['summary.freeSpace']) / 1024 / 1024 / 1024)
+    ring.add(SampleRing.key(datastore['moref']._moId, 'space.used'), [(int(time.time()), datastore_used)])
+    growth = trend_per_hour(get_trend_samples(ring, datastore['moref']._moId, 'space.used'))
+    if growth is None:
+        raise CheckError(STATE_UNKNOWN, 'ERROR: Not enough samples for a trend yet')
+    return format_output_float(growth, 'Datastore Growth', warning, critical, 'GB/h', '', '', '')
 
 
-def ds_status(ds_moref):
+def ds_status(datastore):
     """
     Obtains the overall status for the Datastore
 
-    :param ds_moref: Managed Object Reference for the Datastore
+    :param datastore: The Datastore properties, including those listed in counter_props
     """
-    final_output = str(ds_moref.overallStatus)
-    extraOutput = '(Type: ' + ds_moref.summary.type + ')'
-    print_output_string(final_output, 'Datastore Status', 'yellow', 'red', 'gray', extraOutput)
+    final_output = str(datastore['overallStatus'])
+    extraOutput = '(Type: ' + datastore['summary.type'] + ')'
+    return format_output_string(final_output, 'Datastore Status', 'yellow', 'red', 'gray', extraOutput)
 
 
 def stat_lookup(perf_dict, counter_name):
@@ -329,7 +1183,7 @@ def stat_lookup(perf_dict, counter_name):
     return counter_key
 
 
-def get_properties(content, viewType, props, specType):
+def get_properties(content, viewType, props, specType, container=None):
     """
     Obtains a list of specific properties for a particular Managed Object Reference data object.
 
@@ -337,39 +1191,317 @@ def get_properties(content, viewType, props, specType):
     :param viewType: Type of Managed Object Reference that should populate the View
     :param props: A list of properties that should be retrieved for the entity
     :param specType: Type of Managed Object Reference that should be used for the Property Specification
+    :param container: Optional Folder, Datacenter or Cluster to build the View from (default: the root folder)
     :return:
     """
+    objView, pfSpec = build_view_spec(content, viewType, props, specType, container)
+    gpOutput = retrieve_properties(content, pfSpec)
+    objView.Destroy()
+    return gpOutput
+
+
+def build_view_spec(content, viewType, props, specType, container=None):
+    """
+    Builds a Container View and the Filter Specification that retrieves properties for every object in it
+
+    :return: A tuple of the View (which must be destroyed by the caller) and the Filter Specification
+    """
     # Get the View based on the viewType
-    objView = content.viewManager.CreateContainerView(content.rootFolder, viewType, True)
+    objView = content.viewManager.CreateContainerView(container or content.rootFolder, viewType, True)
     # Build the Filter Specification
     tSpec = vim.PropertyCollector.TraversalSpec(name='tSpecName', path='view', skip=False, type=vim.view.ContainerView)
     pSpec = vim.PropertyCollector.PropertySpec(all=False, pathSet=props, type=specType)
     oSpec = vim.PropertyCollector.ObjectSpec(obj=objView, selectSet=[tSpec], skip=False)
     pfSpec = vim.PropertyCollector.FilterSpec(objectSet=[oSpec], propSet=[pSpec], reportMissingObjectsInResults=False)
+    return objView, pfSpec
+
+
+def get_object_properties(content, morefs, props, specType):
+    """
+    Obtains a list of specific properties for the supplied Managed Object References only, without building a View.
+
+    :param content: ServiceInstance Managed Object
+    :param morefs: A list of Managed Object References to retrieve the properties for
+    :param props: A list of properties that should be retrieved for the entities
+    :param specType: Type of Managed Object Reference that should be used for the Property Specification
+    """
+    pSpec = vim.PropertyCollector.PropertySpec(all=False, pathSet=props, type=specType)
+    oSpecs = [vim.PropertyCollector.ObjectSpec(obj=moref, skip=False) for moref in morefs]
+    pfSpec = vim.PropertyCollector.FilterSpec(objectSet=oSpecs, propSet=[pSpec], reportMissingObjectsInResults=False)
+    return retrieve_properties(content, pfSpec)
+
+
+def retrieve_properties(content, pfSpec):
+    """
+    Retrieves the properties described by a Filter Specification and turns them into a list of dictionaries,
+    one per Managed Object with the Managed Object Reference stored under 'moref'.
+
+    :param content: ServiceInstance Managed Object
+    :param pfSpec: The Property Collector Filter Specification
+    """
+    return list(iter_properties(content, pfSpec))
+
+
+def iter_properties(content, pfSpec):
+    """
+    Generator version of retrieve_properties that fetches one page of results at a time.  If the caller stops
+    early the remaining pages are cancelled on the server.
+
+    :param content: ServiceInstance Managed Object
+    :param pfSpec: The Property Collector Filter Specification
+    """
     retOptions = vim.PropertyCollector.RetrieveOptions()
+    # Properties that are not set are left out of the results, they are returned as None instead
+    paths = [prop_path for propSpec in pfSpec.propSet for prop_path in propSpec.pathSet or []]
     # Retrieve the properties and look for a token coming back with each RetrievePropertiesEx call
     # If the token is present it indicates there are more items to be returned.
-    totalProps = []
     retProps = content.propertyCollector.RetrievePropertiesEx(specSet=[pfSpec], options=retOptions)
-    totalProps += retProps.objects
-    while retProps.token:
-        retProps = content.propertyCollector.ContinueRetrievePropertiesEx(token=retProps.token)
-        totalProps += retProps.objects
-    objView.Destroy()
-    # Turn the output in totalProps into a usable dictionary of values
-    gpOutput = []
-    for eachProp in totalProps:
-        propDic = {}
-        for prop in eachProp.propSet:
-            propDic[prop.name] = prop.val
-        propDic['moref'] = eachProp.obj
-        gpOutput.append(propDic)
-    return gpOutput
+    try:
+        while retProps:
+            # Turn the output into a usable dictionary of values
+            for eachProp in retProps.objects:
+                propDic = dict.fromkeys(paths)
+                for prop in eachProp.propSet:
+                    propDic[prop.name] = prop.val
+                propDic['moref'] = eachProp.obj
+                yield propDic
+            if not retProps.token:
+                break
+            retProps = content.propertyCollector.ContinueRetrievePropertiesEx(token=retProps.token)
+    finally:
+        if retProps and retProps.token:
+            try:
+                content.propertyCollector.CancelRetrievePropertiesEx(token=retProps.token)
+            except vmodl.MethodFault:
+                pass
+
+
+def split_entity_names(entity):
+    """
+    Splits the entities supplied on the command line into plain names and wildcard patterns
 
+    :param entity: Comma separated list of entity names or patterns
+    :return: A tuple of the list of names and the list of patterns
+    """
+    names = []
+    patterns = []
+    for pattern in entity.split(','):
+        if any(char in pattern for char in '*?['):
+            patterns.append(pattern)
+        elif pattern not in names:
+            names.append(pattern)
+    return names, patterns
 
-def print_output_float(finalOutput, statName, warnValue, critValue, suffix, extraOutput='', min_value=0, max_value=100):
+
+def get_instance_key(content, args):
+    """
+    Returns a short key identifying the vCenter (or ESXi host) connected to, for use in cache file names.
+    The key is based on the vCenter instance UUID, or the host and port where there is none.
+
+    :param content: ServiceInstance Managed Object
+    :param args: The parsed command-line arguments
+    """
+    instance = content.about.instanceUuid or '{}:{}'.format(args.host, args.port)
+    return hashlib.sha256(instance.encode('utf-8')).hexdigest()[:16]
+
+
+def get_clock_file(content, args):
+    """
+    Returns the name of the file holding the offset between the local clock and the clock of the vCenter
+    """
+    return path.join(private_dir(clock_dir), 'pyvinga_clock_{}.json'.format(get_instance_key(content, args)))
+
+
+def get_vcenter_time(si, clock_file):
+    """
+    Returns the vCenter date and time, derived from the local clock and the offset between the two clocks.
+    The offset is kept in clock_file and only measured with CurrentTime again once it is older than clock_ttl
+    seconds, so most checks save that round trip.
+
+    :param si: The ServiceInstance Managed Object
+    :param clock_file: The file name returned by get_clock_file
+    :return: The vCenter date and time as a timezone aware datetime
+    """
+    try:
+        with open(clock_file) as f:
+            clock = json.load(f)
+    except (IOError, OSError, ValueError):
+        clock = None
+    now = time.time()
+    if clock and 0 <= now - clock['measured'] < clock_ttl:
+        return datetime.fromtimestamp(now + clock['offset'], timezone.utc)
+    vchtime = si.CurrentTime()
+    # The vCenter clock is read half way through the round trip
+    offset = epoch_seconds(vchtime) + vchtime.microsecond / 1000000.0 - (now + time.time()) / 2
+    write_file_atomic(clock_file, json.dumps({'offset': offset, 'measured': now}), 0o644)
+    return vchtime
+
+
+def get_index_file(content, args, specType):
+    """
+    Returns the name of the entity index file for the vCenter (or ESXi host) and entity type
+
+    :param content: ServiceInstance Managed Object
+    :param args: The parsed command-line arguments
+    :param specType: Type of Managed Object Reference held in the index
+    """
+    return path.join(private_dir(index_dir), 'pyvinga_index_{}_{}.json'.format(get_instance_key(content, args),
+                                                                              specType.__name__.split('.')[-1]))
+
+
+def read_index(index_file):
     """
-    Prints the formatted output for Icinga based on supplied warning and critical values.
+    Reads an entity index file.  The index holds the time of the last full inventory listing ('built')
+    and a list of [name, moref ID] pairs ('entities').
+
+    :param index_file: The file name returned by get_index_file
+    :return: The index, or None if there is no usable index
+    """
+    try:
+        with open(index_file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def find_entities(content, args, viewType, props, specType, mirror=None):
+    """
+    Finds the entities matching the names or patterns supplied on the command line and obtains their properties.
+
+    Names are resolved through a local index of name to Managed Object Reference.  Names missing from the index
+    are looked up on the server (lookup_entities) and added to it.  Patterns are matched against the index while
+    it is younger than --index-ttl seconds, after which it is rebuilt from a full inventory listing.
+    With --container the index is not used and the lookup is limited to that part of the inventory.
+    Inside the pyvinga daemon the entities are taken from its InventoryMirror instead, once it is in sync.
+
+    :param content: ServiceInstance Managed Object
+    :param args: The parsed command-line arguments
+    :param viewType: Type of Managed Object Reference that should populate the View
+    :param props: A list of properties that should be retrieved for the entity, including 'name'
+    :param specType: Type of Managed Object Reference that should be used for the Property Specification
+    :param mirror: An InventoryMirror holding the properties of the inventory, or None
+    :return: A list of property dictionaries as returned by get_properties
+    """
+    if mirror and not args.container:
+        entity_props = mirror.find(specType, args.entity, props)
+        if entity_props is not None:
+            return entity_props
+
+    names, patterns = split_entity_names(args.entity)
+    if args.container:
+        container = content.searchIndex.FindByInventoryPath(inventoryPath=args.container)
+        if not container:
+            raise CheckError(STATE_UNKNOWN, 'ERROR: Container {} not found'.format(args.container))
+        if patterns:
+            return match_entities(get_properties(content, viewType, props, specType, container), args.entity)
+        return lookup_entities(content, args, viewType, props, specType, names, container)
+
+    if args.index_ttl <= 0:
+        if patterns:
+            return match_entities(get_properties(content, viewType, props, specType), args.entity)
+        return lookup_entities(content, args, viewType, props, specType, names)
+
+    index_file = get_index_file(content, args, specType)
+    index = read_index(index_file)
+    # Every entity taken from the index is checked on the server, so names can use an index of any age
+    if index and (not patterns or index['built'] > time.time() - args.index_ttl):
+        entity_props = index_entities(content, index, args.entity, names, props, specType)
+        if entity_props is not None:
+            return entity_props
+
+    if patterns:
+        # Rebuild the index from the full inventory
+        entity_props = get_properties(content, viewType, props, specType)
+        index = {'built': time.time(), 'entities': [[prop['name'], prop['moref']._moId] for prop in entity_props]}
+        write_file_atomic(index_file, json.dumps(index))
+        return match_entities(entity_props, args.entity)
+
+    entity_props = lookup_entities(content, args, viewType, props, specType, names)
+    if entity_props:
+        # Remember the entities found so the next check can go straight to them
+        if not index:
+            index = {'built': 0, 'entities': []}
+        found = dict((prop['name'], prop['moref']._moId) for prop in entity_props)
+        # An entity found under a new name replaces the entry for its old name
+        moids = set(found.values())
+        index['entities'] = [entry for entry in index['entities']
+                             if entry[0] not in found and entry[1] not in moids] + \
+            [[name, moid] for name, moid in found.items()]
+        write_file_atomic(index_file, json.dumps(index))
+    return entity_props
+
+
+def index_entities(content, index, entity, names, props, specType):
+    """
+    Obtains the properties for the entities in the index matching the names or patterns supplied on the command line
+
+    :return: A list of property dictionaries, or None if a name is missing from the index or an entity
+    no longer exists under its indexed name
+    """
+    matched = match_entities([{'name': name, 'moref': moid} for name, moid in index['entities']], entity)
+    if not matched or not all(name in [entry['name'] for entry in matched] for name in names):
+        return None
+    stub = content.propertyCollector._GetStub()
+    morefs = [specType(entry['moref'], stub) for entry in matched]
+    try:
+        entity_props = get_object_properties(content, morefs, props, specType)
+    except vmodl.fault.ManagedObjectNotFound:
+        return None
+    by_moid = dict((prop['moref']._moId, prop) for prop in entity_props)
+    if not all(entry['moref'] in by_moid and by_moid[entry['moref']].get('name') == entry['name']
+               for entry in matched):
+        return None
+    return [by_moid[entry['moref']] for entry in matched]
+
+
+def lookup_entities(content, args, viewType, props, specType, names, container=None):
+    """
+    Looks up entities by name on the server without listing the whole inventory.  With --container each name is
+    first tried as an inventory path below the container through the SearchIndex.  Any names still missing are
+    found with a single View scan that stops as soon as they have all been seen.
+
+    :param content: ServiceInstance Managed Object
+    :param args: The parsed command-line arguments
+    :param viewType: Type of Managed Object Reference that should populate the View
+    :param props: A list of properties that should be retrieved for the entity, including 'name'
+    :param specType: Type of Managed Object Reference that should be used for the Property Specification
+    :param names: The entity names to look up
+    :param container: Optional Folder, Datacenter or Cluster to limit the lookup to
+    :return: A list of property dictionaries as returned by get_properties, in the order of names
+    """
+    found = {}
+    morefs = []
+    if container:
+        for name in names:
+            moref = content.searchIndex.FindByInventoryPath(
+                inventoryPath=args.container + '/' + name.replace('%', '%25').replace('/', '%2f'))
+            if moref and isinstance(moref, specType):
+                morefs.append(moref)
+    if morefs:
+        for prop in get_object_properties(content, morefs, props, specType):
+            if prop.get('name') in names:
+                found.setdefault(prop['name'], prop)
+
+    remaining = set(name for name in names if name not in found)
+    if remaining:
+        objView, pfSpec = build_view_spec(content, viewType, props, specType, container)
+        results = iter_properties(content, pfSpec)
+        try:
+            for prop in results:
+                if prop['name'] in remaining:
+                    found[prop['name']] = prop
+                    remaining.discard(prop['name'])
+                    if not remaining:
+                        break
+        finally:
+            results.close()
+            objView.Destroy()
+    return [found[name] for name in names if name in found]
+
+
+def format_output_float(finalOutput, statName, warnValue, critValue, suffix, extraOutput='', min_value=0, max_value=100):
+    """
+    Formats the output for Icinga based on supplied warning and critical values.
     Used for functions where a float is supplied for comparison.
 
     :param finalOutput: The final calculated performance value for the counter
@@ -378,27 +1510,25 @@ def print_output_float(finalOutput, statName, warnValue, critValue, suffix, extr
     :param critValue: The value used to calculate the critical threshold for status change
     :param suffix: The performance value suffix (e.g. MB, GB, %)
     :param extraOutput: Any additional output that is displayed after the core performance information
+    :return: A tuple of the Icinga state and the output line
     """
     if finalOutput >= critValue:
-        print("{0} - {1} is {2:.1f}{3} {4} | '{1}'={2:.1f}{3};{5};{6}".format(state_tuple[STATE_CRITICAL], statName,
-                                                                              finalOutput, suffix, extraOutput,
-                                                                              warnValue, critValue, min_value, max_value))
-        exit(STATE_CRITICAL)
+        return STATE_CRITICAL, "{0} - {1} is {2:.1f}{3} {4} | '{1}'={2:.1f}{3};{5};{6}".format(
+            state_tuple[STATE_CRITICAL], statName, finalOutput, suffix, extraOutput, warnValue, critValue, min_value,
+            max_value)
     elif finalOutput >= warnValue:
-        print("{0} - {1} is {2:.1f}{3} {4} | '{1}'={2:.1f}{3};{5};{6}".format(state_tuple[STATE_WARNING], statName,
-                                                                              finalOutput, suffix, extraOutput,
-                                                                              warnValue, critValue, min_value, max_value))
-        exit(STATE_WARNING)
+        return STATE_WARNING, "{0} - {1} is {2:.1f}{3} {4} | '{1}'={2:.1f}{3};{5};{6}".format(
+            state_tuple[STATE_WARNING], statName, finalOutput, suffix, extraOutput, warnValue, critValue, min_value,
+            max_value)
     else:
-        print("{0} - {1} is {2:.1f}{3} {4} | '{1}'={2:.1f}{3};{5};{6};{7};{8}".format(state_tuple[STATE_OK], statName,
-                                                                              finalOutput, suffix, extraOutput,
-                                                                              warnValue, critValue, min_value, max_value))
-        exit(STATE_OK)
+        return STATE_OK, "{0} - {1} is {2:.1f}{3} {4} | '{1}'={2:.1f}{3};{5};{6};{7};{8}".format(
+            state_tuple[STATE_OK], statName, finalOutput, suffix, extraOutput, warnValue, critValue, min_value,
+            max_value)
 
 
-def print_output_string(finalOutput, statName, warnValue, critValue, unkValue, extraOutput=''):
+def format_output_string(finalOutput, statName, warnValue, critValue, unkValue, extraOutput=''):
     """
-    Prints the formatted output for Icinga based on supplied warning and critical values.
+    Formats the output for Icinga based on supplied warning and critical values.
     Used for functions where a text string is supplied for comparison.
 
     :param finalOutput: The final calculated performance value for the counter
@@ -407,35 +1537,63 @@ def print_output_string(finalOutput, statName, warnValue, critValue, unkValue, e
     :param critValue: The text string used to calculate the critical threshold for status change
     :param unkValue: The text string used to calculate the unknown threshold for status change
     :param extraOutput: Any additional output that is displayed after the core performance information
+    :return: A tuple of the Icinga state and the output line
     """
     if finalOutput == critValue:
-        print("{} - {} is {} {}".format(state_tuple[STATE_CRITICAL], statName, finalOutput, extraOutput))
-        exit(STATE_CRITICAL)
+        return STATE_CRITICAL, "{} - {} is {} {}".format(state_tuple[STATE_CRITICAL], statName, finalOutput, extraOutput)
     elif finalOutput == warnValue:
-        print("{} - {} is {} {}".format(state_tuple[STATE_WARNING], statName, finalOutput, extraOutput))
-        exit(STATE_WARNING)
+        return STATE_WARNING, "{} - {} is {} {}".format(state_tuple[STATE_WARNING], statName, finalOutput, extraOutput)
     elif finalOutput == unkValue:
-        print("{} - {} is {} {}".format(state_tuple[STATE_UNKNOWN], statName, finalOutput, extraOutput))
-        exit(STATE_WARNING)
+        # An unknown status is reported with the UNKNOWN text but a WARNING return code
+        return STATE_WARNING, "{} - {} is {} {}".format(state_tuple[STATE_UNKNOWN], statName, finalOutput, extraOutput)
     else:
-        print("{} - {} is {} {}".format(state_tuple[STATE_OK], statName, finalOutput, extraOutput))
-        exit(STATE_OK)
+        return STATE_OK, "{} - {} is {} {}".format(state_tuple[STATE_OK], statName, finalOutput, extraOutput)
 
 
-def create_perf_dictionary(content):
+def print_output_float(finalOutput, statName, warnValue, critValue, suffix, extraOutput='', min_value=0, max_value=100):
+    """
+    Prints the formatted output for Icinga based on supplied warning and critical values and exits with the
+    matching return code.  See format_output_float for the parameters.
+    """
+    state, output = format_output_float(finalOutput, statName, warnValue, critValue, suffix, extraOutput, min_value,
+                                        max_value)
+    print(output)
+    exit(state)
+
+
+def print_output_string(finalOutput, statName, warnValue, critValue, unkValue, extraOutput=''):
     """
-    Checks whether the connection is to an ESXi host or vCenter and calls the write_perf_dictionary
-    function with the relevant file name.
+    Prints the formatted output for Icinga based on supplied warning and critical values and exits with the
+    matching return code.  See format_output_string for the parameters.
+    """
+    state, output = format_output_string(finalOutput, statName, warnValue, critValue, unkValue, extraOutput)
+    print(output)
+    exit(state)
+
+
+class PerfDictionary(dict):
+    """
+    The performance dictionary (counter name to counter ID) of one vCenter.  Only the counters collected at
+    statistics levels up to 'level' have been fetched, resolve_perf_counters fetches the higher levels.
+    """
+    def __init__(self, counters, file_perf_dic, level):
+        dict.__init__(self, counters)
+        self.file_perf_dic = file_perf_dic
+        self.level = level
+        self.lock = threading.Lock()
+
+
+def create_perf_dictionary(content, args):
+    """
+    Calls the write_perf_dictionary function with the file name for the vCenter (or ESXi host) connected to.
+    Every vCenter has its own file, counter IDs are not the same on different vCenters.
 
     :param content: ServiceInstance Managed Object
+    :param args: The parsed command-line arguments
     """
-    if content.about.name == 'VMware vCenter Server':
-        perf_dict = write_perf_dictionary(content, '/tmp/vcenter_perfdic.txt')
-        # perf_dict = write_perf_dictionary(content, 'c:\\temp\\vcenter_perfdic.txt')
-    elif content.about.name == 'VMware ESXi':
-        perf_dict = write_perf_dictionary(content, '/tmp/host_perfdic.txt')
-        # perf_dict = write_perf_dictionary(content, 'c:\\temp\\host_perfdic.txt')
-    return perf_dict
+    file_perf_dic = path.join(private_dir(perf_dict_dir),
+                              'pyvinga_perfdic_{}.json'.format(get_instance_key(content, args)))
+    return write_perf_dictionary(content, file_perf_dic)
 
 
 def write_perf_dictionary(content, file_perf_dic):
@@ -444,46 +1602,1498 @@ def write_perf_dictionary(content, file_perf_dic):
     This dictionary is read into the array and used in the functions that require perf_dict.
     NOTE: This is faster than doing a lookup live with a ServiceInstance Managed Object for every performance query.
 
+    The file is written to a temporary file and renamed into place, so it can always be read without locking.
+    Only one process rebuilds it, holding a lock on file_perf_dic + '.lock'.  Other processes keep using the
+    old dictionary while the rebuild runs, or wait for it if there is none yet.
+
     :param content: ServiceInstance Managed Object
-    :param file_perf_dic: file name supplied by calling function (based on ESXi or vCenter connection)
+    :param file_perf_dic: file name supplied by calling function (based on the vCenter connected to)
     :return:
     """
-    if not path.exists(file_perf_dic) or datetime.fromtimestamp(path.getmtime(file_perf_dic)) < (datetime.now() - timedelta(days=7)):
-        # Get all the vCenter performance counters
-        perf_dict = {}
-        perfList = content.perfManager.perfCounter
-        f = open(file_perf_dic, mode='w')
-        for counter in perfList:
-            counter_full = "{}.{}.{}".format(counter.groupInfo.key, counter.nameInfo.key, counter.rollupType)
-            perf_dict[counter_full] = counter.key
-            f.write(counter_full + ',' + str(perf_dict[counter_full]) + '\n')
-        f.close()
-    else:
-        perf_dict = {}
-        f = open(file_perf_dic, mode='r')
-        for line in f:
-            perf_dict[line.split(',')[0]] = int(line.split(',')[1])
-        f.close()
+    perf_dict = read_perf_dictionary(file_perf_dic)
+    if perf_dict is not None and not perf_dictionary_expired(file_perf_dic):
+        return perf_dict
+
+    lock_fd = os.open(file_perf_dic + '.lock', os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | (fcntl.LOCK_NB if perf_dict is not None else 0))
+        except (IOError, OSError):
+            # Another process is already rebuilding the dictionary
+            return perf_dict
+        # The dictionary may have been rebuilt while waiting for the lock
+        if path.exists(file_perf_dic) and not perf_dictionary_expired(file_perf_dic):
+            perf_dict = read_perf_dictionary(file_perf_dic)
+            if perf_dict is not None:
+                return perf_dict
+        # Get the vCenter performance counters up to perf_dict_level, others are fetched when first used
+        perf_dict = PerfDictionary(fetch_perf_counters(content, perf_dict_level), file_perf_dic, perf_dict_level)
+        save_perf_dictionary(perf_dict)
+    finally:
+        os.close(lock_fd)
     return perf_dict
 
 
+def read_perf_dictionary(file_perf_dic):
+    """
+    Reads a performance dictionary file written by write_perf_dictionary
+
+    :param file_perf_dic: The performance dictionary file
+    :return: The PerfDictionary, or None if there is no usable file
+    """
+    try:
+        with open(file_perf_dic) as f:
+            data = json.load(f)
+        return PerfDictionary(data['counters'], file_perf_dic, data['level'])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_perf_dictionary(perf_dict):
+    """
+    Writes the performance dictionary to its file
+    """
+    data = {'level': perf_dict.level, 'counters': dict(perf_dict)}
+    write_file_atomic(perf_dict.file_perf_dic, json.dumps(data, separators=(',', ':')), 0o644)
+
+
+def fetch_perf_counters(content, level):
+    """
+    Obtains the performance counters collected at the supplied statistics level and below.
+    This is much smaller than the full perfManager.perfCounter list at the lower levels.
+
+    :param content: ServiceInstance Managed Object
+    :param level: The statistics collection level (1 to 4)
+    :return: A dictionary of counter name to counter ID
+    """
+    counters = {}
+    for counter in content.perfManager.QueryPerfCounterByLevel(level=level):
+        counter_full = "{}.{}.{}".format(counter.groupInfo.key, counter.nameInfo.key, counter.rollupType)
+        counters[counter_full] = counter.key
+    return counters
+
+
+def resolve_perf_counters(content, perf_dict, counter_names):
+    """
+    Makes sure every counter name is in the performance dictionary, fetching the next statistics level
+    until they are all found.  Newly found counters are saved to the dictionary file.
+
+    :param content: ServiceInstance Managed Object
+    :param perf_dict: The PerfDictionary returned by create_perf_dictionary
+    :param counter_names: The counter names that are about to be looked up
+    """
+    if all(counter_name in perf_dict for counter_name in counter_names):
+        return
+    with perf_dict.lock:
+        level = perf_dict.level
+        while perf_dict.level < max_perf_level and not all(name in perf_dict for name in counter_names):
+            perf_dict.level += 1
+            perf_dict.update(fetch_perf_counters(content, perf_dict.level))
+        if perf_dict.level != level:
+            save_perf_dictionary(perf_dict)
+
+
+def perf_dictionary_expired(file_perf_dic):
+    """
+    Returns True if the performance dictionary file is older than perf_dict_age
+    """
+    return datetime.fromtimestamp(path.getmtime(file_perf_dic)) < (datetime.now() - perf_dict_age)
+
+
+def write_file_atomic(file_name, data, mode=0o600):
+    """
+    Writes data to a temporary file next to file_name and renames it into place, so readers never see
+    a partially written file.
+
+    :param file_name: The file to write
+    :param data: The string to write to the file
+    :param mode: The permissions for the new file
+    """
+    # tempfile pulls in random and shutil, checks answered from the result cache never write a file
+    import tempfile
+    # A unique name created exclusively, so nothing planted in the directory can redirect the write
+    fd, temp_name = tempfile.mkstemp(prefix=path.basename(file_name) + '.', suffix='.tmp',
+                                     dir=path.dirname(file_name))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            os.fchmod(f.fileno(), mode)
+            f.write(data)
+        os.rename(temp_name, file_name)
+    except Exception:
+        if path.exists(temp_name):
+            os.unlink(temp_name)
+        raise
+
+
+def private_dir(directory):
+    """
+    Creates a cache directory only the current user can access if it does not exist yet, and refuses one
+    other users could plant files or symlinks in.
+
+    :param directory: The directory to check
+    :return: The directory
+    """
+    if directory in private_dirs:
+        return directory
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise IOError('Refusing cache directory {}, it must be a directory owned by the current user and '
+                      'writable by nobody else'.format(directory))
+    private_dirs.add(directory)
+    return directory
+
+
+def get_session_file(args):
+    """
+    Returns the name of the session cache file for the host, port and user supplied on the command line
+
+    :param args: The parsed command-line arguments
+    """
+    key = '{}:{}:{}'.format(args.host, args.port, args.user)
+    return path.join(private_dir(session_cache_dir),
+                     'pyvinga_session_' + hashlib.sha256(key.encode('utf-8')).hexdigest()[:16])
+
+
+def connect_cached_session(args, context):
+    """
+    Reconnects using the session cookie stored by a previous check
+
+    :param args: The parsed command-line arguments
+    :param context: The SSL context to use for the connection
+    :return: The ServiceInstance Managed Object, or None if there is no cached session or it is no longer valid
+    """
+    import http.client
+    session_file = get_session_file(args)
+    try:
+        with open(session_file) as f:
+            cached = json.load(f)
+    except IOError:
+        return None
+    except ValueError:
+        cached = None
+    try:
+        stub = SoapStubAdapter(host=args.host, port=int(args.port), version=cached['version'], sslContext=context)
+        stub.cookie = cached['cookie']
+        si = vim.ServiceInstance('ServiceInstance', stub)
+        if si.RetrieveContent().sessionManager.currentSession:
+            return si
+    except (KeyError, TypeError, ValueError, vmodl.MethodFault, socket.error, http.client.HTTPException):
+        # A damaged cache file, or a session the host no longer accepts or cannot be reached with
+        pass
+    # The check logs in again and stores the new session
+    try:
+        os.unlink(session_file)
+    except OSError:
+        pass
+    return None
+
+
+def connect(args, password):
+    """
+    Connects and logs in to the vCenter or ESXi host supplied on the command line.
+    With --session-cache a session stored by a previous check is tried first, and a new session is stored.
+
+    :param args: The parsed command-line arguments
+    :param password: Password to use when connecting to host
+    :return: The ServiceInstance Managed Object
+    """
+    # disable SSL verification if requested
+    context = None
+    if args.insecure:
+        context = ssl._create_unverified_context()
+    if args.session_cache:
+        si = connect_cached_session(args, context)
+        if si:
+            return si
+    si = SmartConnect(host=args.host,
+                      user=args.user,
+                      pwd=password,
+                      port=int(args.port),
+                      sslContext=context)
+    if si and args.session_cache:
+        write_file_atomic(get_session_file(args), json.dumps({'cookie': si._stub.cookie,
+                                                              'version': si._stub.version}))
+    return si
+
+
+def match_entities(entity_props, entity):
+    """
+    Returns the entities whose names match the names or wildcard patterns supplied on the command line.
+    A plain name only matches the first entity with that name, a pattern matches every entity.
+
+    :param entity_props: The list of entity properties returned by get_properties
+    :param entity: Comma separated list of entity names or patterns
+    """
+    names, patterns = split_entity_names(entity)
+    names = set(names)
+    matched = []
+    found = set()
+    for prop in entity_props:
+        name = prop['name']
+        if name in names and name not in found:
+            found.add(name)
+            matched.append(prop)
+        elif any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns):
+            matched.append(prop)
+    return matched
+
+
+def combine_results(results):
+    """
+    Combines the results for each entity and counter into a single Icinga state and output.
+    A single result is returned unchanged.  Several results are returned with the most severe state, a first line
+    counting the results in each state and one line per result.  The perfdata of every result is labelled with its
+    entity and follows the first line, after a single '|'.
+
+    :param results: A list of (entity name, result) tuples where result is a tuple of state and output line
+    """
+    results = [(name, result) for name, result in results if result]
+    if not results:
+        return None
+    if len(results) == 1:
+        return results[0][1]
+    state = max((result[0] for name, result in results), key=state_severity.index)
+    states = [result[0] for name, result in results]
+    counts = ['{} {}'.format(states.count(result_state), state_tuple[result_state])
+              for result_state in reversed(state_severity) if result_state in states]
+    lines = ['{} - {} results, {}'.format(state_tuple[state], len(results), ', '.join(counts))]
+    perfdata = []
+    for name, result in results:
+        text, fields = split_check_output(result[1])
+        lines.append('{}: {}'.format(name, text.strip()))
+        perfdata += label_perfdata(name, fields)
+    return state, join_check_output(lines, perfdata)
+
+
+def label_perfdata(name, fields):
+    """
+    Prefixes the label of every perfdata field with the name of an entity, so the fields of several entities
+    reported by one check can be told apart.  Single quotes in the name are doubled, as the plugin guidelines
+    require for quoted labels.
+
+    :param name: The entity name
+    :param fields: The perfdata fields, as returned by split_check_output
+    :return: The list of labelled fields
+    """
+    prefix = name.replace("'", "''") + ' '
+    labelled = []
+    for field in fields:
+        if field.startswith("'"):
+            labelled.append("'" + prefix + field[1:])
+        else:
+            label, _, value = field.partition('=')
+            labelled.append("'{}{}'={}".format(prefix, label, value))
+    return labelled
+
+
+def join_check_output(lines, perfdata):
+    """
+    Builds the output of a check from its lines and perfdata fields, with every field on the first line after
+    a single '|'
+
+    :param lines: The output lines, the first is the summary shown by Icinga
+    :param perfdata: The perfdata fields
+    """
+    output = lines[0]
+    if perfdata:
+        output += ' | ' + ' '.join(perfdata)
+    return '\n'.join([output] + lines[1:])
+
+
+class CheckTimings(object):
+    """
+    The time taken by each phase of a check, measured with a monotonic clock, and the number of SOAP calls
+    made to vCenter (see --timings)
+
+    :param soap_calls: Whether the SOAP calls are counted.  The pyvinga daemon shares one stub between the
+    checks running at once, so the calls of a single check cannot be told apart there.
+    """
+    def __init__(self, soap_calls=True):
+        self.started = time.monotonic()
+        self.phases = {}
+        self.soap_calls = 0 if soap_calls else None
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Adds the time spent in the with block to the phase name
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + time.monotonic() - start
+
+    def count_calls(self, stub):
+        """
+        Counts every method call and property read sent through the SOAP stub of a ServiceInstance.
+        Calls made while logging in are part of the connect phase but not counted.
+        """
+        def counted(invoke):
+            def invoke_counted(*args):
+                with self.lock:
+                    self.soap_calls += 1
+                return invoke(*args)
+            return invoke_counted
+        stub.InvokeMethod = counted(stub.InvokeMethod)
+        stub.InvokeAccessor = counted(stub.InvokeAccessor)
+
+    def perfdata(self):
+        """
+        Returns the timings as Icinga perfdata, one field per phase followed by the total and the SOAP call count
+        """
+        fields = ["'pyvinga {}'={:.4f}s".format(name, seconds) for name, seconds in self.phases.items()]
+        fields.append("'pyvinga total'={:.4f}s".format(time.monotonic() - self.started))
+        if self.soap_calls is not None:
+            fields.append("'pyvinga soap calls'={}".format(self.soap_calls))
+        return ' '.join(fields)
+
+
+def timed(timings, name):
+    """
+    Returns a context manager timing the phase name when --timings is set, or one doing nothing
+    """
+    if timings is None:
+        return contextlib.nullcontext()
+    return timings.phase(name)
+
+
+def add_timings(result, timings):
+    """
+    Adds the perfdata of the timings to the output of a check, after any perfdata on its first line
+
+    :param result: A tuple of the Icinga state and output as returned by run_check, or None
+    :param timings: The CheckTimings of the check, or None without --timings
+    """
+    if timings is None or not result:
+        return result
+    state, output = result
+    # The timings join the perfdata after the first line, where multi-entity checks keep all of it
+    first, newline, rest = output.partition('\n')
+    separator = ' ' if '|' in first else ' | '
+    return state, first + separator + timings.perfdata() + newline + rest
+
+
+def run_vm_counter(vm, counter, perf_results, warning, critical, ring=None):
+    """
+    Runs a single counter against a Virtual Machine
+
+    :param vm: The Virtual Machine properties returned by get_properties
+    :param counter: The counter name supplied on the command line
+    :param perf_results: The performance values returned by build_query
+    :param warning: The warning value for the counter
+    :param critical: The critical value for the counter
+    :param ring: The SampleRing used for trend counters, or None
+    :return: A tuple of the Icinga state and the output line
+    """
+    vm_moref = vm['moref']
+    try:
+        if vm['runtime.powerState'] == "poweredOn":
+            if counter == 'core':
+                return vm_core(vm)
+            elif counter == 'status':
+                return vm_status(vm)
+            elif counter == 'cpu.ready':
+                return vm_cpu_ready(vm, get_statdata(perf_results, vm_moref), warning, critical)
+            elif counter == 'cpu.usage':
+                return vm_cpu_usage(vm, get_statdata(perf_results, vm_moref), warning, critical)
+            elif counter == 'mem.active':
+                return vm_mem_active(vm, get_statdata(perf_results, vm_moref), warning, critical)
+            elif counter == 'mem.shared':
+                return vm_mem_shared(vm, get_statdata(perf_results, vm_moref), warning, critical)
+            elif counter == 'mem.balloon':
+                return vm_mem_balloon(vm, get_statdata(perf_results, vm_moref), warning, critical)
+            elif counter == 'datastore.io':
+                return vm_ds_io(vm, get_statdata(perf_results, vm_moref), warning, critical)
+            elif counter == 'datastore.latency':
+                return vm_ds_latency(vm, get_statdata(perf_results, vm_moref), warning, critical)
+            elif counter == 'network.usage':
+                return vm_net_usage(vm, get_statdata(perf_results, vm_moref), warning, critical)
+            elif counter == 'cpu.ready.trend':
+                get_statdata(perf_results, vm_moref)
+                return vm_cpu_ready_trend(vm, ring, warning, critical)
+            else:
+                return STATE_UNKNOWN, 'ERROR: No supported counter found'
+        elif (vm['runtime.powerState'] == "poweredOff") or (vm['runtime.powerState'] == "suspended"):
+            if counter == 'core':
+                return vm_core(vm)
+            elif counter == 'status':
+                return vm_status(vm)
+            else:
+                return STATE_UNKNOWN, 'ERROR: Virtual Machine is powered off'
+    except CheckError as e:
+        return e.state, str(e)
+    return None
+
+
+def run_host_counter(host, counter, warning, critical, perf_results=None):
+    """
+    Runs a single counter against an ESXi Host
+
+    :param host: The ESXi Host properties returned by get_properties
+    :param counter: The counter name supplied on the command line
+    :param warning: The warning value for the counter
+    :param critical: The critical value for the counter
+    :param perf_results: The performance values returned by build_query for the Virtual Machines of the Host
+    :return: A tuple of the Icinga state and the output line
+    """
+    try:
+        if counter == 'core':
+            return host_core(host)
+        elif counter == 'cpu.usage':
+            return host_cpu_usage(host, warning, critical)
+        elif counter == 'mem.usage':
+            return host_mem_usage(host, warning, critical)
+        elif counter == 'vms.cpu.ready':
+            return rollup_cpu_ready(host, perf_results, warning, critical)
+        elif counter == 'vms.mem.balloon':
+            return rollup_mem_balloon(host, perf_results, warning, critical)
+        else:
+            return STATE_UNKNOWN, 'ERROR: No supported counter found'
+    except CheckError as e:
+        return e.state, str(e)
+
+
+def run_ds_counter(datastore, counter, warning, critical, ring=None):
+    """
+    Runs a single counter against a Datastore
+
+    :param datastore: The Datastore properties returned by get_properties
+    :param counter: The counter name supplied on the command line
+    :param warning: The warning value for the counter
+    :param critical: The critical value for the counter
+    :param ring: The SampleRing used for trend counters, or None
+    :return: A tuple of the Icinga state and the output line
+    """
+    try:
+        if counter == 'status':
+            return ds_status(datastore)
+        elif counter == 'space':
+            return ds_space(datastore, warning, critical)
+        elif counter == 'space.growth':
+            return ds_space_growth(datastore, ring, warning, critical)
+        else:
+            return STATE_UNKNOWN, 'ERROR: No supported counter found'
+    except CheckError as e:
+        return e.state, str(e)
+
+
+def run_cl_counter(cluster, counter, warning=None, critical=None, perf_results=None):
+    """
+    Runs a single counter against a vSphere Cluster
+
+    :param cluster: The Cluster properties returned by get_properties
+    :param counter: The counter name supplied on the command line
+    :param warning: The warning value for the counter
+    :param critical: The critical value for the counter
+    :param perf_results: The performance values returned by build_query for the Virtual Machines of the Cluster
+    :return: A tuple of the Icinga state and the output line
+    """
+    try:
+        if counter == 'status':
+            return cl_status(cluster)
+        elif counter == 'vms.cpu.ready':
+            return rollup_cpu_ready(cluster, perf_results, warning, critical)
+        elif counter == 'vms.mem.balloon':
+            return rollup_mem_balloon(cluster, perf_results, warning, critical)
+        else:
+            return STATE_UNKNOWN, 'ERROR: No supported counter found'
+    except CheckError as e:
+        return e.state, str(e)
+
+
+def run_check(content, vchtime, perf_dict, args, mirror=None, ring=None, timings=None):
+    """
+    Finds the entities supplied on the command line and runs the requested counters against them.
+
+    :param content: ServiceInstance Managed Object
+    :param vchtime: The vCenter date and time used as the baseline when querying for counters
+    :param perf_dict: The array containing the performance dictionary (with counters and IDs)
+    :param args: The parsed command-line arguments
+    :param mirror: An InventoryMirror to read the entity properties from, if running in the pyvinga daemon
+    :param ring: A SampleRing for the vCenter, if --sample-ring is set
+    :param timings: A CheckTimings to record the inventory and query phases in, if --timings is set
+    :return: A tuple of the Icinga state and output, or None if no entity could be found.
+    The state is None where only the output should be printed.
+    """
+    try:
+        if args.top > 0:
+            return check_top(content, vchtime, perf_dict, args, mirror, ring, timings)
+        results = check_entities(content, vchtime, perf_dict, args, mirror, ring, timings)
+    except CheckError as e:
+        return e.state, str(e)
+    return combine_results([(name, result) for name, counter, result in results])
+
+
+def check_entities(content, vchtime, perf_dict, args, mirror=None, ring=None, timings=None):
+    """
+    Runs the requested counters against every entity matching the command line.
+    Performance counters for every entity and counter are fetched with a single query.
+
+    :param content: ServiceInstance Managed Object
+    :param vchtime: The vCenter date and time used as the baseline when querying for counters
+    :param perf_dict: The array containing the performance dictionary (with counters and IDs)
+    :param args: The parsed command-line arguments
+    :param mirror: An InventoryMirror to read the entity properties from, if running in the pyvinga daemon
+    :param ring: A SampleRing for the vCenter, if --sample-ring is set
+    :param timings: A CheckTimings to record the inventory and query phases in, if --timings is set
+    :return: A list of (entity name, counter, result) tuples where result is a tuple of state and output line,
+    or None where the counter produced no result
+    """
+    counters = args.counter.split(',')
+    warning, critical = get_thresholds(args, counters)
+    if args.type not in entity_types:
+        raise CheckError(None, 'ERROR: No supported Entity type provided')
+
+    if get_result_cache_names(args) is not None:
+        # Fetch every counter of the entities so the checks for the other counters can use the result cache
+        entities, perf_results = fetch_entities(content, vchtime, perf_dict, args, cached_counters[args.type],
+                                                mirror, ring, timings)
+        write_result_cache(args, entities, perf_results)
+    else:
+        entities, perf_results = fetch_entities(content, vchtime, perf_dict, args, counters, mirror, ring, timings)
+    return evaluate_entities(args.type, entities, perf_results, counters, warning, critical, ring)
+
+
+def check_top(content, vchtime, perf_dict, args, mirror=None, ring=None, timings=None):
+    """
+    Ranks every Virtual Machine matching the command line by a single counter and reports the worst --top of
+    them as a single result.  The values of all the Virtual Machines are fetched with a single (chunked) query
+    and the worst are picked with a heap, so only they are formatted.
+
+    :param content: ServiceInstance Managed Object
+    :param vchtime: The vCenter date and time used as the baseline when querying for counters
+    :param perf_dict: The array containing the performance dictionary (with counters and IDs)
+    :param args: The parsed command-line arguments
+    :param mirror: An InventoryMirror to read the entity properties from, if running in the pyvinga daemon
+    :param ring: A SampleRing for the vCenter, if --sample-ring is set
+    :param timings: A CheckTimings to record the inventory and query phases in, if --timings is set
+    :return: A tuple of the Icinga state and output, one line for each of the worst Virtual Machines
+    """
+    counters = args.counter.split(',')
+    if args.type != 'vm' or len(counters) != 1 or counters[0] not in top_counters:
+        raise CheckError(STATE_UNKNOWN, 'ERROR: --top ranks Virtual Machines by one of the counters ' +
+                         ', '.join(top_counters))
+    counter = counters[0]
+    warning, critical = get_thresholds(args, counters)
+    entities, perf_results = fetch_entities(content, vchtime, perf_dict, args, counters, mirror, ring, timings)
+
+    ranked = []
+    for vm in entities:
+        statdata = perf_results.get(vm['moref']._moId)
+        if statdata:
+            ranked.append((top_value(vm, counter, statdata), vm))
+    if not ranked:
+        raise CheckError(STATE_WARNING, 'ERROR: Performance results empty.  Check time drift on source and vCenter server')
+    over = len([value for value, vm in ranked if value >= warning])
+    worst = heapq.nlargest(args.top, ranked, key=lambda item: item[0])
+
+    state = STATE_OK
+    lines = []
+    perfdata = []
+    for value, vm in worst:
+        vm_state, output = run_vm_counter(vm, counter, perf_results, warning, critical, ring)
+        state = max(state, vm_state, key=state_severity.index)
+        text, fields = split_check_output(output)
+        lines.append('{}: {}'.format(vm['name'], text.strip()))
+        # Every field is labelled with the Virtual Machine, so the fields of each of them can be told apart
+        perfdata += label_perfdata(vm['name'], fields)
+    perfdata.append("'VMs over warning'={};;;0;{}".format(over, len(ranked)))
+    header = '{} - {} of {} VMs over warning for {}, worst {}'.format(state_tuple[state], over, len(ranked), counter,
+                                                                     len(worst))
+    return state, join_check_output([header] + lines, perfdata)
+
+
+def top_value(vm, counter, statdata):
+    """
+    Returns the value a Virtual Machine is ranked by for --top, in the units of the warning and critical values.
+    The memory counters are a percentage of the memory configured for the Virtual Machine.
+
+    :param vm: The Virtual Machine properties, including those listed in counter_props
+    :param counter: The counter name supplied on the command line
+    :param statdata: The performance values returned by build_query for the Virtual Machine
+    """
+    if counter == 'cpu.ready':
+        return statdata['cpu.ready.summation'] / 20000 * 100
+    elif counter == 'cpu.usage':
+        return statdata['cpu.usage.average'] / 100
+    elif counter in ('mem.active', 'mem.shared', 'mem.balloon'):
+        memory = vm['summary.config.memorySizeMB'] or 1
+        return statdata[vm_perf_counters[counter][0][0]] / 1024 * 100 / memory
+    elif counter == 'datastore.io':
+        return statdata['datastore.numberReadAveraged.average'] + statdata['datastore.numberWriteAveraged.average']
+    elif counter == 'datastore.latency':
+        return statdata['datastore.totalReadLatency.average'] + statdata['datastore.totalWriteLatency.average']
+    else:
+        return (statdata['net.received.average'] + statdata['net.transmitted.average']) * 8 / 1024
+
+
+def get_thresholds(args, counters):
+    """
+    Returns the warning and critical values supplied on the command line, or None where only
+    core and status counters are requested
+    """
+    if any(counter != 'core' and counter != 'status' for counter in counters):
+        return float(args.warning), float(args.critical)
+    return None, None
+
+
+def fetch_entities(content, vchtime, perf_dict, args, counters, mirror=None, ring=None, timings=None):
+    """
+    Finds the entities matching the command line and fetches the properties and performance values the
+    counters need
+
+    :param content: ServiceInstance Managed Object
+    :param vchtime: The vCenter date and time used as the baseline when querying for counters
+    :param perf_dict: The array containing the performance dictionary (with counters and IDs)
+    :param args: The parsed command-line arguments
+    :param counters: The counters to fetch the values for
+    :param mirror: An InventoryMirror to read the entity properties from, if running in the pyvinga daemon
+    :param ring: A SampleRing for the vCenter, if --sample-ring is set
+    :param timings: A CheckTimings to record the inventory and query phases in, if --timings is set
+    :return: A tuple of the list of entity property dictionaries and the performance values returned by build_query
+    """
+    specType = get_entity_type(args.type)
+    props = ['name']
+    for counter in counters:
+        props += [prop for prop in counter_props.get((args.type, counter), []) if prop not in props]
+    if args.type == 'vm' and 'runtime.powerState' not in props:
+        props.append('runtime.powerState')
+    with timed(timings, 'inventory'):
+        entities = find_entities(content, args, [specType], props, specType, mirror)
+
+    perf_results = {}
+    if args.type == 'vm':
+        #Use the Managed Object Reference (moref) of the VMs found for the counters
+        queries = []
+        for vm in entities:
+            if vm['runtime.powerState'] == "poweredOn":
+                vm_counters = []
+                for counter in counters:
+                    vm_counters += vm_perf_counters.get(counter, [])
+                if vm_counters:
+                    queries.append((vm['moref'], vm_counters))
+        with timed(timings, 'query'):
+            perf_results = build_query(content, vchtime, perf_dict, queries, args.chunk_size, args.workers,
+                                       args.perf_format, args.window, args.stat, ring, args.aggregate)
+    elif args.type in ('host', 'cluster') and any(counter in rollup_counters for counter in counters):
+        with timed(timings, 'inventory'):
+            fetch_child_vms(content, args.type, entities)
+        # The counters of every Virtual Machine of every entity are fetched with a single (chunked) query
+        vm_counters = []
+        for counter in counters:
+            if counter in rollup_counters:
+                vm_counters += vm_perf_counters[rollup_counters[counter]]
+        queries = [(vm['moref'], vm_counters) for entity in entities for vm in entity['vms']
+                   if vm['runtime.powerState'] == "poweredOn"]
+        with timed(timings, 'query'):
+            perf_results = build_query(content, vchtime, perf_dict, queries, args.chunk_size, args.workers,
+                                       args.perf_format, args.window, args.stat, ring, args.aggregate)
+    return entities, perf_results
+
+
+def fetch_child_vms(content, entity_type, entities):
+    """
+    Obtains the properties in rollup_vm_props for the Virtual Machines of each Host or Cluster and stores them in
+    the entity under 'vms'.  The Virtual Machines of all the entities are retrieved with a single call.
+
+    :param content: ServiceInstance Managed Object
+    :param entity_type: 'host' or 'cluster'
+    :param entities: The Host or Cluster properties returned by find_entities, including 'vm' or 'host'
+    """
+    if entity_type == 'cluster':
+        hosts = [host for entity in entities for host in entity['host'] or []]
+        host_vms = {}
+        if hosts:
+            host_vms = dict((host['moref']._moId, host['vm'] or [])
+                            for host in get_object_properties(content, hosts, ['vm'], vim.HostSystem))
+        entity_vms = [[vm for host in entity['host'] or [] for vm in host_vms.get(host._moId, [])]
+                      for entity in entities]
+    else:
+        entity_vms = [entity['vm'] or [] for entity in entities]
+    morefs = [vm for vms in entity_vms for vm in vms]
+    by_moid = {}
+    if morefs:
+        by_moid = dict((vm['moref']._moId, vm)
+                       for vm in get_object_properties(content, morefs, rollup_vm_props, vim.VirtualMachine))
+    for entity, vms in zip(entities, entity_vms):
+        entity['vms'] = [by_moid[vm._moId] for vm in vms if vm._moId in by_moid]
+
+
+def evaluate_entities(entity_type, entities, perf_results, counters, warning, critical, ring=None):
+    """
+    Runs the counters against the entities returned by fetch_entities
+
+    :return: A list of (entity name, counter, result) tuples as returned by check_entities
+    """
+    results = []
+    for entity in entities:
+        for counter in counters:
+            if entity_type == 'vm':
+                result = run_vm_counter(entity, counter, perf_results, warning, critical, ring)
+            elif entity_type == 'host':
+                result = run_host_counter(entity, counter, warning, critical, perf_results)
+            elif entity_type == 'datastore':
+                result = run_ds_counter(entity, counter, warning, critical, ring)
+            else:
+                result = run_cl_counter(entity, counter, warning, critical, perf_results)
+            results.append((entity['name'], counter, result))
+    return results
+
+
+def get_result_cache_names(args):
+    """
+    Returns the entity names supplied on the command line if the result cache can be used for the check,
+    that is --result-cache is set, every entity is a plain name, no trend counter is requested and --top is not set
+
+    :param args: The parsed command-line arguments
+    :return: The list of names, or None
+    """
+    names, patterns = split_entity_names(args.entity)
+    if args.result_cache <= 0 or patterns or args.type not in entity_types or args.top > 0:
+        return None
+    if any(counter not in cached_counters[args.type] for counter in args.counter.split(',')):
+        return None
+    return names
+
+
+def get_result_cache_file(args, name):
+    """
+    Returns the name of the result cache file for an entity.  Checks only share cached results when they
+    fetch the values the same way.
+
+    :param args: The parsed command-line arguments
+    :param name: The entity name
+    """
+    # The password is part of the key, so a cached result is only returned to checks that could log in
+    key = json.dumps([args.host, int(args.port), args.user, hashlib.sha256(args.password.encode('utf-8')).hexdigest(),
+                      args.type, name, args.container, args.window, args.stat, args.aggregate])
+    return path.join(private_dir(result_cache_dir), 'pyvinga_result_{}.json'.format(
+        hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]))
+
+
+def read_result_cache(cache_file, ttl):
+    """
+    Reads a result cache file
+
+    :return: The cached entry, or None if there is none younger than ttl seconds
+    """
+    try:
+        with open(cache_file) as f:
+            entry = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if entry.get('time', 0) <= time.time() - ttl:
+        return None
+    return entry
+
+
+def lock_result_cache(args):
+    """
+    Looks up the entities supplied on the command line in the result cache.  An exclusive lock is taken for
+    every entity that is missing, so only one of the checks started at the same time fetches it from vCenter;
+    the others wait for the lock and then find the entity in the cache.  The locks are held until the
+    process exits (or release_result_cache is called).
+
+    :param args: The parsed command-line arguments
+    :return: A tuple of the cached entries by entity name and the file descriptors of the locks taken,
+    or (None, []) if the result cache cannot be used for the check
+    """
+    names = get_result_cache_names(args)
+    if names is None:
+        return None, []
+    entries = {}
+    locks = []
+    for name in sorted(set(names)):
+        cache_file = get_result_cache_file(args, name)
+        entry = read_result_cache(cache_file, args.result_cache)
+        if entry is None:
+            lock_fd = os.open(cache_file + '.lock', os.O_WRONLY | os.O_CREAT, 0o600)
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            # Another check may have fetched the entity while waiting for the lock
+            entry = read_result_cache(cache_file, args.result_cache)
+            if entry is None:
+                locks.append(lock_fd)
+                continue
+            os.close(lock_fd)
+        entries[name] = entry
+    return entries, locks
+
+
+def release_result_cache(locks):
+    """
+    Releases the locks taken by lock_result_cache
+    """
+    for lock_fd in locks:
+        os.close(lock_fd)
+    del locks[:]
+
+
+def write_result_cache(args, entities, perf_results):
+    """
+    Stores the properties and performance values of each entity in the result cache
+
+    :param args: The parsed command-line arguments
+    :param entities: The entities returned by fetch_entities
+    :param perf_results: The performance values returned by fetch_entities
+    """
+    for entity in entities:
+        moid = entity['moref']._moId
+        entry = {'time': time.time(), 'moid': moid, 'statdata': perf_results.get(moid),
+                 'props': dict((prop, value) for prop, value in entity.items() if prop != 'moref')}
+        write_file_atomic(get_result_cache_file(args, entity['name']), json.dumps(entry, separators=(',', ':')))
+
+
+class CachedMoref(object):
+    """
+    Stands in for the Managed Object Reference of an entity read from the result cache.  Only its ID is used
+    by the checks, so cached checks run without importing pyVmomi.
+    """
+    def __init__(self, moid):
+        self._moId = moid
+
+
+def run_cached_check(entries, args):
+    """
+    Runs the requested counters against the entities held in the result cache, without connecting to vCenter
+
+    :param entries: The cached entries by entity name returned by lock_result_cache
+    :param args: The parsed command-line arguments
+    :return: A tuple of the Icinga state and output as returned by run_check
+    """
+    counters = args.counter.split(',')
+    warning, critical = get_thresholds(args, counters)
+    entities = []
+    perf_results = {}
+    for name in split_entity_names(args.entity)[0]:
+        entity = dict(entries[name]['props'])
+        entity['moref'] = CachedMoref(entries[name]['moid'])
+        entities.append(entity)
+        if entries[name]['statdata']:
+            perf_results[entries[name]['moid']] = entries[name]['statdata']
+    results = evaluate_entities(args.type, match_entities(entities, args.entity), perf_results, counters,
+                                warning, critical)
+    return combine_results([(name, result) for name, counter, result in results])
+
+
+def format_passive_results(results, args):
+    """
+    Formats the results of a scan as Icinga PROCESS_SERVICE_CHECK_RESULT external commands
+
+    :param results: A list of (entity name, counter, result) tuples as returned by check_entities
+    :param args: The parsed command-line arguments
+    :return: A list of external command lines
+    """
+    timestamp = int(time.time())
+    commands = []
+    for name, counter, result in results:
+        if not result:
+            continue
+        state, output = result
+        if state is None:
+            state = STATE_UNKNOWN
+        fields = {'entity': name, 'type': args.type, 'counter': counter}
+        # External commands are one line each, multi-line output uses escaped newlines
+        output = output.strip().replace('\n', '\\n')
+        commands.append('[{}] PROCESS_SERVICE_CHECK_RESULT;{};{};{};{}\n'.format(
+            timestamp, args.host_name.format(**fields), args.service_name.format(**fields), state, output))
+    return commands
+
+
+def submit_passive_results(commands, args):
+    """
+    Submits external commands to the Icinga command file or spool directory supplied on the command line
+
+    :param commands: A list of external command lines as returned by format_passive_results
+    :param args: The parsed command-line arguments
+    """
+    if args.command_file:
+        # The command file is a named pipe, write each command on its own so commands are never interleaved
+        fd = os.open(args.command_file, os.O_WRONLY | os.O_APPEND)
+        try:
+            for command in commands:
+                os.write(fd, command.encode('utf-8'))
+        finally:
+            os.close(fd)
+    if args.spool_dir and commands:
+        spool_file = path.join(args.spool_dir, 'pyvinga_{}_{}_{}.cmd'.format(args.type, int(time.time()),
+                                                                           os.getpid()))
+        write_file_atomic(spool_file, ''.join(commands), 0o644)
+
+
+def split_check_output(output):
+    """
+    Splits the output of a check into the plugin output and the performance data fields the way Icinga 2 splits
+    the output of an active check, so a result submitted to the API is stored exactly as if the check had been
+    run by Icinga 2.  Every line may carry performance data after a '|'.
+
+    :param output: The output line(s) of the check, as printed
+    :return: A tuple of the plugin output and the list of performance data fields
+    """
+    text = []
+    perfdata = []
+    for line in re.split(r'[\r\n]', output.strip()):
+        delim = line.find('|')
+        if delim != -1 and line.find('=', delim) != -1:
+            text.append(line[:delim])
+            perfdata.append(line[delim + 1:])
+        elif line or text:
+            text.append(line)
+    # Labels are quoted where they contain spaces, e.g. 'CPU Ready'=0.3%;5.0;10.0;0;100
+    fields = perfdata_field.findall(' '.join(perfdata))
+    return '\n'.join(text), fields
+
+
+def format_api_results(results, args):
+    """
+    Formats the results of a scan as Icinga 2 API process-check-result requests
+
+    :param results: A list of (entity name, counter, result) tuples as returned by check_entities
+    :param args: The parsed command-line arguments
+    :return: A list of request bodies
+    """
+    payloads = []
+    for name, counter, result in results:
+        if not result:
+            continue
+        state, output = result
+        if state is None:
+            state = STATE_UNKNOWN
+        fields = {'entity': name, 'type': args.type, 'counter': counter}
+        plugin_output, perfdata = split_check_output(output)
+        payloads.append({'type': 'Service', 'exit_status': state, 'plugin_output': plugin_output,
+                         'performance_data': perfdata,
+                         'service': '{}!{}'.format(args.host_name.format(**fields),
+                                                   args.service_name.format(**fields))})
+    return payloads
+
+
+class ApiSubmitter(object):
+    """
+    Submits passive check results to the Icinga 2 API over a pool of keep-alive connections.
+
+    Results are queued by submit() and sent by one thread per connection, each taking up to batch_size
+    results off the queue at a time and sending them back to back over its connection.  The queue is bounded,
+    so submit() waits while the API is behind instead of queueing a whole inventory in memory.  A result is
+    retried on a new connection when the connection fails or the API answers 429 or 5xx.
+    """
+    def __init__(self, url, user, password, connections=api_connections, ca_file=None, insecure=False,
+                 queue_size=api_queue_size, batch_size=api_batch_size, retries=api_retries,
+                 retry_delay=api_retry_delay, timeout=api_timeout):
+        from urllib.parse import urlsplit
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('Icinga 2 API URL must start with https:// or http://: ' + url)
+        self.scheme = parts.scheme
+        self.address = (parts.hostname, parts.port or api_port)
+        self.path = parts.path.rstrip('/') + '/v1/actions/process-check-result'
+        credentials = '{}:{}'.format(user or '', password or '').encode('utf-8')
+        self.headers = {'Accept': 'application/json', 'Content-Type': 'application/json',
+                        'Authorization': 'Basic ' + base64.b64encode(credentials).decode('ascii')}
+        self.ca_file = ca_file
+        self.insecure = insecure
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.queue = queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.failed = []
+        self.threads = [threading.Thread(target=self.run) for _ in range(max(connections, 1))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, payload):
+        """
+        Queues a result, waiting while the queue is full
+        """
+        self.queue.put(payload)
+
+    def close(self):
+        """
+        Waits for every queued result to be sent and closes the connections
+
+        :return: The number of results accepted by the API
+        :raise IOError: If any result could not be submitted
+        """
+        self.queue.join()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.failed:
+            raise IOError('{} of {} results were not accepted by the Icinga 2 API, {}'.format(
+                len(self.failed), len(self.failed) + self.submitted, self.failed[0]))
+        return self.submitted
+
+    def connect(self):
+        """
+        Opens a new connection to the API
+        """
+        import http.client
+        if self.scheme == 'http':
+            return http.client.HTTPConnection(self.address[0], self.address[1], timeout=self.timeout)
+        # The global ssl is only set by import_vsphere(), results may be submitted without connecting to vCenter
+        import ssl as ssl_module
+        if self.insecure:
+            context = ssl_module._create_unverified_context()
+        else:
+            context = ssl_module.create_default_context(cafile=self.ca_file)
+        return http.client.HTTPSConnection(self.address[0], self.address[1], timeout=self.timeout,
+                                           context=context)
+
+    def run(self):
+        """
+        Sends batches of queued results over one connection until close() is called
+        """
+        connection = None
+        done = False
+        while not done:
+            batch = []
+            payload = self.queue.get()
+            while payload is not None:
+                batch.append(payload)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    payload = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            done = payload is None
+            for payload in batch:
+                try:
+                    connection = self.send(connection, payload)
+                except Exception as e:
+                    # Anything send() does not expect fails this result only, a thread that died would leave
+                    # the queue full and submit() and close() waiting forever
+                    with self.lock:
+                        self.failed.append('{}: {}'.format(payload.get('service'), e))
+                    if connection is not None:
+                        connection.close()
+                    connection = None
+                finally:
+                    self.queue.task_done()
+            if done:
+                self.queue.task_done()
+        if connection is not None:
+            connection.close()
+
+    def send(self, connection, payload):
+        """
+        Sends a single result, retrying on a new connection where the API may accept it later
+
+        :return: The connection to use for the next result, or None if it has to be opened again
+        """
+        import http.client
+        body = json.dumps(payload).encode('utf-8')
+        error = None
+        for attempt in range(self.retries):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                if connection is None:
+                    connection = self.connect()
+                connection.request('POST', self.path, body, self.headers)
+                response = connection.getresponse()
+                reply = response.read()
+            except (http.client.HTTPException, socket.error) as e:
+                error = '{}: {}'.format(payload['service'], e)
+                if connection is not None:
+                    connection.close()
+                connection = None
+                continue
+            if response.status == 200:
+                with self.lock:
+                    self.submitted += 1
+                return connection
+            error = '{}: HTTP {} {}'.format(payload['service'], response.status, reply.decode('utf-8', 'replace'))
+            if response.status != 429 and response.status < 500:
+                # The API refused the result (e.g. an unknown service), sending it again would not help
+                break
+            if response.will_close:
+                connection.close()
+                connection = None
+        with self.lock:
+            self.failed.append(error)
+        return connection
+
+
+def submit_api_results(payloads, args):
+    """
+    Submits process-check-result requests to the Icinga 2 API supplied on the command line
+
+    :param payloads: A list of request bodies as returned by format_api_results
+    :param args: The parsed command-line arguments
+    """
+    submitter = ApiSubmitter(args.api_url, args.api_user, args.api_password, args.api_connections, args.api_ca,
+                             args.insecure)
+    for payload in payloads:
+        submitter.submit(payload)
+    submitter.close()
+
+
+def forward_check(args):
+    """
+    Sends the check to a pyvinga daemon listening on the Unix socket supplied on the command line
+
+    :param args: The parsed command-line arguments (including the password)
+    :return: The reply from the daemon, or None if no daemon is listening on the socket
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(args.socket)
+    except socket.error:
+        client.close()
+        return None
+    try:
+        client.sendall((json.dumps(vars(args)) + '\n').encode('utf-8'))
+        reply = client.makefile('rb').readline()
+    finally:
+        client.close()
+    if not reply:
+        return None
+    return json.loads(reply.decode('utf-8'))
+
+
+class InventoryMirror(threading.Thread):
+    """
+    Keeps the properties listed in mirror_props for every Virtual Machine, Host, Datastore and Cluster in memory.
+    A private PropertyCollector filter is created over the whole inventory and WaitForUpdatesEx is called in a
+    loop, so only the properties that changed since the previous call are sent by vCenter.
+    """
+    daemon = True
+
+    def __init__(self, content):
+        threading.Thread.__init__(self)
+        self.content = content
+        self.ready = threading.Event()
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.entities = {}
+        self.collector = None
+
+    def run(self):
+        view = None
+        try:
+            self.collector = self.content.propertyCollector.CreatePropertyCollector()
+            view = self.content.viewManager.CreateContainerView(self.content.rootFolder,
+                                                                [getattr(vim, name) for name in mirror_props], True)
+            traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(name='traverseEntities', path='view',
+                                                                         skip=False, type=view.__class__)
+            obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal_spec])
+            prop_set = [vmodl.query.PropertyCollector.PropertySpec(type=getattr(vim, name), pathSet=props)
+                        for name, props in mirror_props.items()]
+            filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=prop_set)
+            self.collector.CreateFilter(filter_spec, partialUpdates=False)
+            wait_options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=mirror_wait)
+            # The first call (empty version) returns the whole inventory, later calls only the changes
+            version = ''
+            while not self.stopped:
+                update_set = self.collector.WaitForUpdatesEx(version, wait_options)
+                if update_set is None:
+                    continue
+                self.apply(update_set)
+                version = update_set.version
+                if not update_set.truncated:
+                    self.ready.set()
+        except Exception:
+            # Checks fall back to querying vCenter until the daemon starts a new mirror
+            pass
+        finally:
+            self.ready.clear()
+            self.stopped = True
+            try:
+                if view is not None:
+                    view.Destroy()
+                if self.collector is not None:
+                    self.collector.DestroyPropertyCollector()
+            except Exception:
+                pass
+
+    def apply(self, update_set):
+        """
+        Applies the changes from a WaitForUpdatesEx call to the mirrored entities
+
+        :param update_set: The UpdateSet returned by WaitForUpdatesEx
+        """
+        with self.lock:
+            for filter_update in update_set.filterSet or []:
+                for obj_update in filter_update.objectSet or []:
+                    moid = obj_update.obj._moId
+                    if obj_update.kind == 'leave':
+                        self.entities.pop(moid, None)
+                        continue
+                    entity = self.entities.setdefault(moid, {'moref': obj_update.obj})
+                    for change in obj_update.changeSet or []:
+                        if change.op == 'remove':
+                            entity.pop(change.name, None)
+                        else:
+                            entity[change.name] = change.val
+
+    def find(self, specType, entity, props):
+        """
+        Obtains the properties for the mirrored entities matching the names or patterns supplied on the command line
+
+        :param specType: Type of Managed Object Reference to look for
+        :param entity: The entity names or patterns supplied on the command line
+        :param props: A list of properties that should be returned for the entity, including 'name'
+        :return: A list of property dictionaries as returned by get_properties, or None if the mirror is not in sync
+        or does not hold every requested property
+        """
+        if not self.ready.is_set() or specType._wsdlName not in mirror_props:
+            return None
+        tracked = mirror_props[specType._wsdlName]
+        paths = {}
+        for prop in props:
+            # Properties below a mirrored property (summary.capacity below summary) are read from the data object
+            parents = [tracked_path for tracked_path in tracked
+                       if prop == tracked_path or prop.startswith(tracked_path + '.')]
+            if not parents:
+                return None
+            paths[prop] = max(parents, key=len)
+        with self.lock:
+            candidates = [mirrored for mirrored in self.entities.values()
+                          if isinstance(mirrored['moref'], specType) and 'name' in mirrored]
+            entity_props = []
+            for mirrored in match_entities(candidates, entity):
+                properties = {'moref': mirrored['moref']}
+                for prop, tracked_path in paths.items():
+                    value = mirrored.get(tracked_path)
+                    for attr in prop[len(tracked_path):].split('.')[1:]:
+                        value = getattr(value, attr, None) if value is not None else None
+                    properties[prop] = value
+                entity_props.append(properties)
+        return entity_props
+
+    def stop(self):
+        """
+        Stops the mirror, cancelling the WaitForUpdatesEx call in progress
+        """
+        self.stopped = True
+        if self.collector is not None:
+            try:
+                self.collector.CancelWaitForUpdates()
+            except Exception:
+                pass
+
+
+class CheckServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    The pyvinga daemon.  Holds an authenticated session, the ServiceContent and the performance dictionary
+    for each host/port/user combination and runs the checks forwarded by clients against them.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, mirror=True):
+        import_vsphere()
+        if path.exists(socket_path):
+            # A socket left behind by a daemon that did not shut down cleanly is replaced, one still answering is not
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                client.connect(socket_path)
+            except socket.error:
+                os.unlink(socket_path)
+            else:
+                raise IOError('A pyvinga daemon is already listening on {}'.format(socket_path))
+            finally:
+                client.close()
+        # The socket is created with the permissions of the umask, other users must not connect even for the
+        # moment between the bind and a chmod
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path, CheckHandler)
+        finally:
+            os.umask(umask)
+        self.mirror = mirror
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+
+    def get_session(self, args, renew=False):
+        """
+        Returns the session for the host, port and user of the check, logging in if there is none yet.
+
+        :param args: The parsed command-line arguments forwarded by the client
+        :param renew: Discard any existing session and log in again
+        """
+        key = (args.host, int(args.port), args.user)
+        pwd_hash = hashlib.sha256(args.password.encode('utf-8')).hexdigest()
+        with self.sessions_lock:
+            session = self.sessions.setdefault(key, {'lock': threading.Lock(), 'si': None, 'mirror': None})
+        with session['lock']:
+            # Only hand out an existing session to clients that supplied the same password
+            if renew or session['si'] is None or session['pwd_hash'] != pwd_hash:
+                si = connect(args, args.password)
+                if not si:
+                    return None
+                if session['mirror'] is not None:
+                    session['mirror'].stop()
+                    session['mirror'] = None
+                if session['si'] is not None:
+                    try:
+                        Disconnect(session['si'])
+                    except Exception:
+                        pass
+                session['si'] = si
+                session['pwd_hash'] = pwd_hash
+                session['content'] = si.RetrieveContent()
+                session['perf_dict'] = None
+            # The daemon outlives the dictionary file it read, read (or rebuild) it again once that file has expired
+            if session['perf_dict'] is None or time.time() > session['perf_dict_expires']:
+                session['perf_dict'] = create_perf_dictionary(session['content'], args)
+                session['perf_dict_expires'] = path.getmtime(session['perf_dict'].file_perf_dic) + \
+                    perf_dict_age.total_seconds()
+            if self.mirror and (session['mirror'] is None or session['mirror'].stopped):
+                session['mirror'] = InventoryMirror(session['content'])
+                session['mirror'].start()
+            return session
+
+    def execute(self, args):
+        """
+        Runs a single check forwarded by a client.
+
+        :param args: The parsed command-line arguments forwarded by the client
+        :return: A tuple of the Icinga state and the output line
+        """
+        timings = CheckTimings(soap_calls=False) if args.timings else None
+        renew = False
+        while True:
+            try:
+                with timed(timings, 'session'):
+                    session = self.get_session(args, renew)
+                if not session:
+                    return None, 'Could not connect to the specified host using specified username and password'
+                with timed(timings, 'time'):
+                    vchtime = get_vcenter_time(session['si'], get_clock_file(session['content'], args))
+                if args.sample_ring and session.get('ring') is None:
+                    session['ring'] = SampleRing(get_sample_ring_file(session['content'], args),
+                                                 args.sample_ring_series)
+                return add_timings(run_check(session['content'], vchtime, session['perf_dict'], args,
+                                             session['mirror'], session.get('ring'), timings), timings)
+            except vim.fault.NotAuthenticated:
+                # The session has expired on the server side, log in again once
+                if renew:
+                    raise
+                renew = True
+
+    def shutdown_sessions(self):
+        """
+        Logs out of every session held by the daemon
+        """
+        for session in self.sessions.values():
+            if session['mirror'] is not None:
+                session['mirror'].stop()
+            if session['si'] is not None:
+                Disconnect(session['si'])
+
+
+class CheckHandler(socketserver.StreamRequestHandler):
+    """
+    Handles a single check request from a client.  Requests and replies are one line of JSON each.
+    """
+    def handle(self):
+        request = self.rfile.readline()
+        if not request:
+            return
+        args = argparse.Namespace(**json.loads(request.decode('utf-8')))
+        try:
+            result = self.server.execute(args)
+        except SSLError:
+            result = None, 'Could not verify SSL certificate, use -i / --insecure to skip checking'
+        except IOError:
+            result = None, 'Could not connect to the specified host using specified username and password'
+        except vmodl.MethodFault as e:
+            result = None, "Caught vmodl fault : " + e.msg
+        except Exception as e:
+            result = None, "Caught exception : " + str(e)
+        if result:
+            reply = {'state': result[0], 'output': result[1]}
+        else:
+            reply = {'state': None, 'output': None}
+        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+
+def serve():
+    """
+    Runs pyvinga as a daemon until it is interrupted
+    """
+    args = GetServeArgs(sys.argv[2:])
+
+    def terminate(signum, frame):
+        # Stopped by the service manager, shut down as on an interrupt so the socket is removed
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, terminate)
+    server = None
+    try:
+        try:
+            server = CheckServer(args.socket, not args.no_mirror)
+        except IOError as e:
+            print('ERROR: {}'.format(e))
+            return -1
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.server_close()
+            server.shutdown_sessions()
+            os.unlink(args.socket)
+    return 0
+
+
 def main():
     args = GetArgs()
     try:
-        # disable SSL verification if requested
-        context = None
-        if args.insecure:
-            context = ssl._create_unverified_context()
-        entity = args.entity
-        if args.counter != 'core' and args.counter != 'status':
-            warning = float(args.warning)
-            critical = float(args.critical)
         si = None
         if args.password:
             password = args.password
         else:
             password = getpass.getpass(prompt="Enter password for host {} and user {}: ".format(args.host, args.user))
 
+        args.password = password
+        timings = CheckTimings() if args.timings else None
+        passive = args.command_file or args.spool_dir or args.api_url
+        if args.type not in entity_types:
+            # Fail before paying for the connection
+            print('ERROR: No supported Entity type provided')
+            return -1 if passive else 0
+        if passive and args.top > 0:
+            print('ERROR: --top reports a single result and cannot be used in scan mode')
+            return -1
+        if args.socket and not passive:
+            # Hand the check to the daemon, falling back to running it here if no daemon is listening
+            reply = forward_check(args)
+            if reply is not None:
+                if reply['output'] is not None:
+                    print(reply['output'])
+                if reply['state'] is not None:
+                    exit(reply['state'])
+                return 0
+
+        if not passive:
+            # Checks for the other counters of an entity fetched moments ago are answered without connecting
+            with timed(timings, 'cache'):
+                cache_entries, cache_locks = lock_result_cache(args)
+            atexit.register(release_result_cache, cache_locks)
+            if cache_entries is not None and not cache_locks:
+                result = add_timings(run_cached_check(cache_entries, args), timings)
+                if result:
+                    state, output = result
+                    print(output)
+                    if state is not None:
+                        exit(state)
+                return 0
+
+        with timed(timings, 'import'):
+            import_vsphere()
         # Set stderr to log /dev/null instead of the screen to prevent warnings contaminating output
         # NOTE: This is only in place until a more suitable method to deal with the latest certificate warnings
         f = open('/dev/null', "w")
@@ -491,11 +3101,8 @@ def main():
         original_stderr = sys.stderr
         sys.stderr = f
         try:
-            si = SmartConnect(host=args.host,
-                              user=args.user,
-                              pwd=password,
-                              port=int(args.port),
-                              sslContext=context)
+            with timed(timings, 'connect'):
+                si = connect(args, password)
         except SSLError as e:
             print('Could not verify SSL certificate, use -i / --insecure to skip checking')
             return -1
@@ -508,103 +3115,64 @@ def main():
             print('Could not connect to the specified host using specified username and password')
             return -1
 
-        atexit.register(Disconnect, si)
-        content = si.RetrieveContent()
+        # Keep a cached session logged in so the next check can reuse it
+        if not args.session_cache:
+            atexit.register(Disconnect, si)
+        if timings:
+            timings.count_calls(si._stub)
+        with timed(timings, 'content'):
+            content = si.RetrieveContent()
         # Get vCenter date and time for use as baseline when querying for counters
-        vchtime = si.CurrentTime()
-
-        perf_dict = create_perf_dictionary(content)
-
-        if args.type == 'vm':
-            #Find VM supplied as arg and use Managed Object Reference (moref) for the PrintVmInfo
-            vmProps = get_properties(content, [vim.VirtualMachine], ['name', 'runtime.powerState'], vim.VirtualMachine)
-            for vm in vmProps:
-                if (vm['name'] == entity) and (vm['runtime.powerState'] == "poweredOn"):
-                    vm_moref = vm['moref']
-                    if args.counter == 'core':
-                        vm_core(vm_moref)
-                    elif args.counter == 'status':
-                        vm_status(vm_moref)
-                    elif args.counter == 'cpu.ready':
-                        vm_cpu_ready(vm_moref, content, vchtime, perf_dict, warning, critical)
-                    elif args.counter == 'cpu.usage':
-                        vm_cpu_usage(vm_moref, content, vchtime, perf_dict, warning, critical)
-                    elif args.counter == 'mem.active':
-                        vm_mem_active(vm_moref, content, vchtime, perf_dict, warning, critical)
-                    elif args.counter == 'mem.shared':
-                        vm_mem_shared(vm_moref, content, vchtime, perf_dict, warning, critical)
-                    elif args.counter == 'mem.balloon':
-                        vm_mem_balloon(vm_moref, content, vchtime, perf_dict, warning, critical)
-                    elif args.counter == 'datastore.io':
-                        vm_ds_io(vm_moref, content, vchtime, perf_dict, warning, critical)
-                    elif args.counter == 'datastore.latency':
-                        vm_ds_latency(vm_moref, content, vchtime, perf_dict, warning, critical)
-                    elif args.counter == 'network.usage':
-                        vm_net_usage(vm_moref, content, vchtime, perf_dict, warning, critical)
-                    else:
-                        print('ERROR: No supported counter found')
-                        exit(STATE_UNKNOWN)
-                elif (vm['name'] == entity) and ((vm['runtime.powerState'] == "poweredOff") or (vm['runtime.powerState'] == "suspended")):
-                    vm_moref = vm['moref']
-                    if args.counter == 'core':
-                        vm_core(vm_moref)
-                    elif args.counter == 'status':
-                        vm_status(vm_moref)
-                    else:
-                        print('ERROR: Virtual Machine is powered off')
-                        exit(STATE_UNKNOWN)
-
-        elif args.type == 'host':
-            hostProps = get_properties(content, [vim.HostSystem], ['name'], vim.HostSystem)
-            for host in hostProps:
-                if host['name'] == entity:
-                    host_moref = host['moref']
-                    if args.counter == 'core':
-                        host_core(host_moref)
-                    elif args.counter == 'cpu.usage':
-                        host_cpu_usage(host_moref, warning, critical)
-                    elif args.counter == 'mem.usage':
-                        host_mem_usage(host_moref, warning, critical)
-                    else:
-                        print('ERROR: No supported counter found')
-                        exit(STATE_UNKNOWN)
-
-        elif args.type == 'datastore':
-            dsProps = get_properties(content, [vim.Datastore], ['name'], vim.Datastore)
-            for datastore in dsProps:
-                if datastore['name'] == entity:
-                    ds_moref = datastore['moref']
-                    if args.counter == 'status':
-                        ds_status(ds_moref)
-                    elif args.counter == 'space':
-                        ds_space(ds_moref, warning, critical)
-                    else:
-                        print('ERROR: No supported counter found')
-                        exit(STATE_UNKNOWN)
-
-        elif args.type == 'cluster':
-            clProps = get_properties(content, [vim.ClusterComputeResource], ['name'], vim.ClusterComputeResource)
-            for cluster in clProps:
-                if cluster['name'] == entity:
-                    cl_moref = cluster['moref']
-                    if args.counter == 'status':
-                        cl_status(cl_moref)
-                    else:
-                        print('ERROR: No supported counter found')
-                        exit(STATE_UNKNOWN)
-
-        else:
-            print('ERROR: No supported Entity type provided')
+        with timed(timings, 'time'):
+            vchtime = get_vcenter_time(si, get_clock_file(content, args))
+
+        with timed(timings, 'perf dictionary'):
+            perf_dict = create_perf_dictionary(content, args)
+        ring = SampleRing(get_sample_ring_file(content, args), args.sample_ring_series) if args.sample_ring else None
+
+        if passive:
+            # Scan mode, every entity and counter becomes a passive check result
+            try:
+                results = check_entities(content, vchtime, perf_dict, args, ring=ring)
+            except CheckError as e:
+                print(str(e))
+                if e.state is not None:
+                    exit(e.state)
+                return -1
+            commands = format_passive_results(results, args)
+            try:
+                submit_passive_results(commands, args)
+                if args.api_url:
+                    submit_api_results(format_api_results(results, args), args)
+            except (IOError, OSError) as e:
+                print('CRITICAL - Could not submit passive check results: ' + str(e))
+                exit(STATE_CRITICAL)
+            print('OK - Submitted {} passive check results for {} entities'.format(
+                len(commands), len(set(name for name, counter, result in results))))
+            exit(STATE_OK)
+
+        result = add_timings(run_check(content, vchtime, perf_dict, args, ring=ring, timings=timings), timings)
+        # Let the sibling checks waiting on this fetch read the cache
+        release_result_cache(cache_locks)
+        if result:
+            state, output = result
+            print(output)
+            if state is not None:
+                exit(state)
 
-    except vmodl.MethodFault as e:
-        print("Caught vmodl fault : " + e.msg)
-        return -1
     except Exception as e:
-        print("Caught exception : " + str(e))
+        # vmodl is only imported once the check connects to vCenter
+        if vmodl is not None and isinstance(e, vmodl.MethodFault):
+            print("Caught vmodl fault : " + e.msg)
+        else:
+            print("Caught exception : " + str(e))
         return -1
 
     return 0
 
 # Start program
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        exit(serve())
+    else:
+        main()
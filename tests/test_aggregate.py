@@ -0,0 +1,86 @@
+"""
+Checks how the instances of a counter are combined by build_query, against the fake vCenter in benchmarks/fakevc.py.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from array import array
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+
+import pyvinga
+from fakevc import FakeVCenter
+
+
+class AggregateTest(unittest.TestCase):
+    def setUp(self):
+        pyvinga.import_vsphere()
+        self.work_dir = tempfile.mkdtemp()
+        self.vc = FakeVCenter(num_vms=10, num_datastores=4)
+        si = self.vc.login()
+        self.content = si.RetrieveContent()
+        self.vchtime = si.CurrentTime()
+        self.perf_dict = pyvinga.PerfDictionary(pyvinga.fetch_perf_counters(self.content, pyvinga.max_perf_level),
+                                                os.path.join(self.work_dir, 'perfdic.json'), pyvinga.max_perf_level)
+        # The first Virtual Machine is on two datastores
+        self.vm = pyvinga.vim.VirtualMachine(self.vc.vms[0], self.content.perfManager._GetStub())
+        self.assertEqual(len(self.vc.objects[self.vc.vms[0]].props['datastore']), 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def query(self, counter, aggregate=None):
+        perf_results = pyvinga.build_query(self.content, self.vchtime, self.perf_dict,
+                                           [(self.vm, pyvinga.vm_perf_counters[counter])], aggregate=aggregate)
+        return perf_results[self.vm._moId]
+
+    def test_latency_is_not_summed(self):
+        statdata = self.query('datastore.latency')
+        for counter_name in ('datastore.totalReadLatency.average', 'datastore.totalWriteLatency.average'):
+            instances = list(statdata['instances'][counter_name].values())
+            self.assertEqual(len(instances), 2)
+            self.assertEqual(statdata[counter_name], max(instances))
+            self.assertNotEqual(statdata[counter_name], sum(instances))
+
+    def test_rates_are_summed(self):
+        statdata = self.query('datastore.io')
+        for counter_name in ('datastore.numberReadAveraged.average', 'datastore.numberWriteAveraged.average'):
+            self.assertEqual(statdata[counter_name], sum(statdata['instances'][counter_name].values()))
+
+    def test_aggregate_overrides_the_default(self):
+        statdata = self.query('datastore.latency', 'avg')
+        instances = list(statdata['instances']['datastore.totalReadLatency.average'].values())
+        self.assertEqual(statdata['datastore.totalReadLatency.average'], sum(instances) / len(instances))
+
+
+    def test_latency_is_that_of_the_worst_datastore(self):
+        # Read 10/write 1 on one datastore and read 1/write 10 on the other is 11 on each, not 20
+        statdata = {'datastore.totalReadLatency.average': 10, 'datastore.totalWriteLatency.average': 10,
+                    'instances': {'datastore.totalReadLatency.average': {'A': 10, 'B': 1},
+                                  'datastore.totalWriteLatency.average': {'A': 1, 'B': 10}}}
+        state, output = pyvinga.vm_ds_latency(None, statdata, 20, 50)
+        self.assertTrue(output.startswith('OK - Datastore Latency is 11.0ms'), output)
+        self.assertIn("'Datastore Latency A'=11.0ms 'Datastore Latency B'=11.0ms", output)
+
+    def test_latency_follows_the_aggregate(self):
+        statdata = self.query('datastore.latency', 'sum')
+        instances = statdata['instances']
+        total = sum(instances['datastore.totalReadLatency.average'].values()) + \
+            sum(instances['datastore.totalWriteLatency.average'].values())
+        state, output = pyvinga.vm_ds_latency(None, statdata, 20, 50)
+        self.assertIn('Datastore Latency is {:.1f}ms'.format(total), output)
+
+    def test_series_of_different_lengths_are_aligned_on_the_last_sample(self):
+        instances = {'A': array('l', [1, 2, 3, 4]), 'B': array('l', [10, 20])}
+        self.assertEqual(list(pyvinga.aggregate_series(instances, 'sum')), [1, 2, 13, 24])
+        self.assertEqual(list(pyvinga.aggregate_series(instances, 'max')), [1, 2, 10, 20])
+        self.assertEqual(list(pyvinga.aggregate_series(instances, 'avg')), [1, 2, 6.5, 12])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Checks that the checks for the other counters of an entity are answered from the result cache (--result-cache),
+against the fake vCenter in benchmarks/fakevc.py.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+
+import pyvinga
+from fakevc import FakeVCenter
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        pyvinga.import_vsphere()
+        self.work_dir = tempfile.mkdtemp()
+        self.dirs = pyvinga.result_cache_dir, pyvinga.index_dir
+        pyvinga.result_cache_dir = pyvinga.index_dir = self.work_dir
+        self.vc = FakeVCenter(num_vms=10)
+        si = self.vc.login()
+        self.content = si.RetrieveContent()
+        self.vchtime = si.CurrentTime()
+        self.perf_dict = pyvinga.PerfDictionary(pyvinga.fetch_perf_counters(self.content, pyvinga.max_perf_level),
+                                                os.path.join(self.work_dir, 'perfdic.json'), pyvinga.max_perf_level)
+
+    def tearDown(self):
+        pyvinga.result_cache_dir, pyvinga.index_dir = self.dirs
+        shutil.rmtree(self.work_dir)
+
+    def args(self, counter, *extra):
+        argv = sys.argv
+        sys.argv = ['pyvinga.py', '-s', 'vcenter', '-u', 'pyvinga', '-p', 'secret', '-n', 'vm',
+                    '-e', 'VM00001,VM00002', '-r', counter, '--result-cache', '60'] + list(extra)
+        try:
+            return pyvinga.GetArgs()
+        finally:
+            sys.argv = argv
+
+    def check(self, args):
+        return pyvinga.run_check(self.content, self.vchtime, self.perf_dict, args)
+
+    def test_other_counters_are_answered_from_the_cache(self):
+        args = self.args('cpu.ready')
+        entries, locks = pyvinga.lock_result_cache(args)
+        self.assertEqual((entries, len(locks)), ({}, 2))
+        self.check(args)
+        pyvinga.release_result_cache(locks)
+        self.assertEqual(locks, [])
+        calls = dict(self.vc.calls)
+        for counter in ('cpu.usage', 'mem.balloon', 'datastore.latency', 'status'):
+            args = self.args(counter)
+            entries, locks = pyvinga.lock_result_cache(args)
+            self.assertEqual((sorted(entries), locks), (['VM00001', 'VM00002'], []))
+            uncached = self.check(self.args(counter, '--result-cache', '0'))
+            self.assertEqual(pyvinga.run_cached_check(entries, args), uncached)
+        # The cached checks did not call vCenter, only the checks run for comparison did
+        self.assertEqual(self.vc.calls['QueryPerf'] - calls['QueryPerf'], 3)
+
+    def test_expired_entry_is_fetched_again(self):
+        args = self.args('cpu.ready')
+        self.check(args)
+        cache_file = pyvinga.get_result_cache_file(args, 'VM00001')
+        with open(cache_file) as f:
+            entry = json.load(f)
+        entry['time'] = time.time() - 61
+        with open(cache_file, 'w') as f:
+            json.dump(entry, f)
+        entries, locks = pyvinga.lock_result_cache(args)
+        self.assertEqual((sorted(entries), len(locks)), (['VM00002'], 1))
+        pyvinga.release_result_cache(locks)
+
+    def test_checks_fetching_values_differently_do_not_share_entries(self):
+        args = self.args('cpu.ready')
+        self.check(args)
+        for extra in (['--window', '300'], ['--stat', 'max'], ['-p', 'other']):
+            self.assertNotEqual(pyvinga.get_result_cache_file(self.args('cpu.ready', *extra), 'VM00001'),
+                                pyvinga.get_result_cache_file(args, 'VM00001'))
+        self.assertIsNone(pyvinga.lock_result_cache(self.args('cpu.ready', '-e', 'VM0000*'))[0])
+        self.assertIsNone(pyvinga.lock_result_cache(self.args('cpu.ready', '--top', '1'))[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+"""
+Checks that the vCenter time is derived from the local clock and the offset kept between checks, against the fake
+vCenter in benchmarks/fakevc.py with a clock running behind the local one.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from datetime import datetime, timezone
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+
+import pyvinga
+from fakevc import FakeVCenter
+
+
+class ClockOffsetTest(unittest.TestCase):
+    def setUp(self):
+        pyvinga.import_vsphere()
+        self.work_dir = tempfile.mkdtemp()
+        self.clock_file = os.path.join(self.work_dir, 'pyvinga_clock.json')
+        self.vc = FakeVCenter(num_vms=1, clock_skew=-300)
+        self.si = self.vc.login()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def assertSkew(self, vchtime):
+        self.assertAlmostEqual((vchtime - datetime.now(timezone.utc)).total_seconds(), -300, delta=1)
+
+    def test_offset_is_measured_once(self):
+        self.assertSkew(pyvinga.get_vcenter_time(self.si, self.clock_file))
+        self.assertEqual(self.vc.calls['CurrentTime'], 1)
+        with open(self.clock_file) as f:
+            self.assertAlmostEqual(json.load(f)['offset'], -300, delta=1)
+        vchtime = pyvinga.get_vcenter_time(self.si, self.clock_file)
+        self.assertSkew(vchtime)
+        self.assertIsNotNone(vchtime.tzinfo)
+        self.assertEqual(self.vc.calls['CurrentTime'], 1)
+
+    def test_old_or_future_measurement_is_taken_again(self):
+        for measured in (time.time() - pyvinga.clock_ttl - 1, time.time() + 3600):
+            with open(self.clock_file, 'w') as f:
+                json.dump({'offset': 0, 'measured': measured}, f)
+            self.assertSkew(pyvinga.get_vcenter_time(self.si, self.clock_file))
+        self.assertEqual(self.vc.calls['CurrentTime'], 2)
+
+    def test_damaged_file_is_measured_again(self):
+        with open(self.clock_file, 'w') as f:
+            f.write('not json')
+        self.assertSkew(pyvinga.get_vcenter_time(self.si, self.clock_file))
+        self.assertEqual(self.vc.calls['CurrentTime'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
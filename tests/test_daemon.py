@@ -0,0 +1,104 @@
+"""
+Checks the start up and shut down of the pyvinga daemon (pyvinga.py serve) and the sessions it holds, against the
+fake vCenter in benchmarks/fakevc.py.
+"""
+
+import argparse
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+
+import pyvinga
+from fakevc import FakeVCenter
+
+
+class DaemonSocketTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.work_dir, 'pyvinga.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_stale_socket_is_replaced(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socket_path)
+        stale.close()
+        server = pyvinga.CheckServer(self.socket_path, False)
+        server.server_close()
+
+    def test_running_daemon_is_not_replaced(self):
+        server = pyvinga.CheckServer(self.socket_path, False)
+        try:
+            self.assertRaises(IOError, pyvinga.CheckServer, self.socket_path, False)
+            self.assertTrue(os.path.exists(self.socket_path))
+        finally:
+            server.server_close()
+
+    def test_sigterm_removes_the_socket(self):
+        daemon = subprocess.Popen([sys.executable, os.path.join(root, 'pyvinga.py'), 'serve', '--no-mirror',
+                                   '--socket', self.socket_path])
+        try:
+            for attempt in range(100):
+                client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    client.connect(self.socket_path)
+                    break
+                except socket.error:
+                    time.sleep(0.1)
+                finally:
+                    client.close()
+            else:
+                self.fail('The daemon did not start listening')
+            daemon.send_signal(signal.SIGTERM)
+            self.assertEqual(daemon.wait(10), 0)
+        finally:
+            if daemon.poll() is None:
+                daemon.kill()
+                daemon.wait()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+
+class DaemonSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.perf_dict_dir = pyvinga.perf_dict_dir
+        pyvinga.perf_dict_dir = self.work_dir
+        self.server = pyvinga.CheckServer(os.path.join(self.work_dir, 'pyvinga.sock'), False)
+        self.vc = FakeVCenter(num_vms=1)
+        pyvinga.SmartConnect = self.vc.SmartConnect
+        self.args = argparse.Namespace(host='vcenter', port=443, user='pyvinga', password='secret', insecure=False,
+                                       session_cache=False)
+
+    def tearDown(self):
+        self.server.server_close()
+        pyvinga.perf_dict_dir = self.perf_dict_dir
+        shutil.rmtree(self.work_dir)
+
+    def test_expired_perf_dictionary_is_rebuilt(self):
+        perf_dict = self.server.get_session(self.args)['perf_dict']
+        self.assertIs(self.server.get_session(self.args)['perf_dict'], perf_dict)
+        calls = self.vc.calls['QueryPerfCounterByLevel']
+        # Age the dictionary file past perf_dict_age
+        mtime = time.time() - pyvinga.perf_dict_age.total_seconds() - 60
+        os.utime(perf_dict.file_perf_dic, (mtime, mtime))
+        self.server.sessions[('vcenter', 443, 'pyvinga')]['perf_dict_expires'] = mtime
+        session = self.server.get_session(self.args)
+        self.assertIsNot(session['perf_dict'], perf_dict)
+        self.assertEqual(self.vc.calls['QueryPerfCounterByLevel'], calls + 1)
+        self.assertGreater(session['perf_dict_expires'], time.time())
+        self.assertEqual(self.vc.calls['Login'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""
+Checks that the files kept between checks cannot be redirected by other users.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+
+import pyvinga
+from fakevc import FakeStub, FakeVCenter
+
+
+class PrivateFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_missing_directory_is_created_private(self):
+        cache_dir = os.path.join(self.work_dir, 'cache')
+        self.assertEqual(pyvinga.private_dir(cache_dir), cache_dir)
+        self.assertEqual(os.stat(cache_dir).st_mode & 0o777, 0o700)
+
+    def test_directory_writable_by_others_is_refused(self):
+        cache_dir = os.path.join(self.work_dir, 'shared')
+        os.mkdir(cache_dir)
+        os.chmod(cache_dir, 0o1777)
+        self.assertRaises(IOError, pyvinga.private_dir, cache_dir)
+
+    def test_symlinked_directory_is_refused(self):
+        cache_dir = os.path.join(self.work_dir, 'link')
+        os.symlink(self.work_dir, cache_dir)
+        self.assertRaises(IOError, pyvinga.private_dir, cache_dir)
+
+    def test_write_replaces_a_planted_symlink(self):
+        target = os.path.join(self.work_dir, 'target')
+        with open(target, 'w') as f:
+            f.write('untouched')
+        file_name = os.path.join(self.work_dir, 'pyvinga_clock.json')
+        os.symlink(target, file_name)
+        pyvinga.write_file_atomic(file_name, '{}', 0o644)
+        with open(target) as f:
+            self.assertEqual(f.read(), 'untouched')
+        self.assertFalse(os.path.islink(file_name))
+        with open(file_name) as f:
+            self.assertEqual(f.read(), '{}')
+        self.assertEqual(os.stat(file_name).st_mode & 0o777, 0o644)
+        self.assertEqual(sorted(os.listdir(self.work_dir)), ['pyvinga_clock.json', 'target'])
+
+
+class SessionCacheTest(unittest.TestCase):
+    def setUp(self):
+        pyvinga.import_vsphere()
+        self.work_dir = tempfile.mkdtemp()
+        self.session_cache_dir = pyvinga.session_cache_dir
+        pyvinga.session_cache_dir = self.work_dir
+        self.vc = FakeVCenter(num_vms=1)
+        pyvinga.SmartConnect = self.vc.SmartConnect
+        pyvinga.SoapStubAdapter = self.vc.SoapStubAdapter
+        self.args = argparse.Namespace(host='vcenter', port=443, user='pyvinga', insecure=False, session_cache=True)
+
+    def tearDown(self):
+        pyvinga.session_cache_dir = self.session_cache_dir
+        shutil.rmtree(self.work_dir)
+
+    def test_cached_session_is_reused(self):
+        si = pyvinga.connect(self.args, 'secret')
+        self.assertIsNotNone(si)
+        self.assertEqual(pyvinga.connect(self.args, 'secret')._stub.cookie, si._stub.cookie)
+        self.assertEqual(self.vc.calls['Login'], 1)
+
+    def test_damaged_cache_file_logs_in_again(self):
+        for content in ('not json', '{}', '[]'):
+            with open(pyvinga.get_session_file(self.args), 'w') as f:
+                f.write(content)
+            self.assertIsNotNone(pyvinga.connect(self.args, 'secret'))
+            with open(pyvinga.get_session_file(self.args)) as f:
+                self.assertIn('cookie', json.load(f))
+        self.assertEqual(self.vc.calls['Login'], 3)
+
+    def test_expired_session_logs_in_again(self):
+        si = pyvinga.connect(self.args, 'secret')
+        self.vc.sessions.clear()
+        self.assertNotEqual(pyvinga.connect(self.args, 'secret')._stub.cookie, si._stub.cookie)
+        self.assertEqual(self.vc.calls['Login'], 2)
+
+    def test_unreachable_session_logs_in_again(self):
+        pyvinga.connect(self.args, 'secret')
+
+        class UnreachableStub(FakeStub):
+            def InvokeMethod(self, mo, info, args):
+                raise ConnectionResetError(104, 'Connection reset by peer')
+
+        pyvinga.SoapStubAdapter = lambda *args, **kwargs: UnreachableStub(self.vc)
+        self.assertIsNotNone(pyvinga.connect(self.args, 'secret'))
+        self.assertEqual(self.vc.calls['Login'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
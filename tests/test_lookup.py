@@ -0,0 +1,106 @@
+"""
+Checks how the entities named on the command line are found on the fake vCenter in benchmarks/fakevc.py.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+
+import pyvinga
+from fakevc import FakeVCenter
+
+
+class LookupTest(unittest.TestCase):
+    def setUp(self):
+        pyvinga.import_vsphere()
+        self.vc = FakeVCenter(num_vms=50)
+        self.content = self.vc.login().RetrieveContent()
+
+    def lookup(self, names, container=None):
+        args = argparse.Namespace(container=container)
+        if container:
+            container = self.content.searchIndex.FindByInventoryPath(inventoryPath=container)
+        return pyvinga.lookup_entities(self.content, args, [pyvinga.vim.VirtualMachine], ['name'],
+                                       pyvinga.vim.VirtualMachine, names, container)
+
+    def test_names_are_found_with_one_view_scan(self):
+        found = self.lookup(['VM00007', 'VM00003', 'missing'])
+        self.assertEqual([prop['name'] for prop in found], ['VM00007', 'VM00003'])
+        self.assertEqual([prop['moref']._moId for prop in found], ['vm-7', 'vm-3'])
+        self.assertNotIn('FindByDnsName', self.vc.calls)
+        self.assertEqual(self.vc.calls['CreateContainerView'], 1)
+
+    def test_names_below_a_container_are_found_by_inventory_path(self):
+        found = self.lookup(['VM00007'], 'DC1/vm')
+        self.assertEqual([prop['moref']._moId for prop in found], ['vm-7'])
+        self.assertNotIn('CreateContainerView', self.vc.calls)
+
+
+class IndexTest(unittest.TestCase):
+    def setUp(self):
+        pyvinga.import_vsphere()
+        self.work_dir = tempfile.mkdtemp()
+        self.index_dir = pyvinga.index_dir
+        pyvinga.index_dir = self.work_dir
+        self.vc = FakeVCenter(num_vms=50)
+        self.content = self.vc.login().RetrieveContent()
+
+    def tearDown(self):
+        pyvinga.index_dir = self.index_dir
+        shutil.rmtree(self.work_dir)
+
+    def args(self, entity):
+        return argparse.Namespace(entity=entity, container=None, index_ttl=3600, host='vcenter', port=443)
+
+    def find(self, entity):
+        found = pyvinga.find_entities(self.content, self.args(entity), [pyvinga.vim.VirtualMachine], ['name'],
+                                      pyvinga.vim.VirtualMachine)
+        return [(prop['name'], prop['moref']._moId) for prop in found]
+
+    def read_index(self):
+        return pyvinga.read_index(pyvinga.get_index_file(self.content, self.args(''), pyvinga.vim.VirtualMachine))
+
+    def test_found_names_are_remembered(self):
+        self.assertEqual(self.find('VM00007'), [('VM00007', 'vm-7')])
+        self.assertEqual(self.read_index()['entities'], [['VM00007', 'vm-7']])
+        self.assertEqual(self.find('VM00003,VM00007'), [('VM00003', 'vm-3'), ('VM00007', 'vm-7')])
+        self.assertEqual(sorted(self.read_index()['entities']), [['VM00003', 'vm-3'], ['VM00007', 'vm-7']])
+        views = self.vc.calls['CreateContainerView']
+        # Every name is in the index now, the entities are read without a View scan
+        self.assertEqual(sorted(self.find('VM00007,VM00003')), [('VM00003', 'vm-3'), ('VM00007', 'vm-7')])
+        self.assertEqual(self.vc.calls['CreateContainerView'], views)
+
+    def test_renamed_entity_is_looked_up_again(self):
+        self.find('VM00007')
+        self.vc.set_property('vm-7', 'name', 'web01')
+        self.assertEqual(self.find('VM00007'), [])
+        self.assertEqual(self.find('web01'), [('web01', 'vm-7')])
+        self.assertEqual(self.read_index()['entities'], [['web01', 'vm-7']])
+
+    def test_patterns_use_the_index_until_it_expires(self):
+        self.assertEqual(len(self.find('VM0000*')), 9)
+        self.assertEqual(len(self.read_index()['entities']), 50)
+        views = self.vc.calls['CreateContainerView']
+        self.assertEqual(len(self.find('VM0001?')), 10)
+        self.assertEqual(self.vc.calls['CreateContainerView'], views)
+        index_file = pyvinga.get_index_file(self.content, self.args(''), pyvinga.vim.VirtualMachine)
+        index = self.read_index()
+        index['built'] = time.time() - 3601
+        with open(index_file, 'w') as f:
+            json.dump(index, f)
+        self.assertEqual(len(self.find('VM0001?')), 10)
+        self.assertEqual(self.vc.calls['CreateContainerView'], views + 1)
+        self.assertGreater(self.read_index()['built'], time.time() - 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+Checks how the output of checks reporting on several entities is put together.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pyvinga
+
+
+class CombineResultsTest(unittest.TestCase):
+    def test_single_result_is_unchanged(self):
+        result = (pyvinga.STATE_OK, "OK - CPU Ready is 0.3%  | 'CPU Ready'=0.3%;5.0;10.0;0;100")
+        self.assertEqual(pyvinga.combine_results([('VM1', result)]), result)
+
+    def test_perfdata_follows_the_first_line_labelled_by_entity(self):
+        state, output = pyvinga.combine_results([
+            ('VM1', pyvinga.format_output_float(0.3, 'CPU Ready', 5.0, 10.0, '%')),
+            ('VM2', pyvinga.format_output_float(7.5, 'CPU Ready', 5.0, 10.0, '%')),
+            ('VM3', (pyvinga.STATE_OK, 'OK - Virtual Machine Status is green ')),
+        ])
+        self.assertEqual(state, pyvinga.STATE_WARNING)
+        lines = output.split('\n')
+        self.assertEqual(output.count('|'), 1)
+        self.assertEqual(lines[0], "WARNING - 3 results, 1 WARNING, 2 OK | 'VM1 CPU Ready'=0.3%;5.0;10.0;0;100 "
+                                   "'VM2 CPU Ready'=7.5%;5.0;10.0")
+        self.assertEqual(lines[1:], ['VM1: OK - CPU Ready is 0.3%', 'VM2: WARNING - CPU Ready is 7.5%',
+                                     'VM3: OK - Virtual Machine Status is green'])
+
+    def test_first_line_reports_the_worst_state(self):
+        state, output = pyvinga.combine_results([
+            ('VM1', pyvinga.format_output_float(0.3, 'CPU Ready', 5.0, 10.0, '%')),
+            ('VM2', pyvinga.format_output_float(12.5, 'CPU Ready', 5.0, 10.0, '%')),
+            ('VM3', pyvinga.format_output_float(7.5, 'CPU Ready', 5.0, 10.0, '%')),
+            ('VM4', (pyvinga.STATE_UNKNOWN, 'UNKNOWN - No supported counter found')),
+        ])
+        self.assertEqual(state, pyvinga.STATE_CRITICAL)
+        self.assertTrue(output.startswith('CRITICAL - 4 results, 1 CRITICAL, 1 WARNING, 1 UNKNOWN, 1 OK | '), output)
+        self.assertEqual(output.split('\n')[1], 'VM1: OK - CPU Ready is 0.3%')
+
+    def test_quotes_in_entity_names_are_doubled(self):
+        state, output = pyvinga.combine_results([
+            ("Bob's VM", pyvinga.format_output_float(0.3, 'CPU Ready', 5.0, 10.0, '%')),
+            ('VM2', (pyvinga.STATE_OK, 'OK - Free is 3 | free=3')),
+        ])
+        self.assertIn("'Bob''s VM CPU Ready'=0.3%", output)
+        self.assertIn("'VM2 free'=3", output)
+        self.assertEqual(pyvinga.split_check_output(output)[1],
+                         ["'Bob''s VM CPU Ready'=0.3%;5.0;10.0;0;100", "'VM2 free'=3"])
+
+
+if __name__ == '__main__':
+    unittest.main()
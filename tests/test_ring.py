@@ -0,0 +1,110 @@
+"""
+Checks the shared sample ring (see --sample-ring), and what build_query keeps in it, against the fake vCenter in
+benchmarks/fakevc.py.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+
+import pyvinga
+from fakevc import FakeVCenter
+
+
+class SampleRingTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.work_dir, 'ring')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_series_reuses_its_slot(self):
+        ring = pyvinga.SampleRing(self.file_name, 64, 4)
+        key = pyvinga.SampleRing.key('vm-1', 'cpu.ready.summation')
+        ring.add(key, [(20, 1.0), (40, 2.0)])
+        # Samples already stored are skipped, the ring keeps the last 4
+        ring.add(key, [(40, 9.0), (60, 3.0), (80, 4.0), (100, 5.0)])
+        self.assertEqual(ring.samples(key), [(40, 2.0), (60, 3.0), (80, 4.0), (100, 5.0)])
+        self.assertEqual(ring.samples(key, 40, 80), [(60, 3.0), (80, 4.0)])
+        ring.close()
+        # Another process finds the series in the same slot
+        ring = pyvinga.SampleRing(self.file_name, 64, 4)
+        self.assertEqual(ring.samples(key), [(40, 2.0), (60, 3.0), (80, 4.0), (100, 5.0)])
+        ring.close()
+
+    def test_full_table_evicts_the_oldest_series(self):
+        ring = pyvinga.SampleRing(self.file_name, 16, 4)
+        keys = [pyvinga.SampleRing.key('vm-{}'.format(number), 'cpu.ready.summation') for number in range(17)]
+        for number, key in enumerate(keys[:16]):
+            # vm-3 has the oldest samples
+            ring.add(key, [(1000 if number != 3 else 10, float(number))])
+        ring.add(keys[16], [(2000, 16.0)])
+        self.assertEqual(ring.samples(keys[3]), [])
+        self.assertEqual(ring.samples(keys[16]), [(2000, 16.0)])
+        self.assertEqual(len([key for key in keys if ring.samples(key)]), 16)
+        ring.close()
+
+    def test_reserve_grows_the_ring_and_keeps_the_samples(self):
+        ring = pyvinga.SampleRing(self.file_name, 16, 4)
+        other = pyvinga.SampleRing(self.file_name, 16, 4)
+        keys = [pyvinga.SampleRing.key('vm-{}'.format(number), 'cpu.ready.summation') for number in range(40)]
+        for number, key in enumerate(keys[:8]):
+            ring.add(key, [(20, float(number))])
+        ring.reserve(len(keys))
+        self.assertEqual(ring.series, 128)
+        for number, key in enumerate(keys):
+            ring.add(key, [(40, float(number))])
+        # A process that mapped the smaller file follows the growth
+        self.assertEqual(other.samples(keys[0]), [(20, 0.0), (40, 0.0)])
+        self.assertEqual(other.series, 128)
+        self.assertEqual([len(other.samples(key)) for key in keys], [2] * 8 + [1] * 32)
+        # A process asking for fewer slots keeps the larger layout
+        ring.close()
+        ring = pyvinga.SampleRing(self.file_name, 16, 4)
+        self.assertEqual(ring.series, 128)
+        ring.close()
+        other.close()
+
+
+class RingQueryTest(unittest.TestCase):
+    def setUp(self):
+        pyvinga.import_vsphere()
+        self.work_dir = tempfile.mkdtemp()
+        self.vc = FakeVCenter(num_vms=10, num_datastores=4)
+        si = self.vc.login()
+        self.content = si.RetrieveContent()
+        self.vchtime = si.CurrentTime()
+        self.perf_dict = pyvinga.PerfDictionary(pyvinga.fetch_perf_counters(self.content, pyvinga.max_perf_level),
+                                                os.path.join(self.work_dir, 'perfdic.json'), pyvinga.max_perf_level)
+        self.vm = pyvinga.vim.VirtualMachine(self.vc.vms[0], self.content.perfManager._GetStub())
+        self.ring = pyvinga.SampleRing(os.path.join(self.work_dir, 'ring'), 64)
+
+    def tearDown(self):
+        self.ring.close()
+        shutil.rmtree(self.work_dir)
+
+    def query(self, counter):
+        return pyvinga.build_query(self.content, self.vchtime, self.perf_dict,
+                                   [(self.vm, pyvinga.vm_perf_counters[counter])], ring=self.ring)
+
+    def test_second_query_is_answered_from_the_ring(self):
+        first = self.query('cpu.ready')
+        calls = self.vc.calls.get('QueryPerf', 0)
+        self.assertEqual(self.query('cpu.ready'), first)
+        self.assertEqual(self.vc.calls.get('QueryPerf', 0), calls)
+
+    def test_instance_counters_are_not_stored(self):
+        self.query('datastore.latency')
+        for counter_name, instance in pyvinga.vm_perf_counters['datastore.latency']:
+            self.assertEqual(self.ring.samples(pyvinga.SampleRing.key(self.vm._moId, counter_name)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
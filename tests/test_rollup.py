@@ -0,0 +1,59 @@
+"""
+Checks the Host and Cluster counters rolled up over their Virtual Machines.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pyvinga
+
+
+class Moref(object):
+    def __init__(self, moid):
+        self._moId = moid
+
+
+def vm(moid, power_state='poweredOn', memory=1024):
+    return {'moref': Moref(moid), 'name': moid, 'runtime.powerState': power_state,
+            'summary.config.memorySizeMB': memory}
+
+
+class RollupTest(unittest.TestCase):
+    def setUp(self):
+        self.host = {'name': 'esx01', 'vms': [vm('vm-1'), vm('vm-2'), vm('vm-3'), vm('vm-4', 'poweredOff')]}
+        self.perf_results = {
+            'vm-1': {'cpu.ready.summation': 200, 'mem.vmmemctl.average': 0},
+            'vm-2': {'cpu.ready.summation': 1400, 'mem.vmmemctl.average': 102400},
+            'vm-3': {'cpu.ready.summation': 2400, 'mem.vmmemctl.average': 0},
+        }
+
+    def test_cpu_ready_reports_the_worst_vm(self):
+        state, output = pyvinga.rollup_cpu_ready(self.host, self.perf_results, 5, 10)
+        self.assertEqual(state, pyvinga.STATE_CRITICAL)
+        self.assertIn('Worst VM CPU Ready is 12.0% (vm-3, 2 of 3 VMs over warning)', output)
+        self.assertIn("'VMs over warning'=2;;;0;3", output)
+
+    def test_mem_balloon_is_a_share_of_the_configured_memory(self):
+        state, output = pyvinga.rollup_mem_balloon(self.host, self.perf_results, 50, 75)
+        self.assertEqual(state, pyvinga.STATE_OK)
+        self.assertIn('Total VM Memory Balloon is 100.0MB (1 of 3 VMs ballooning)', output)
+        self.assertIn("'Total VM Memory Balloon'=100.0MB;1536.0;2304.0;0;3072", output)
+
+    def test_mem_balloon_skips_vms_without_a_memory_size(self):
+        self.host['vms'][0]['summary.config.memorySizeMB'] = None
+        del self.host['vms'][2]['summary.config.memorySizeMB']
+        state, output = pyvinga.rollup_mem_balloon(self.host, self.perf_results, 50, 75)
+        self.assertIn("'Total VM Memory Balloon'=100.0MB;512.0;768.0;0;1024", output)
+
+    def test_no_powered_on_vm_is_unknown(self):
+        self.host['vms'] = [vm('vm-4', 'poweredOff')]
+        with self.assertRaises(pyvinga.CheckError) as raised:
+            pyvinga.rollup_cpu_ready(self.host, self.perf_results, 5, 10)
+        self.assertEqual(raised.exception.state, pyvinga.STATE_UNKNOWN)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+"""
+Checks the submission of passive check results to the Icinga 2 API against the stand-in API.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import pyvinga
+from fakeicinga import FakeIcinga
+
+
+def result(number, output='OK - CPU Ready is 0.3%  '):
+    return {'type': 'Service', 'service': 'host{}!cpu.ready'.format(number), 'exit_status': 0,
+            'plugin_output': output, 'performance_data': ["'CPU Ready'=0.3%;5.0;10.0;0;100"]}
+
+
+class ApiSubmitterTest(unittest.TestCase):
+    def setUp(self):
+        self.icinga = FakeIcinga()
+
+    def tearDown(self):
+        self.icinga.close()
+
+    def test_results_are_accepted(self):
+        submitter = pyvinga.ApiSubmitter(self.icinga.url, 'pyvinga', 'secret', 2)
+        for number in range(20):
+            submitter.submit(result(number))
+        self.assertEqual(submitter.close(), 20)
+        self.assertEqual(len(self.icinga.results), 20)
+
+    def test_unexpected_error_fails_only_its_result(self):
+        # A result that cannot be serialized raises in the worker, more of them than the queue holds
+        submitter = pyvinga.ApiSubmitter(self.icinga.url, 'pyvinga', 'secret', 1, queue_size=2, batch_size=1)
+        for number in range(10):
+            submitter.submit(result(number, object() if number % 2 else 'OK'))
+        with self.assertRaises(IOError) as raised:
+            submitter.close()
+        self.assertIn('5 of 10 results', str(raised.exception))
+        self.assertEqual(submitter.submitted, 5)
+
+
+    def test_https_does_not_need_a_vcenter_connection(self):
+        submitter = pyvinga.ApiSubmitter('https://127.0.0.1:1', 'pyvinga', 'secret', 1, insecure=True)
+        try:
+            self.assertEqual(submitter.connect().port, 1)
+        finally:
+            submitter.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
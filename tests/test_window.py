@@ -0,0 +1,80 @@
+"""
+Checks the statistics taken over a multi-sample window (--window and --stat), against the fake vCenter in
+benchmarks/fakevc.py.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from array import array
+from datetime import timedelta
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+
+import pyvinga
+from fakevc import FakeVCenter, realtime_samples
+
+
+class SeriesStatTest(unittest.TestCase):
+    def test_statistics(self):
+        values = array('l', range(20, 0, -1))
+        self.assertEqual(pyvinga.series_stat(values, 'avg'), 10.5)
+        self.assertEqual(pyvinga.series_stat(values, 'max'), 20.0)
+        # The nearest rank 95th percentile of 20 samples is the 19th smallest
+        self.assertEqual(pyvinga.series_stat(values, 'p95'), 19.0)
+        self.assertEqual(pyvinga.series_stat(array('l', [7]), 'p95'), 7.0)
+        self.assertEqual(pyvinga.series_stat(array('l'), 'max'), 0.0)
+
+    def test_stat_name(self):
+        self.assertEqual(pyvinga.stat_name('CPU Ready', {'stat': 'p95'}), 'CPU Ready (p95)')
+        self.assertEqual(pyvinga.stat_name('CPU Ready', {}), 'CPU Ready')
+
+
+class WindowQueryTest(unittest.TestCase):
+    def setUp(self):
+        pyvinga.import_vsphere()
+        self.work_dir = tempfile.mkdtemp()
+        self.vc = FakeVCenter(num_vms=10)
+        si = self.vc.login()
+        self.content = si.RetrieveContent()
+        self.vchtime = si.CurrentTime()
+        self.perf_dict = pyvinga.PerfDictionary(pyvinga.fetch_perf_counters(self.content, pyvinga.max_perf_level),
+                                                os.path.join(self.work_dir, 'perfdic.json'), pyvinga.max_perf_level)
+        self.vm = pyvinga.vim.VirtualMachine(self.vc.vms[0], self.content.perfManager._GetStub())
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def query(self, window, stat):
+        perf_results = pyvinga.build_query(self.content, self.vchtime, self.perf_dict,
+                                           [(self.vm, pyvinga.vm_perf_counters['cpu.ready'])],
+                                           window=window, stat=stat)
+        return perf_results[self.vm._moId]
+
+    def samples(self, window):
+        end = pyvinga.align_sample_time(self.vchtime - timedelta(seconds=pyvinga.sample_delay))
+        counter_id = self.perf_dict['cpu.ready.summation']
+        return [self.vc.sample_value(self.vm._moId, counter_id, '', timestamp)
+                for timestamp in realtime_samples(end - timedelta(seconds=window), end)]
+
+    def test_window_holds_every_sample(self):
+        self.assertEqual(len(self.samples(300)), 15)
+        for stat in ('avg', 'max', 'p95'):
+            statdata = self.query(300, stat)
+            self.assertEqual(statdata['stat'], stat)
+            self.assertEqual(statdata['cpu.ready.summation'], pyvinga.series_stat(array('l', self.samples(300)), stat))
+        state, output = pyvinga.vm_cpu_ready(None, self.query(300, 'p95'), 100, 100)
+        self.assertIn("'CPU Ready (p95)'=", output)
+
+    def test_single_sample_has_no_statistic(self):
+        statdata = self.query(pyvinga.sample_interval, 'p95')
+        self.assertNotIn('stat', statdata)
+        self.assertEqual(statdata['cpu.ready.summation'], float(self.samples(pyvinga.sample_interval)[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()